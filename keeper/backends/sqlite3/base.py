@@ -0,0 +1,230 @@
+"""
+SQLite backend for concurrent web workers, use it with ENGINE 'keeper.backends.sqlite3'.
+
+Every new connection runs LUNA_SQLITE_PRAGMAS, by default WAL journaling so that readers never wait for a writer.
+The transaction of an atomic block begins with its first statement. It begins with BEGIN IMMEDIATE if that statement
+writes or reads rows with select_for_update, so a transaction that reads before it writes can't fail half-way with
+"database is locked", and with a plain BEGIN otherwise, so read-only blocks don't wait for writers. A block that
+reads before it writes should read with select_for_update. With LUNA_SQLITE_WRITER_QUEUE on, write transactions and
+writes outside of transactions of all threads and processes of the host also take turns on a lock file next to the
+database, instead of polling SQLite's busy handler. Both wait at most OPTIONS['timeout'] seconds, 20 by default.
+"""
+import logging
+import os
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.db.backends.sqlite3 import base, operations
+from django.db.utils import OperationalError
+
+try:
+    import fcntl
+except ImportError:  #  not available on Windows
+    fcntl = None
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    #  WAL stays consistent after a crash with NORMAL, the last transactions may be lost on power failure
+    'synchronous': 'NORMAL',
+    #  in KiB when negative
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+}
+DEFAULT_TIMEOUT_SECONDS = 20
+#  statements taking the writer lock
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
+#  waits between attempts to lock a lock file held by another process
+POLL_MIN_SECONDS = 0.0005
+POLL_MAX_SECONDS = 0.005
+
+
+def pragmas() -> typing.Dict[str, typing.Any]:
+    return getattr(settings, 'LUNA_SQLITE_PRAGMAS', DEFAULT_PRAGMAS) or {}
+
+
+def writer_queue_enabled() -> bool:
+    return getattr(settings, 'LUNA_SQLITE_WRITER_QUEUE', True)
+
+
+class WriterLock:
+    """Lets one connection at a time write the database, across the threads and processes of the host.
+
+    A thread lock queues the threads of the process, the winner then locks the lock file against other processes,
+    as POSIX locks don't exclude threads of the same process.
+    """
+
+    _locks: typing.Dict[typing.Tuple[int, str], 'WriterLock'] = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path + '-writer'
+        self.lock = threading.Lock()
+        self.fd: typing.Optional[int] = None
+
+    @classmethod
+    def of(cls, database: str) -> 'WriterLock':
+        #  a forked worker gets its own, the parent's thread lock may have been held while forking
+        key = (os.getpid(), os.path.abspath(database))
+        with cls._locks_lock:
+            if key not in cls._locks:
+                cls._locks[key] = cls(key[1])
+            return cls._locks[key]
+
+    def acquire(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        if not self.lock.acquire(timeout=timeout):
+            raise OperationalError('database is locked')
+        if fcntl is None:
+            return
+        try:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            delay = POLL_MIN_SECONDS
+            while True:
+                try:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return
+                except OSError:
+                    #  held by another process
+                    if time.monotonic() + delay > deadline:
+                        raise OperationalError('database is locked')
+                    time.sleep(delay)
+                    delay = min(delay * 2, POLL_MAX_SECONDS)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+class DatabaseOperations(operations.DatabaseOperations):
+    compiler_module = 'keeper.backends.sqlite3.compiler'
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    ops_class = DatabaseOperations
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer_lock: typing.Optional[WriterLock] = None
+        self.holds_writer_lock = False
+        #  an atomic block was entered, its transaction begins with the first statement
+        self.begin_pending = False
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        #  SQLite's busy handler waits as long as the writer lock
+        params.setdefault('timeout', DEFAULT_TIMEOUT_SECONDS)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        in_memory = self.is_in_memory_db()
+        for name, value in pragmas().items():
+            result = conn.execute(f'PRAGMA {name} = {value}').fetchone()
+            if name == 'journal_mode' and not in_memory and str(result[0]).lower() != str(value).lower():
+                #  e.g. WAL on a network file system
+                logging.warning("sqlite journal_mode is %s instead of %s", result[0], value)
+        self.writer_lock = WriterLock.of(conn_params['database']) \
+            if writer_queue_enabled() and not in_memory else None
+        return conn
+
+    def create_cursor(self, name=None):
+        cursor = self.connection.cursor(factory=SQLiteCursorWrapper)
+        cursor.database = self
+        return cursor
+
+    def _start_transaction_under_autocommit(self):
+        self.begin_pending = True
+
+    def begin(self, writes: bool):
+        self.begin_pending = False
+        if writes:
+            self.acquire_writer_lock()
+        try:
+            with self.wrap_database_errors:
+                self.connection.execute('BEGIN IMMEDIATE' if writes else 'BEGIN')
+        except BaseException:
+            self.release_writer_lock()
+            raise
+
+    def before_statement(self, writes: bool) -> bool:
+        """Begins a pending transaction and takes the writer lock before a write,
+        returns whether the lock is to be released after the statement"""
+        if self.begin_pending:
+            self.begin(writes)
+            return False
+        if not writes or self.writer_lock is None or self.holds_writer_lock:
+            return False
+        self.acquire_writer_lock()
+        #  a transaction that began with a read holds it until it ends
+        return not self.connection.in_transaction
+
+    def prepare_write(self):
+        """Called before reading rows the transaction is going to write, i.e. by select_for_update"""
+        if self.begin_pending:
+            self.begin(writes=True)
+        elif self.connection is not None and self.connection.in_transaction:
+            self.acquire_writer_lock()
+
+    def _commit(self):
+        self.begin_pending = False
+        try:
+            super()._commit()
+        finally:
+            self.release_writer_lock()
+
+    def _rollback(self):
+        self.begin_pending = False
+        try:
+            super()._rollback()
+        finally:
+            self.release_writer_lock()
+
+    def _close(self):
+        self.begin_pending = False
+        try:
+            super()._close()
+        finally:
+            self.release_writer_lock()
+
+    def acquire_writer_lock(self):
+        if self.writer_lock is not None and not self.holds_writer_lock:
+            self.writer_lock.acquire(self.settings_dict['OPTIONS'].get('timeout', DEFAULT_TIMEOUT_SECONDS))
+            self.holds_writer_lock = True
+
+    def release_writer_lock(self):
+        if self.holds_writer_lock:
+            self.holds_writer_lock = False
+            self.writer_lock.release()
+
+
+class SQLiteCursorWrapper(base.SQLiteCursorWrapper):
+    """Begins pending transactions and takes the writer lock for writes"""
+    database: DatabaseWrapper
+
+    def execute(self, query, params=None):
+        if not self.database.before_statement(self.writes(query)):
+            return super().execute(query, params)
+        try:
+            return super().execute(query, params)
+        finally:
+            self.database.release_writer_lock()
+
+    def executemany(self, query, param_list):
+        if not self.database.before_statement(self.writes(query)):
+            return super().executemany(query, param_list)
+        try:
+            return super().executemany(query, param_list)
+        finally:
+            self.database.release_writer_lock()
+
+    @staticmethod
+    def writes(query: str) -> bool:
+        return query.lstrip()[:7].upper().startswith(WRITE_STATEMENTS)
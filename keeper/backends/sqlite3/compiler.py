@@ -0,0 +1,26 @@
+from django.db.models.sql import compiler
+
+
+class SQLCompiler(compiler.SQLCompiler):
+
+    def execute_sql(self, *args, **kwargs):
+        if self.query.select_for_update:
+            #  SQLite has no row locks, the rows are read to be written
+            self.connection.prepare_write()
+        return super().execute_sql(*args, **kwargs)
+
+
+class SQLInsertCompiler(compiler.SQLInsertCompiler, SQLCompiler):
+    pass
+
+
+class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SQLCompiler):
+    pass
+
+
+class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SQLCompiler):
+    pass
+
+
+class SQLAggregateCompiler(compiler.SQLAggregateCompiler, SQLCompiler):
+    pass
@@ -0,0 +1,89 @@
+import contextlib
+import datetime
+import os
+import statistics
+import tempfile
+import typing
+
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils.timezone import now
+
+from ..consts import NOTIFY_CHANNEL_EMAIL
+from ..models import Pony
+from ..services import pony_cache, counters
+from ..utils import hash_password
+
+BENCHMARK_PASSCODE = 'benchmark'
+SEED_BATCH_SIZE = 2000
+
+
+@contextlib.contextmanager
+def benchmark_environment():
+    """Runs the benchmark against a fresh file based test database, never against the configured one"""
+    setup_test_environment()
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    tmp_dir = None
+    if connection.vendor == 'sqlite':
+        #  a file instead of the in-memory default, so worker threads share the data
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_settings['NAME'] = os.path.join(tmp_dir.name, 'benchmark.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = old_test_name
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+        teardown_test_environment()
+
+
+def seed_ponies(count: int, status: int = Pony.STATUS_NORMAL, last_hi_time: datetime.datetime = None,
+                dark_minute: int = 5, prefix: str = 'bench') -> typing.List[str]:
+    """Bulk creates ponies sharing BENCHMARK_PASSCODE, returns their names"""
+    current_time = now()
+    if last_hi_time is None and status == Pony.STATUS_NORMAL:
+        last_hi_time = current_time
+    passcode = hash_password(BENCHMARK_PASSCODE)
+    names = [f'{prefix}{i}' for i in range(count)]
+    for i in range(0, count, SEED_BATCH_SIZE):
+        ponies = [Pony(name=name, passcode=passcode, dark_minute=dark_minute, status=status,
+                       last_hi_time=last_hi_time, notify_channel=NOTIFY_CHANNEL_EMAIL,
+                       notify_url=f'{name}@equestria.org', create_time=current_time)
+                  for name in names[i:i + SEED_BATCH_SIZE]]
+        for pony in ponies:
+            pony.refresh_deadline()
+        Pony.objects.bulk_create(ponies, batch_size=500)
+    counters.reconcile()
+    return names
+
+
+def clear_pony_cache():
+    """Makes the next run start cold"""
+    cache = pony_cache.get_cache()
+    if cache is not None:
+        cache.clear()
+
+
+def latency_summary(latencies: typing.List[float], elapsed: float, errors: int = 0) -> dict:
+    """Throughput and latency percentiles in milliseconds of a list of latencies in seconds"""
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+
+def percentile(sorted_values: typing.List[float], pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
@@ -0,0 +1,154 @@
+import datetime
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.signals import request_started, request_finished
+from django.db import connection, DatabaseError
+from django.utils.timezone import now
+
+from . import BENCHMARK_PASSCODE, seed_ponies, latency_summary
+from .startup import write_settings
+
+CONTENTION_PONIES = 1000
+CONTENTION_SECONDS = 10
+CONTENTION_READERS = 2
+#  ponies the checker process lets go overdue before each sweep, and its pause between sweeps
+SWEEP_OVERDUE = 20
+SWEEP_INTERVAL_SECONDS = 0.2
+#  processes start working together at the same time after this many seconds, enough to import Django
+START_DELAY_SECONDS = 3
+
+#  profile -> database engine, journal mode of the copy of the database it starts with, and settings
+PROFILES = {
+    'sqlite3': ('django.db.backends.sqlite3', 'DELETE', {}),
+    'tuned': ('keeper.backends.sqlite3', 'WAL', {'LUNA_SQLITE_WRITER_QUEUE': False}),
+    'tuned+writer-queue': ('keeper.backends.sqlite3', 'WAL', {'LUNA_SQLITE_WRITER_QUEUE': True}),
+}
+
+#  run in a fresh interpreter per process, prints what keeper.benchmarks.contention.work returns
+WORKER = '''
+import json, sys
+import django
+django.setup()
+from keeper.benchmarks.contention import work
+print(json.dumps(work(*sys.argv[1:])))
+'''
+
+
+def run_contention(workers: int, seconds: float = CONTENTION_SECONDS) -> dict:
+    """Error rate and latency of gunicorn-like worker processes sharing one SQLite file in every profile.
+
+    `workers` processes send heartbeats of random ponies, CONTENTION_READERS processes read the overview
+    and the missing ponies, and a checker process lets a few ponies go overdue and sweeps them every
+    SWEEP_INTERVAL_SECONDS. Every request opens its own connection like with CONN_MAX_AGE = 0.
+    Every profile starts from its own copy of the same seeded database.
+    """
+    if connection.vendor != 'sqlite':
+        return {'skipped': f'needs sqlite, the database is {connection.vendor}'}
+    seed_ponies(CONTENTION_PONIES)
+    source = str(connection.settings_dict['NAME'])
+    results = {'workers': workers, 'readers': CONTENTION_READERS, 'seconds': seconds}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, (profile, (engine, journal_mode, overrides)) in enumerate(PROFILES.items()):
+            path = os.path.join(tmp_dir, f'contention_{i}.sqlite3')
+            copy_database(source, path, journal_mode)
+            database = {'ENGINE': engine, 'NAME': path, 'OPTIONS': connection.settings_dict['OPTIONS']}
+            module = write_settings(tmp_dir, 'luna.settings', module=f'contention_{i}', DATABASES={'default': database},
+                                    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', **overrides)
+            results[profile] = run_profile(module, tmp_dir, workers, seconds)
+    return results
+
+
+def copy_database(source: str, path: str, journal_mode: str):
+    source_db, target_db = sqlite3.connect(source), sqlite3.connect(path)
+    try:
+        source_db.backup(target_db)
+        target_db.execute(f'PRAGMA journal_mode = {journal_mode}')
+    finally:
+        source_db.close()
+        target_db.close()
+
+
+def run_profile(module: str, tmp_dir: str, workers: int, seconds: float) -> dict:
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=module,
+               PYTHONPATH=os.pathsep.join([tmp_dir, str(settings.BASE_DIR)]))
+    start_at = time.time() + START_DELAY_SECONDS
+    roles = ['hi'] * workers + ['read'] * CONTENTION_READERS + ['check']
+    processes = [(role, subprocess.Popen([sys.executable, '-c', WORKER, role, str(start_at), str(seconds), str(i)],
+                                         env=env, cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL, text=True))
+                 for i, role in enumerate(roles)]
+    outputs = {role: {'latencies': [], 'errors': 0} for role in set(roles)}
+    for role, process in processes:
+        stdout, _ = process.communicate()
+        if process.returncode:
+            raise RuntimeError(f'{role} process of {module} exited with {process.returncode}')
+        output = json.loads(stdout.strip().splitlines()[-1])
+        outputs[role]['latencies'].extend(output['latencies'])
+        outputs[role]['errors'] += output['errors']
+    result = {}
+    for role, name in (('hi', 'hi'), ('read', 'reads'), ('check', 'sweeps')):
+        latencies, errors = outputs[role]['latencies'], outputs[role]['errors']
+        result[name] = latency_summary(latencies, seconds, errors)
+        result[name]['error_rate'] = round(errors / (len(latencies) + errors), 4) if latencies or errors else 0
+    return result
+
+
+def work(role: str, start_at: str, seconds: str, seed: str) -> dict:
+    """Runs one role of run_contention in this process until the time is up, returns latencies of successful
+    requests in seconds and the number of failed ones"""
+    from ..ingress import hi_in_request
+    from ..models import Pony
+    from ..services import checker
+    from ..views import overview
+
+    names = [f'bench{i}' for i in range(CONTENTION_PONIES)]
+    rng = random.Random(int(seed))
+
+    def hi() -> bool:
+        response = hi_in_request(rng.choice(names), BENCHMARK_PASSCODE)
+        return response.status_code == 200 and b'"code": 0' in response.content
+
+    def read() -> bool:
+        overview()
+        list(Pony.objects.filter(status=Pony.STATUS_MISSING).values_list('name', flat=True)[:50])
+        return True
+
+    def check() -> bool:
+        current_time = now()
+        long_ago = current_time - datetime.timedelta(days=1)
+        Pony.objects.filter(name__in=rng.sample(names, SWEEP_OVERDUE)).update(deadline=long_ago)
+        checker.check_ponies(current_time=current_time)
+        return True
+
+    action = {'hi': hi, 'read': read, 'check': check}[role]
+    start_at, deadline = float(start_at), float(start_at) + float(seconds)
+    time.sleep(max(0.0, start_at - time.time()))
+    latencies, errors = [], 0
+    while time.time() < deadline:
+        start = time.perf_counter()
+        ok = False
+        if role != 'hi':
+            #  hi_in_request sends the request signals itself
+            request_started.send(sender=None)
+        try:
+            ok = action()
+        except DatabaseError:
+            pass
+        finally:
+            if role != 'hi':
+                request_finished.send(sender=None)
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+        if role == 'check':
+            time.sleep(SWEEP_INTERVAL_SECONDS)
+    return {'latencies': latencies, 'errors': errors}
@@ -0,0 +1,80 @@
+import time
+import typing
+
+from django.test import override_settings
+
+from . import servers
+from ..consts import NOTIFY_CHANNEL_EMAIL, NOTIFY_CHANNEL_SLACK
+from ..models import Outbox
+from ..services import notification, dispatcher
+from ..utils import http_pool
+
+
+def fanout_messages(count: int, slack_url: str) -> typing.List[typing.Tuple[str, str, str, str]]:
+    """Alternating email and Slack messages, each to its own destination so nothing is digested"""
+    messages = []
+    for i in range(count):
+        if i % 2:
+            messages.append((f'Your pony bench{i} was missing', 'benchmark', NOTIFY_CHANNEL_SLACK,
+                             f'{slack_url}/hooks/bench{i}'))
+        else:
+            messages.append((f'Your pony bench{i} was missing', 'benchmark', NOTIFY_CHANNEL_EMAIL,
+                             f'bench{i}@equestria.org'))
+    return messages
+
+
+def run_direct(messages: typing.List[tuple]) -> dict:
+    """Sends the messages the way the checker does without an outbox, emails first over one SMTP connection"""
+    results = {}
+    for channel in (NOTIFY_CHANNEL_EMAIL, NOTIFY_CHANNEL_SLACK):
+        channel_messages = [message for message in messages if message[2] == channel]
+        servers.reset_counts()
+        connections_opened = http_pool.connections_opened
+        start = time.perf_counter()
+        sent = notification.send_messages(channel_messages)
+        elapsed = time.perf_counter() - start
+        results[channel] = dict(throughput_summary(len(channel_messages), sent.count(False), elapsed),
+                                http_connections=http_pool.connections_opened - connections_opened,
+                                **servers.counts())
+    return results
+
+
+def run_outbox(messages: typing.List[tuple]) -> dict:
+    """Queues the messages in the outbox and drains it with the dispatcher's thread pools"""
+    Outbox.objects.all().delete()
+    Outbox.objects.bulk_create([notification.new_outbox_message(*message) for message in messages], batch_size=500)
+    servers.reset_counts()
+    connections_opened = http_pool.connections_opened
+    runner = dispatcher.Dispatcher()
+    start = time.perf_counter()
+    try:
+        runner.dispatch_all()
+    finally:
+        runner.stop()
+    elapsed = time.perf_counter() - start
+    failed = Outbox.objects.exclude(status=Outbox.STATUS_SENT).count()
+    return dict(throughput_summary(len(messages), failed, elapsed), concurrency=runner.concurrency,
+                http_connections=http_pool.connections_opened - connections_opened, **servers.counts())
+
+
+def throughput_summary(messages: int, failed: int, elapsed: float) -> dict:
+    return {
+        'messages': messages,
+        'failed': failed,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_mps': round(messages / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def run_fanout(count: int, delay: float = 0.0) -> dict:
+    """Notification fan-out against local stand-in SMTP and Slack servers answering after `delay` seconds"""
+    with servers.stand_in_servers(delay) as (smtp_port, slack_url):
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST='127.0.0.1', EMAIL_PORT=smtp_port, EMAIL_HOST_USER='',
+                               EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False, EMAIL_USE_SSL=False,
+                               LUNA_DIGEST_THRESHOLD=0):
+            messages = fanout_messages(count, slack_url)
+            results = {'messages': count, 'server_delay_ms': round(delay * 1000, 3),
+                       'direct': run_direct(messages), 'outbox': run_outbox(messages)}
+    http_pool.close()
+    return results
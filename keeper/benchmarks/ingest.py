@@ -0,0 +1,147 @@
+import asyncio
+import itertools
+import random
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.core.asgi import get_asgi_application
+from django.core.wsgi import get_wsgi_application
+from django.db import close_old_connections
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from . import BENCHMARK_PASSCODE, latency_summary, clear_pony_cache
+from ..ingress import HeartbeatIngress, AsgiHeartbeatIngress
+from ..services import heartbeat
+
+HOST = 'testserver'
+
+
+def hi_query_strings(names: typing.List[str], requests: int) -> typing.List[str]:
+    return [urlencode({'name': name, 'passcode': BENCHMARK_PASSCODE})
+            for name in itertools.islice(itertools.cycle(names), requests)]
+
+
+def sampled_query_strings(names: typing.List[str], requests: int, seed: int = 0) -> typing.List[str]:
+    """Heartbeats of randomly picked ponies, the same ones for the same seed"""
+    return [urlencode({'name': name, 'passcode': BENCHMARK_PASSCODE})
+            for name in random.Random(seed).choices(names, k=requests)]
+
+
+def run_wsgi(path: str, query_strings: typing.List[str], concurrency: int, application=None) -> dict:
+    """Sends the requests through the WSGI application from a pool of threads, like a threaded WSGI server"""
+    if application is None:
+        application = get_wsgi_application()
+    factory = RequestFactory()
+
+    def send(query_string: str) -> typing.Tuple[float, bool]:
+        environ = factory.get(path + '?' + query_string).environ
+        statuses = []
+        start = time.perf_counter()
+        response = application(environ, lambda status, headers: statuses.append(status))
+        body = b''.join(response)
+        if hasattr(response, 'close'):
+            response.close()
+        return time.perf_counter() - start, statuses[0].startswith('200') and b'"code": 0' in body
+
+    def send_all(chunk: typing.List[str]):
+        try:
+            return [send(query_string) for query_string in chunk]
+        finally:
+            close_old_connections()
+
+    chunks = [query_strings[i::concurrency] for i in range(concurrency)]
+    start, cpu_start = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [result for chunk_results in executor.map(send_all, chunks) for result in chunk_results]
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    return dict(latency_summary([latency for latency, _ in results], elapsed, sum(1 for _, ok in results if not ok)),
+                cpu_us_per_request=round(cpu / len(results) * 1e6, 1))
+
+
+def run_asgi(path: str, query_strings: typing.List[str], concurrency: int, application=None) -> dict:
+    """Sends the requests through the ASGI application on one event loop with `concurrency` requests in flight"""
+    if application is None:
+        application = get_asgi_application()
+
+    async def send(query_string: str, semaphore: asyncio.Semaphore) -> typing.Tuple[float, bool]:
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'query_string': query_string.encode(), 'headers': [(b'host', HOST.encode())],
+            'server': (HOST, 80), 'client': ('127.0.0.1', 10000),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def collect(message):
+            messages.append(message)
+
+        async with semaphore:
+            start = time.perf_counter()
+            await application(scope, receive, collect)
+            latency = time.perf_counter() - start
+        body = b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+        return latency, messages[0].get('status') == 200 and b'"code": 0' in body
+
+    async def send_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*[send(query_string, semaphore) for query_string in query_strings])
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    results = asyncio.run(send_all())
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    return dict(latency_summary([latency for latency, _ in results], elapsed, sum(1 for _, ok in results if not ok)),
+                cpu_us_per_request=round(cpu / len(results) * 1e6, 1))
+
+
+def run_hi(names: typing.List[str], requests: int, concurrency: int) -> dict:
+    """Throughput and latency of /pony/hi under WSGI with heartbeats spread over all ponies"""
+    clear_pony_cache()
+    try:
+        return run_wsgi(reverse('hi_pony'), sampled_query_strings(names, requests), concurrency)
+    finally:
+        heartbeat.flush_buffer()
+
+
+def compare_wsgi_asgi(names: typing.List[str], requests: int, concurrency: int) -> dict:
+    """hi_pony under WSGI and under ASGI"""
+    query_strings = hi_query_strings(names, requests)
+    runs = {
+        'wsgi_sync_view': lambda: run_wsgi(reverse('hi_pony'), query_strings, concurrency),
+        'asgi_sync_view': lambda: run_asgi(reverse('hi_pony'), query_strings, concurrency),
+    }
+    results = {}
+    for name, run in runs.items():
+        #  every run starts cold
+        clear_pony_cache()
+        results[name] = run()
+        heartbeat.flush_buffer()
+    return results
+
+
+def compare_ingress(names: typing.List[str], requests: int, concurrency: int) -> dict:
+    """/pony/hi through Django's routing and middleware against the heartbeat ingress in front of it, with every
+    heartbeat written to the database and with the heartbeat buffer, where the framework's share is largest"""
+    query_strings = hi_query_strings(names, requests)
+    path = reverse('hi_pony')
+    runs = {
+        'wsgi_django': lambda: run_wsgi(path, query_strings, concurrency),
+        'wsgi_ingress': lambda: run_wsgi(path, query_strings, concurrency, HeartbeatIngress(get_wsgi_application())),
+        'asgi_django': lambda: run_asgi(path, query_strings, concurrency),
+        'asgi_ingress': lambda: run_asgi(path, query_strings, concurrency,
+                                         AsgiHeartbeatIngress(get_asgi_application())),
+    }
+    results = {}
+    for mode, buffered in (('direct', False), ('buffered', True)):
+        results[mode] = {}
+        with override_settings(LUNA_HEARTBEAT_BUFFER=buffered):
+            for name, run in runs.items():
+                clear_pony_cache()
+                results[mode][name] = run()
+                heartbeat.flush_buffer()
+    return results
@@ -0,0 +1,93 @@
+import contextlib
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+
+
+class StandInSlackHandler(BaseHTTPRequestHandler):
+    """Answers every webhook POST with "ok" like Slack does, after `delay` seconds"""
+    protocol_version = 'HTTP/1.1'
+    #  headers and body are written separately, don't let Nagle hold the body back for the delayed ACK
+    disable_nagle_algorithm = True
+    delay = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        if StandInSlackHandler.delay:
+            time.sleep(StandInSlackHandler.delay)
+        with StandInSlackHandler.lock:
+            StandInSlackHandler.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInSmtpHandler(StreamRequestHandler):
+    """Accepts every message, waits `delay` seconds before acknowledging one"""
+    delay = 0.0
+    sessions = 0
+    messages = 0
+    lock = threading.Lock()
+
+    def handle(self):
+        with StandInSmtpHandler.lock:
+            StandInSmtpHandler.sessions += 1
+        self.wfile.write(b'220 luna stand-in smtp\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command == 'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                if StandInSmtpHandler.delay:
+                    time.sleep(StandInSmtpHandler.delay)
+                with StandInSmtpHandler.lock:
+                    StandInSmtpHandler.messages += 1
+                self.wfile.write(b'250 ok\r\n')
+            elif command == 'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
+def reset_counts():
+    StandInSlackHandler.requests = 0
+    StandInSmtpHandler.sessions = 0
+    StandInSmtpHandler.messages = 0
+
+
+def counts() -> typing.Dict[str, int]:
+    return {'slack_requests': StandInSlackHandler.requests, 'smtp_sessions': StandInSmtpHandler.sessions,
+            'smtp_messages': StandInSmtpHandler.messages}
+
+
+@contextlib.contextmanager
+def stand_in_servers(delay: float = 0.0) -> typing.Iterator[typing.Tuple[int, str]]:
+    """Runs local SMTP and Slack webhook servers answering after `delay` seconds, yields the SMTP port and
+    the webhook base url"""
+    StandInSlackHandler.delay = StandInSmtpHandler.delay = delay
+    reset_counts()
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), StandInSlackHandler)
+    http_server.daemon_threads = True
+    smtp_server = ThreadingTCPServer(('127.0.0.1', 0), StandInSmtpHandler)
+    smtp_server.daemon_threads = True
+    for server in (http_server, smtp_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield smtp_server.server_address[1], f'http://127.0.0.1:{http_server.server_address[1]}'
+    finally:
+        for server in (http_server, smtp_server):
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,94 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+from django.conf import settings
+from django.db import connection
+
+from . import seed_ponies
+
+STARTUP_RUNS = 10
+STARTUP_PONIES = 1000
+
+#  entry point -> settings profile and command line of a cron-launched dry-run sweep
+ENTRY_POINTS = {
+    'manage.py checkpony': ('luna.settings', [sys.executable, 'manage.py', 'checkpony', '--dry-run']),
+    'luna.checker': ('luna.settings_minimal', [sys.executable, '-m', 'luna.checker', '--dry-run']),
+}
+
+#  run in a fresh interpreter, prints the milliseconds spent in imports and django.setup(), then in the first query
+PHASES = '''
+import json, os, sys, time
+start = time.perf_counter()
+if os.environ['LUNA_STARTUP_PROFILE'] == 'luna.checker':
+    from luna.checker import setup
+    setup()
+else:
+    import django
+    django.setup()
+setup_time = time.perf_counter()
+from keeper.models import Pony
+Pony.objects.filter(status=Pony.STATUS_NORMAL).exists()
+query_time = time.perf_counter()
+print(json.dumps({'import_ms': (setup_time - start) * 1000, 'first_query_ms': (query_time - setup_time) * 1000}))
+'''
+
+
+def run_startup(runs: int = STARTUP_RUNS) -> dict:
+    """Cold-start time of each checker entry point in fresh interpreters, against the benchmark database.
+
+    Each entry point runs with a settings module that imports its profile and only points the database elsewhere.
+    """
+    seed_ponies(STARTUP_PONIES)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = {'runs': runs, 'python_ms': summary(time_runs([sys.executable, '-c', 'pass'], runs, {}))}
+        for entry_point, (profile, command) in ENTRY_POINTS.items():
+            module = write_settings(tmp_dir, profile)
+            env = {'DJANGO_SETTINGS_MODULE': module, 'LUNA_STARTUP_PROFILE': entry_point,
+                   'PYTHONPATH': os.pathsep.join([tmp_dir, str(settings.BASE_DIR)])}
+            phases = [json.loads(run([sys.executable, '-c', PHASES], env).strip().splitlines()[-1])
+                      for _ in range(runs)]
+            results[entry_point] = {
+                'wall_ms': summary(time_runs(command, runs, env)),
+                'import_ms': summary([phase['import_ms'] for phase in phases]),
+                'first_query_ms': summary([phase['first_query_ms'] for phase in phases]),
+            }
+    baseline, fast = (results[entry_point]['wall_ms']['median'] for entry_point in ENTRY_POINTS)
+    results['wall_reduction'] = round(1 - fast / baseline, 3)
+    return results
+
+
+def write_settings(tmp_dir: str, profile: str, module: str = None, **overrides) -> str:
+    """Writes a settings module importing the profile, pointing the database to the benchmark database unless
+    DATABASES is overridden, returns its name"""
+    module = module or 'startup_' + profile.replace('.', '_')
+    overrides.setdefault('DATABASES', {'default': {'ENGINE': connection.settings_dict['ENGINE'],
+                                                   'NAME': str(connection.settings_dict['NAME'])}})
+    with open(os.path.join(tmp_dir, module + '.py'), 'w') as f:
+        f.write(f'from {profile} import *\n')
+        for name, value in overrides.items():
+            f.write(f'{name} = {value!r}\n')
+    return module
+
+
+def run(command: typing.List[str], env: dict) -> str:
+    return subprocess.run(command, env=dict(os.environ, **env), cwd=settings.BASE_DIR, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+
+
+def time_runs(command: typing.List[str], runs: int, env: dict) -> typing.List[float]:
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(command, env)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def summary(milliseconds: typing.List[float]) -> dict:
+    return {'median': round(statistics.median(milliseconds), 1), 'min': round(min(milliseconds), 1)}
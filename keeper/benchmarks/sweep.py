@@ -0,0 +1,77 @@
+import datetime
+import time
+import tracemalloc
+import typing
+
+import django.core.mail as mail
+from django.utils.timezone import now
+
+from . import clear_pony_cache
+from ..models import Pony, History, Availability
+from ..services import checker, heartbeat, counters
+
+try:
+    import resource
+except ImportError:  #  not available on Windows
+    resource = None
+
+MISSING_RATIOS = [0.0, 0.01, 0.1, 0.5]
+
+
+def prepare_sweep(missing_ratio: float, current_time: datetime.datetime) -> int:
+    """Turns all ponies normal again with the first missing_ratio of them overdue, returns how many are overdue"""
+    History.objects.all().delete()
+    Availability.objects.all().delete()
+    if hasattr(mail, 'outbox'):
+        mail.outbox.clear()
+    clear_pony_cache()
+    Pony.objects.update(status=Pony.STATUS_NORMAL, last_hi_time=current_time, rollup_time=current_time,
+                        deadline=heartbeat.deadline_expression(current_time), expected_deadline=None)
+    overdue = round(Pony.objects.count() * missing_ratio)
+    if overdue:
+        last_id = Pony.objects.order_by('id').values_list('id', flat=True)[overdue - 1]
+        long_ago = current_time - datetime.timedelta(days=1)
+        Pony.objects.filter(id__lte=last_id).update(last_hi_time=long_ago, rollup_time=long_ago,
+                                                    deadline=heartbeat.deadline_expression(long_ago))
+    counters.reconcile()
+    return overdue
+
+
+def run_sweeps(missing_ratios: typing.List[float]) -> typing.List[dict]:
+    """Wall time and memory of one checkpony sweep per missing ratio.
+
+    Every ratio is swept twice from the same state, memory is traced in the second sweep only
+    so tracemalloc does not slow down the timed one. Notifications go to the test environment's memory backend.
+    """
+    results = []
+    for missing_ratio in missing_ratios:
+        current_time = now()
+        overdue = prepare_sweep(missing_ratio, current_time)
+        start = time.perf_counter()
+        missing = checker.check_ponies(current_time=current_time)
+        elapsed = time.perf_counter() - start
+
+        prepare_sweep(missing_ratio, current_time)
+        tracemalloc.start()
+        try:
+            checker.check_ponies(current_time=current_time)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        results.append({
+            'missing_ratio': missing_ratio,
+            'overdue': overdue,
+            'missing': len(missing),
+            'wall_s': round(elapsed, 3),
+            'ponies_per_s': round(len(missing) / elapsed, 1) if missing and elapsed > 0 else None,
+            'peak_python_mb': round(peak / 2 ** 20, 3),
+            'max_rss_mb': max_rss_mb(),
+        })
+    return results
+
+
+def max_rss_mb() -> typing.Optional[float]:
+    """Peak resident memory of the whole process so far"""
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
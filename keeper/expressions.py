@@ -0,0 +1,21 @@
+from django.db.models import Func, DurationField
+
+
+class Minutes(Func):
+    """Turns an integer expression of minutes into a duration, e.g. Minutes(F('dark_minute'))"""
+    arity = 1
+    output_field = DurationField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template='make_interval(mins => %(expressions)s)', **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        #  sqlite and mysql keep durations as integer microseconds
+        return super().as_sql(compiler, connection, template='(%(expressions)s * 60000000)', **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sqlite(compiler, connection, **extra_context)
+
+    def as_oracle(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template="NUMTODSINTERVAL(%(expressions)s, 'MINUTE')",
+                              **extra_context)
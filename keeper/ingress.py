@@ -0,0 +1,188 @@
+import logging
+import typing
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import DisallowedHost, ValidationError
+from django.core.handlers.wsgi import get_bytes_from_wsgi, get_script_name
+from django.core.signals import request_started, request_finished
+from django.http import HttpRequest, HttpResponse, HttpResponseServerError, QueryDict
+from django.middleware.security import SecurityMiddleware
+from django.urls import reverse
+
+from . import views
+from .middleware import MetricsMiddleware
+
+SECURITY_MIDDLEWARE = 'django.middleware.security.SecurityMiddleware'
+
+
+def ingress_enabled() -> bool:
+    return getattr(settings, 'LUNA_HEARTBEAT_INGRESS', False)
+
+
+class IngressRequest(HttpRequest):
+    """Just the META, scheme and path of a request, enough for Django's host and HTTPS checks"""
+
+    def __init__(self, meta: dict, scheme: str, path: str):
+        super().__init__()
+        self.META = meta
+        self.url_scheme = scheme
+        self.path = self.path_info = path
+
+    def _get_scheme(self):
+        return self.url_scheme
+
+
+def security_middleware() -> typing.Optional[SecurityMiddleware]:
+    if SECURITY_MIDDLEWARE not in settings.MIDDLEWARE:
+        return None
+    return SecurityMiddleware(lambda request: None)
+
+
+def passes_checks(request: IngressRequest, security: typing.Optional[SecurityMiddleware]) -> bool:
+    """Whether Django would let the request reach the view, instead of e.g. rejecting its host or redirecting
+    it to HTTPS. Django answers the others itself."""
+    try:
+        #  validates the host against ALLOWED_HOSTS
+        request.get_host()
+    except DisallowedHost:
+        return False
+    return security is None or security.process_request(request) is None
+
+
+def hi_response(query_params: QueryDict) -> HttpResponse:
+    try:
+        name, passcode = views.clean_credentials(query_params)
+    except ValidationError as e:
+        return views.error_response(e.messages[0])
+    return hi_in_request(name, passcode)
+
+
+def hi_in_request(name: str, passcode: str, pony=None) -> HttpResponse:
+    """hi_pony_by_credentials between Django's request signals, which e.g. close stale database connections"""
+    request_started.send(sender=HeartbeatIngress)
+    try:
+        return views.hi_pony_by_credentials(name, passcode, pony)
+    finally:
+        request_finished.send(sender=HeartbeatIngress)
+
+
+def finish(request: IngressRequest, response: HttpResponse,
+           security: typing.Optional[SecurityMiddleware]) -> HttpResponse:
+    #  what CommonMiddleware and SecurityMiddleware would add
+    response['Content-Length'] = str(len(response.content))
+    if security is not None:
+        security.process_response(request, response)
+    return response
+
+
+class HeartbeatIngress:
+    """WSGI application answering heartbeats to /pony/hi itself, everything else goes on to `application`.
+
+    A heartbeat is authenticated and recorded like hi_pony does and gets the same response, but skips URL routing
+    and the middleware, none of which a passcode-authenticated ping needs. Only the host validation and the HTTPS
+    redirect and headers of SecurityMiddleware are kept, a request failing them goes on to Django.
+    """
+
+    def __init__(self, application, path: str = None):
+        self.application = application
+        self.path = path if path is not None else reverse('hi_pony')
+        self.security = security_middleware()
+
+    def __call__(self, environ, start_response):
+        request = self.checked_request(environ)
+        query_params = self.query_params(environ) if request is not None else None
+        if query_params is None:
+            return self.application(environ, start_response)
+        queries, token, start = MetricsMiddleware.start()
+        try:
+            response = hi_response(query_params)
+        except Exception as e:
+            logging.error("failed to record heartbeat", exc_info=e)
+            response = HttpResponseServerError()
+        finally:
+            MetricsMiddleware.finish(token)
+        MetricsMiddleware.record_view('hi_pony', queries, start)
+        finish(request, response, self.security)
+        start_response(f'{response.status_code} {response.reason_phrase}', list(response.items()))
+        return [response.content]
+
+    def checked_request(self, environ) -> typing.Optional[IngressRequest]:
+        """The request to the ingress' path if it passes Django's checks, None otherwise"""
+        path_info = environ.get('PATH_INFO')
+        if path_info != self.path:
+            return None
+        path = '%s/%s' % (get_script_name(environ).rstrip('/'), path_info.replace('/', '', 1))
+        request = IngressRequest(environ, environ.get('wsgi.url_scheme', 'http'), path)
+        return request if passes_checks(request, self.security) else None
+
+    @staticmethod
+    def query_params(environ) -> typing.Optional[QueryDict]:
+        """The params of a heartbeat, None if the request is not one for the ingress.
+
+        Only GET, a POST goes through Django's CsrfViewMiddleware like any other.
+        """
+        if environ.get('REQUEST_METHOD') != 'GET':
+            return None
+        return QueryDict(get_bytes_from_wsgi(environ, 'QUERY_STRING', ''))
+
+
+class AsgiHeartbeatIngress:
+    """HeartbeatIngress for the ASGI application, records the heartbeat in a thread like Django runs hi_pony"""
+
+    def __init__(self, application, path: str = None):
+        self.application = application
+        self.path = path if path is not None else reverse('hi_pony')
+        self.security = security_middleware()
+
+    async def __call__(self, scope, receive, send):
+        request = self.checked_request(scope)
+        query_params = self.query_params(scope) if request is not None else None
+        if query_params is None:
+            return await self.application(scope, receive, send)
+        queries, token, start = MetricsMiddleware.start()
+        try:
+            response = await self.hi_response(query_params)
+        except Exception as e:
+            logging.error("failed to record heartbeat", exc_info=e)
+            response = HttpResponseServerError()
+        finally:
+            MetricsMiddleware.finish(token)
+        MetricsMiddleware.record_view('hi_pony', queries, start)
+        finish(request, response, self.security)
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(key.encode('latin-1'), value.encode('latin-1')) for key, value in response.items()]})
+        await send({'type': 'http.response.body', 'body': response.content})
+
+    @staticmethod
+    async def hi_response(query_params: QueryDict) -> HttpResponse:
+        try:
+            name, passcode = views.clean_credentials(query_params)
+        except ValidationError as e:
+            return views.error_response(e.messages[0])
+        return await sync_to_async(hi_in_request)(name, passcode)
+
+    def checked_request(self, scope) -> typing.Optional[IngressRequest]:
+        """The request to the ingress' path if it passes Django's checks, None otherwise"""
+        if scope['type'] != 'http':
+            return None
+        path, root_path = scope['path'], scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        if path != self.path:
+            return None
+        #  the part of the META ASGIRequest builds which the checks read
+        server = scope.get('server') or ('unknown', '0')
+        meta = {'SERVER_NAME': server[0], 'SERVER_PORT': str(server[1])}
+        for key, value in scope.get('headers', []):
+            name = 'HTTP_' + key.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            meta[name] = meta[name] + ',' + value if name in meta else value
+        request = IngressRequest(meta, scope.get('scheme') or 'http', scope['path'])
+        return request if passes_checks(request, self.security) else None
+
+    @staticmethod
+    def query_params(scope) -> typing.Optional[QueryDict]:
+        if scope['method'] != 'GET':
+            return None
+        return QueryDict(scope.get('query_string', b''))
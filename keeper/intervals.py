@@ -0,0 +1,95 @@
+import math
+import struct
+import sys
+import typing
+from array import array
+
+RING_SIZE = 32
+#  next slot, number of filled slots, running sum and sum of squares of the filled slots
+HEADER = struct.Struct('<HHdd')
+PACKED_SIZE = HEADER.size + RING_SIZE * 4
+
+#  weight of a new interval in the moving average and variance of the cadence
+EWMA_ALPHA = 0.125
+#  the adaptive checker waits for enough intervals, then for a few missed beats or a few deviations more
+ADAPTIVE_MIN_SAMPLES = 8
+ADAPTIVE_MISSED_BEATS = 3
+ADAPTIVE_DEVIATIONS = 4
+
+
+class IntervalRing:
+    """Fixed-size ring buffer of the latest inter-arrival times of a pony's heartbeats, in seconds.
+
+    Packed as HEADER followed by RING_SIZE little-endian float32 slots, so every pony takes PACKED_SIZE bytes
+    no matter how often it says hi. Mean and variance come from the running sums, p95 from the slots.
+    """
+
+    def __init__(self, data: typing.Optional[bytes] = None):
+        self.values = array('f', bytes(RING_SIZE * 4))
+        self.position = 0
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        if data:
+            self.position, self.count, self.total, self.total_squares = HEADER.unpack_from(data)
+            self.values = array('f', bytes(data[HEADER.size:PACKED_SIZE]))
+            if sys.byteorder == 'big':
+                self.values.byteswap()
+
+    def add(self, seconds: float):
+        #  keep the running sums in step with what fits into a float32 slot
+        seconds = array('f', [seconds])[0]
+        if self.count == RING_SIZE:
+            evicted = self.values[self.position]
+            self.total -= evicted
+            self.total_squares -= evicted * evicted
+        else:
+            self.count += 1
+        self.values[self.position] = seconds
+        self.total += seconds
+        self.total_squares += seconds * seconds
+        self.position = (self.position + 1) % RING_SIZE
+
+    def to_bytes(self) -> bytes:
+        values = array('f', self.values)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return HEADER.pack(self.position, self.count, self.total, self.total_squares) + values.tobytes()
+
+    def mean(self) -> typing.Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def variance(self) -> typing.Optional[float]:
+        if not self.count:
+            return None
+        mean = self.total / self.count
+        return max(self.total_squares / self.count - mean * mean, 0.0)
+
+    def percentile(self, percent: float) -> typing.Optional[float]:
+        if not self.count:
+            return None
+        values = sorted(self.values[:self.count])
+        rank = -(-percent * self.count // 100)
+        return values[max(int(rank), 1) - 1]
+
+    def summary(self) -> dict:
+        return {'count': self.count, 'mean': self.mean(), 'variance': self.variance(), 'p95': self.percentile(95)}
+
+
+def update_ewma(mean: typing.Optional[float], variance: typing.Optional[float],
+                seconds: float) -> typing.Tuple[float, float]:
+    """Exponentially weighted moving average and variance after one more interval"""
+    if mean is None:
+        return seconds, 0.0
+    difference = seconds - mean
+    mean += EWMA_ALPHA * difference
+    variance = (1 - EWMA_ALPHA) * ((variance or 0.0) + EWMA_ALPHA * difference * difference)
+    return mean, variance
+
+
+def expected_gap(mean: typing.Optional[float], variance: typing.Optional[float],
+                 samples: int) -> typing.Optional[float]:
+    """Seconds after a heartbeat until the next one is overdue, None while the cadence is not known well enough"""
+    if mean is None or samples < ADAPTIVE_MIN_SAMPLES:
+        return None
+    return max(ADAPTIVE_MISSED_BEATS * mean, mean + ADAPTIVE_DEVIATIONS * math.sqrt(variance or 0.0))
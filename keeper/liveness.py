@@ -0,0 +1,138 @@
+import contextlib
+import mmap
+import os
+import struct
+import threading
+import typing
+
+try:
+    import fcntl
+except ImportError:  #  not available on Windows
+    fcntl = None
+
+#  heartbeats kept per pony between two reconciliations, older ones only count for last_hi_time
+PENDING_SIZE = 8
+#  pony id, latest heartbeat and latest heartbeat in the database in microseconds since the epoch,
+#  number of heartbeats since the last reconciliation, flags, then the last PENDING_SIZE of those heartbeats
+RECORD = struct.Struct(f'<qqqII{PENDING_SIZE}q')
+ID, LAST, RECONCILED, PENDING, FLAGS, TIMES = range(6)
+#  the first bytes are locked while the file grows, records start after them
+HEADER_SIZE = 64
+GROW_RECORDS = 4096
+LOCK_STRIPES = 64
+FLAG_NOT_NORMAL = 1
+
+
+class LivenessFile:
+    """Memory-mapped file of fixed-size heartbeat records shared by the processes of a host.
+
+    The record of a pony sits at a position given by its id. A record is only changed under a POSIX lock
+    of its own bytes, plus a striped thread lock as POSIX locks don't exclude threads of the same process,
+    so updates of different ponies never wait for each other.
+    """
+
+    def __init__(self, path: str):
+        if fcntl is None:
+            raise OSError('a liveness file needs fcntl record locks')
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.map_lock = threading.Lock()
+        self.stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.map: typing.Optional[mmap.mmap] = None
+        self.remap(HEADER_SIZE + GROW_RECORDS * RECORD.size)
+
+    def remap(self, needed: int) -> mmap.mmap:
+        """Grows the file to at least `needed` bytes if necessary and maps all of it"""
+        with self.map_lock:
+            size = os.fstat(self.fd).st_size
+            if size < needed:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+                try:
+                    #  never shrink what another process has grown meanwhile
+                    size = os.fstat(self.fd).st_size
+                    if size < needed:
+                        size = needed + GROW_RECORDS * RECORD.size
+                        os.ftruncate(self.fd, size)
+                finally:
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+            if self.map is None or len(self.map) != size:
+                #  the previous map stays valid for whoever still uses it and is closed when it is collected
+                self.map = mmap.mmap(self.fd, size)
+            return self.map
+
+    @contextlib.contextmanager
+    def locked(self, pony_id: int) -> typing.Iterator[typing.Tuple[mmap.mmap, int, list]]:
+        """Locks the pony's record and yields the map, its offset and its values, write changes back with pack_into"""
+        offset = HEADER_SIZE + (pony_id - 1) * RECORD.size
+        mapped = self.map
+        if len(mapped) < offset + RECORD.size:
+            mapped = self.remap(offset + RECORD.size)
+        with self.stripes[pony_id % LOCK_STRIPES]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, RECORD.size, offset)
+            try:
+                record = list(RECORD.unpack_from(mapped, offset))
+                if record[ID] != pony_id:
+                    record = [pony_id, 0, 0, 0, 0] + [0] * PENDING_SIZE
+                yield mapped, offset, record
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, RECORD.size, offset)
+
+    def add(self, pony_id: int, microseconds: int) -> bool:
+        """Records a heartbeat, returns False without recording it if the pony is known to be no longer normal"""
+        with self.locked(pony_id) as (mapped, offset, record):
+            if record[FLAGS] & FLAG_NOT_NORMAL:
+                return False
+            record[TIMES + record[PENDING] % PENDING_SIZE] = microseconds
+            record[PENDING] += 1
+            record[LAST] = max(record[LAST], microseconds)
+            RECORD.pack_into(mapped, offset, *record)
+        return True
+
+    def take(self, pony_id: int) -> typing.Optional[typing.Tuple[int, typing.List[int]]]:
+        """Takes the latest heartbeat and the pending ones in order if the database is behind, None otherwise.
+
+        The record stays behind until reconciled() confirms that the latest heartbeat was written.
+        """
+        with self.locked(pony_id) as (mapped, offset, record):
+            if record[LAST] <= record[RECONCILED]:
+                return None
+            pending = record[PENDING]
+            times = sorted(record[TIMES + i % PENDING_SIZE] for i in range(max(pending - PENDING_SIZE, 0), pending))
+            record[PENDING] = 0
+            RECORD.pack_into(mapped, offset, *record)
+        return record[LAST], times
+
+    def reconciled(self, pony_id: int, microseconds: int):
+        with self.locked(pony_id) as (mapped, offset, record):
+            record[RECONCILED] = max(record[RECONCILED], microseconds)
+            RECORD.pack_into(mapped, offset, *record)
+
+    def reset(self, pony_id: int, microseconds: int):
+        """The pony is normal since a heartbeat at `microseconds` that was written to the database directly"""
+        with self.locked(pony_id) as (mapped, offset, record):
+            record[LAST] = max(record[LAST], microseconds)
+            record[RECONCILED] = max(record[RECONCILED], microseconds)
+            record[PENDING] = 0
+            record[FLAGS] &= ~FLAG_NOT_NORMAL
+            RECORD.pack_into(mapped, offset, *record)
+
+    def forget(self, pony_id: int):
+        """The pony is no longer normal, its heartbeats go to the database directly until reset()"""
+        with self.locked(pony_id) as (mapped, offset, record):
+            record[RECONCILED] = record[LAST]
+            record[PENDING] = 0
+            record[FLAGS] |= FLAG_NOT_NORMAL
+            RECORD.pack_into(mapped, offset, *record)
+
+    def behind(self) -> typing.List[int]:
+        """Ids of all ponies with heartbeats the database hasn't seen yet, read without locks"""
+        mapped = self.remap(0)
+        count = (len(mapped) - HEADER_SIZE) // RECORD.size
+        with memoryview(mapped)[HEADER_SIZE:HEADER_SIZE + count * RECORD.size] as view:
+            return [record[ID] for record in RECORD.iter_unpack(view)
+                    if record[ID] and record[LAST] > record[RECONCILED]]
+
+    def close(self):
+        with self.map_lock:
+            self.map = None
+        os.close(self.fd)
@@ -0,0 +1,93 @@
+import json
+import platform
+import time
+
+import django
+from django.core.management import BaseCommand, CommandError, CommandParser
+from django.db import connection
+
+from ...benchmarks import benchmark_environment, seed_ponies, ingest, sweep, fanout, startup, contention
+
+#  scenarios run once per --ponies size, the others do not depend on the number of ponies and run once
+SCALED_SCENARIOS = ['hi', 'hi-asgi', 'hi-ingress', 'check']
+SCENARIOS = SCALED_SCENARIOS + ['notify', 'startup', 'sqlite-concurrency']
+
+
+class Command(BaseCommand):
+    help = "Run benchmarks against a throwaway test database and print the results as JSON"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('scenarios', nargs='*', default=SCENARIOS,
+                            help=f'scenarios to run, all by default: {", ".join(SCENARIOS)}')
+        parser.add_argument('--ponies', type=int, nargs='+', default=[1000],
+                            help='numbers of ponies to seed, e.g. 10000 100000 1000000, each one gets a fresh database')
+        parser.add_argument('--requests', type=int, default=5000, help='number of requests for ingest scenarios')
+        parser.add_argument('--concurrency', type=int, default=50, help='requests in flight for ingest scenarios')
+        parser.add_argument('--missing-ratios', type=float, nargs='+', default=sweep.MISSING_RATIOS,
+                            help='shares of overdue ponies for the check scenario')
+        parser.add_argument('--notifications', type=int, default=1000,
+                            help='number of notifications for the notify scenario')
+        parser.add_argument('--server-delay', type=float, default=0,
+                            help='milliseconds the stand-in SMTP and Slack servers wait before answering')
+        parser.add_argument('--startup-runs', type=int, default=startup.STARTUP_RUNS,
+                            help='cold starts of each checker entry point for the startup scenario')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='heartbeat processes of the sqlite-concurrency scenario')
+        parser.add_argument('--contention-seconds', type=float, default=contention.CONTENTION_SECONDS,
+                            help='seconds each profile of the sqlite-concurrency scenario runs')
+        parser.add_argument('--output', help='also write the results to this file')
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenarios']) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'unknown scenarios: {", ".join(sorted(unknown))}')
+        if min(options['ponies']) <= 0 or options['requests'] <= 0 or options['concurrency'] <= 0 \
+                or options['notifications'] <= 0 or options['startup_runs'] <= 0 or options['workers'] <= 0 \
+                or options['contention_seconds'] <= 0:
+            raise CommandError('ponies, requests, concurrency, notifications, startup runs, workers and '
+                               'contention seconds must be positive')
+        if any(not 0 <= ratio <= 1 for ratio in options['missing_ratios']):
+            raise CommandError('missing ratios must be between 0 and 1')
+
+        results = {
+            'options': {key: options[key] for key in ('scenarios', 'ponies', 'requests', 'concurrency',
+                                                      'missing_ratios', 'notifications', 'server_delay',
+                                                      'startup_runs', 'workers', 'contention_seconds')},
+            'environment': {'python': platform.python_version(), 'django': django.get_version(),
+                            'database': connection.vendor, 'platform': platform.platform()},
+        }
+        scaled = [scenario for scenario in SCALED_SCENARIOS if scenario in options['scenarios']]
+        if scaled:
+            results['runs'] = [self.run_scaled(scaled, ponies, options) for ponies in options['ponies']]
+        if 'notify' in options['scenarios']:
+            with benchmark_environment():
+                results['notify'] = fanout.run_fanout(options['notifications'], options['server_delay'] / 1000)
+        if 'startup' in options['scenarios']:
+            with benchmark_environment():
+                results['startup'] = startup.run_startup(options['startup_runs'])
+        if 'sqlite-concurrency' in options['scenarios']:
+            with benchmark_environment():
+                results['sqlite-concurrency'] = contention.run_contention(options['workers'],
+                                                                          options['contention_seconds'])
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    @staticmethod
+    def run_scaled(scenarios, ponies: int, options) -> dict:
+        with benchmark_environment():
+            start = time.perf_counter()
+            names = seed_ponies(ponies)
+            run = {'ponies': ponies, 'seed_s': round(time.perf_counter() - start, 3)}
+            if 'hi' in scenarios:
+                run['hi'] = ingest.run_hi(names, options['requests'], options['concurrency'])
+            if 'hi-asgi' in scenarios:
+                run['hi-asgi'] = ingest.compare_wsgi_asgi(names, options['requests'], options['concurrency'])
+            if 'hi-ingress' in scenarios:
+                run['hi-ingress'] = ingest.compare_ingress(names, options['requests'], options['concurrency'])
+            if 'check' in scenarios:
+                run['check'] = sweep.run_sweeps(options['missing_ratios'])
+        return run
@@ -1,24 +1,12 @@
 import datetime
-import logging
 
 from django.core.management import BaseCommand, CommandError,CommandParser
 from django.utils.timezone import now
 
-from ...models import Pony,History
-from ...services import notification
-
-
-def mark_pony_missing(pony: Pony):
-    pony.status = Pony.STATUS_MISSING
-    pony.save()
-    history = History(
-        pony_id= pony.id,
-        previous_status= Pony.STATUS_NORMAL,
-        current_status=Pony.STATUS_MISSING,
-        create_time=now()
-    )
-    history.save()
-    notification.send_status_change_notification(pony, Pony.STATUS_NORMAL, Pony.STATUS_MISSING)
+from ... import metrics
+from ...models import Pony
+from ...services import checker, counters
+from ...services.lease import LeaseHolder
 
 
 class Command(BaseCommand):
@@ -27,26 +15,79 @@ class Command(BaseCommand):
     def add_arguments(self, parser: CommandParser):
         parser.add_argument('--dry-run', action='store_true',
                             help='just check ponies, without actual changing status or sending notifications')
+        parser.add_argument('--daemon', action='store_true',
+                            help='keep running and check each pony right after its deadline instead of exiting')
+        parser.add_argument('--grace', type=int,
+                            help=f'seconds to wait after a deadline before marking a pony missing, '
+                                 f'default {checker.CHECK_GRACE_MINUTE * 60}, '
+                                 f'or {checker.DAEMON_GRACE_SECONDS} with --daemon')
+        parser.add_argument('--adaptive', action='store_true',
+                            help='also mark ponies missing once they are late for their usual heartbeat cadence, '
+                                 'dark_minute stays the upper bound')
+        parser.add_argument('--shard',
+                            help='only check shard i of N, given as i/N, e.g. 2/4 on the second of four checker nodes; '
+                                 'all nodes must use the same N')
+        parser.add_argument('--refresh', type=int, default=checker.DAEMON_REFRESH_SECONDS,
+                            help='seconds between reloading upcoming deadlines in daemon mode')
 
     def handle(self, *args, **options):
-        start_time = now()
         dry_run: bool = options['dry_run']
+        grace = None
+        if options['grace'] is not None:
+            if options['grace'] < 0:
+                raise CommandError('grace cannot be negative')
+            grace = datetime.timedelta(seconds=options['grace'])
+        shard = None
+        if options['shard'] is not None:
+            try:
+                shard = checker.parse_shard(options['shard'])
+            except ValueError:
+                raise CommandError('shard must be given as i/N with 1 <= i <= N')
+        #  one checker per shard, a dry run changes nothing and needs no lease
+        lease = None if dry_run else LeaseHolder(checker.lease_name(shard))
+        if options['daemon']:
+            if options['refresh'] <= 0:
+                raise CommandError('refresh must be positive')
+            self.run_daemon(grace, datetime.timedelta(seconds=options['refresh']), dry_run, options['adaptive'],
+                            shard, lease)
+            return
+
+        start_time = now()
+        if lease is not None and not lease.renew():
+            self.stdout.write(f"{lease.name} is held by another checker, skipping")
+            return
         self.stdout.write("start checking ponies")
-        normal_ponies = Pony.objects.filter(status=Pony.STATUS_NORMAL)
-        current_time = now()
-        total_ponies = normal_ponies.count()
-        missing_ponies = 0
-        for pony in normal_ponies:
-            if pony.last_hi_time is None:
-                continue
-            dark_delta = datetime.timedelta(minutes=pony.dark_minute + 5)
-            if current_time - pony.last_hi_time > dark_delta:
-                if not dry_run:
-                    mark_pony_missing(pony)
-                missing_ponies += 1
-                logging.info("pony missing: %s , %d", pony.name, pony.dark_minute)
+        try:
+            if shard is None:
+                total_ponies = counters.counts()[Pony.STATUS_NORMAL]
+            else:
+                #  the counters are not kept per shard
+                total_ponies = checker.in_shard(Pony.objects.filter(status=Pony.STATUS_NORMAL), shard).count()
+            metrics.CHECKED_PONIES.set(total_ponies)
+            missing_ponies = len(checker.check_ponies(dry_run=dry_run, current_time=start_time, grace=grace,
+                                                       adaptive=options['adaptive'], shard=shard, lease=lease))
+        finally:
+            if lease is not None:
+                lease.release()
 
         time_cost = now() - start_time
         self.stdout.write(f"finished checking, total {total_ponies} ,missing {missing_ponies} , execution time: {time_cost.total_seconds()} s")
         if dry_run:
-            self.stdout.write('dry-run option on, no changes will be made')
\ No newline at end of file
+            self.stdout.write('dry-run option on, no changes will be made')
+
+    def run_daemon(self, grace: datetime.timedelta, refresh_interval: datetime.timedelta, dry_run: bool,
+                   adaptive: bool, shard: checker.Shard, lease: LeaseHolder):
+        daemon = checker.CheckerDaemon(grace=grace, refresh_interval=refresh_interval, dry_run=dry_run,
+                                       adaptive=adaptive, shard=shard, lease=lease)
+        self.stdout.write(f"start checking ponies as a daemon, grace {daemon.grace.total_seconds()} s")
+        if dry_run:
+            self.stdout.write('dry-run option on, no changes will be made')
+        try:
+            daemon.run_forever(
+                on_sweep=lambda ponies: self.stdout.write(f"{now()} missing {len(ponies)}")
+            )
+        except KeyboardInterrupt:
+            self.stdout.write("checker daemon stopped")
+        finally:
+            if lease is not None:
+                lease.release()
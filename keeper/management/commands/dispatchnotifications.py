@@ -0,0 +1,42 @@
+import json
+
+from django.core.management import BaseCommand, CommandError, CommandParser
+from django.utils.timezone import now
+
+from ...services import dispatcher
+
+
+class Command(BaseCommand):
+    help = "Send notifications waiting in the outbox, with retries, when LUNA_NOTIFICATION_OUTBOX is on"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('--daemon', action='store_true',
+                            help='keep running and send new notifications as they arrive')
+        parser.add_argument('--poll', type=float, default=1,
+                            help='seconds to wait before looking again when a channel has nothing to send')
+        parser.add_argument('--stats', action='store_true', help='just print queue depth and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(dispatcher.outbox_stats(), indent=2))
+            return
+        if options['poll'] <= 0:
+            raise CommandError('poll must be positive')
+
+        outbox_dispatcher = dispatcher.Dispatcher()
+        if options['daemon']:
+            self.stdout.write(f"start dispatching notifications as a daemon, concurrency {outbox_dispatcher.concurrency}")
+            try:
+                outbox_dispatcher.run_forever(options['poll'])
+            except KeyboardInterrupt:
+                outbox_dispatcher.stop()
+                self.stdout.write("dispatcher stopped")
+            return
+
+        start_time = now()
+        self.stdout.write("start dispatching notifications")
+        handled = outbox_dispatcher.dispatch_all()
+        outbox_dispatcher.stop()
+        time_cost = now() - start_time
+        self.stdout.write(f"finished dispatching, handled {handled} , execution time: {time_cost.total_seconds()} s")
+        self.stdout.write(json.dumps(dispatcher.outbox_stats()))
@@ -0,0 +1,39 @@
+import os
+import sys
+
+from django.core.management import BaseCommand, CommandError, CommandParser
+
+from ...services import provisioning
+
+
+class Command(BaseCommand):
+    help = "Create, update and delete ponies listed in a JSON or CSV file, in one transaction"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('file', help='path of the file, - for standard input')
+        parser.add_argument('--format', choices=['json', 'csv'],
+                            help='format of the file, guessed from its extension by default')
+        parser.add_argument('--dry-run', action='store_true', help='validate only, write nothing')
+
+    def handle(self, *args, **options):
+        path = options['file']
+        format = options['format'] or ('csv' if os.path.splitext(path)[1].lower() == '.csv' else 'json')
+        try:
+            if path == '-':
+                data = sys.stdin.read()
+            else:
+                with open(path, encoding='utf-8', newline='') as f:
+                    data = f.read()
+            items = provisioning.parse_items(data, format)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'failed to read {path}: {e}')
+
+        try:
+            result = provisioning.provision(items, dry_run=options['dry_run'])
+        except provisioning.ProvisioningError as e:
+            for error in e.errors:
+                self.stderr.write(f"item {error['index']} {error['name'] or ''}: {error['msg']}")
+            raise CommandError(f'{len(e.errors)} invalid items, nothing was written')
+        prefix = 'would have' if options['dry_run'] else ''
+        self.stdout.write(f"{prefix} created {len(result['created'])} ,updated {len(result['updated'])} ,"
+                          f"deleted {len(result['deleted'])} ponies".strip())
@@ -0,0 +1,33 @@
+import datetime
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError, CommandParser
+from django.utils.timezone import now
+
+from ...services import history
+
+
+class Command(BaseCommand):
+    help = "Delete old status history and the history of removed ponies, in small batches"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'LUNA_HISTORY_RETENTION_DAYS', 180),
+                            help='keep the history of this many days, LUNA_HISTORY_RETENTION_DAYS by default')
+        parser.add_argument('--batch-size', type=int, default=history.PRUNE_BATCH_SIZE,
+                            help='rows deleted per transaction')
+        parser.add_argument('--sleep', type=float, default=0, help='seconds to pause between batches')
+
+    def handle(self, *args, **options):
+        if options['days'] <= 0:
+            raise CommandError('days must be positive')
+        if options['batch_size'] <= 0:
+            raise CommandError('batch size must be positive')
+
+        start_time = now()
+        self.stdout.write("start pruning history")
+        before = start_time - datetime.timedelta(days=options['days'])
+        old = history.prune_before(before, options['batch_size'], options['sleep'])
+        orphans = history.prune_orphans(options['batch_size'], options['sleep'])
+        time_cost = now() - start_time
+        self.stdout.write(f"finished pruning, older than {options['days']} days {old} ,of removed ponies {orphans} ,"
+                          f" execution time: {time_cost.total_seconds()} s")
@@ -0,0 +1,17 @@
+from django.core.management import BaseCommand
+from django.utils.timezone import now
+
+from ...services import counters, notification
+
+
+class Command(BaseCommand):
+    help = "Repair the per-status pony counters from the ponies, e.g. hourly"
+
+    def handle(self, *args, **options):
+        start_time = now()
+        self.stdout.write("start reconciling status counts")
+        drift = counters.reconcile()
+        time_cost = now() - start_time
+        repaired = ' ,'.join(f"{notification.STATUS_NAME.get(status, status)} {delta:+d}"
+                             for status, delta in sorted(drift.items())) or 'none'
+        self.stdout.write(f"finished reconciling, drift {repaired} , execution time: {time_cost.total_seconds()} s")
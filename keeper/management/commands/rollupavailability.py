@@ -0,0 +1,19 @@
+from django.core.management import BaseCommand, CommandParser
+from django.utils.timezone import now
+
+from ...services import availability
+
+
+class Command(BaseCommand):
+    help = "Close the availability rollups of the past days, run it shortly after midnight"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('--now', action='store_true',
+                            help='roll up until now instead of the start of today, e.g. before reading the table')
+
+    def handle(self, *args, **options):
+        start_time = now()
+        self.stdout.write("start rolling up availability")
+        rolled_up = availability.close_day(start_time if options['now'] else None)
+        time_cost = now() - start_time
+        self.stdout.write(f"finished rolling up, ponies {rolled_up} , execution time: {time_cost.total_seconds()} s")
@@ -0,0 +1,420 @@
+"""Prometheus metrics aggregated across worker processes.
+
+Every process writes its samples into its own memory-mapped file in LUNA_METRICS_DIR, so recording a sample is a
+memory write, and /metrics adds up the files of all processes. Without LUNA_METRICS_DIR the samples stay in memory
+and /metrics only shows the process serving it. The files of processes that exited are folded into one aggregate
+file when /metrics is read, so short-lived commands like checkpony don't leave a file each behind.
+"""
+import contextlib
+import mmap
+import os
+import struct
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+try:
+    import fcntl
+except ImportError:  #  not available on Windows
+    fcntl = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FILE_PREFIX = 'luna_'
+FILE_SUFFIX = '.metrics'
+INITIAL_FILE_SIZE = 64 * 1024
+#  samples of exited processes, and the lock file serializing readers of the directory
+AGGREGATE_NAME = 'aggregate'
+LOCK_FILENAME = 'luna.lock'
+#  bytes used by the entries, followed by entries of key length, key padded to 8 bytes and a double
+USED = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+TIMESTAMP_SUFFIX = '#timestamp'
+
+
+class MemoryStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values: typing.Dict[str, float] = {}
+
+    def inc(self, key: str, amount: float):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def set(self, key: str, value: float):
+        with self.lock:
+            self.values[key] = value
+
+    def files(self) -> typing.List[typing.Tuple[typing.Optional[int], typing.Dict[str, float]]]:
+        with self.lock:
+            return [(None, dict(self.values))]
+
+
+class MmapStore:
+    """Samples of this process in a memory-mapped file, readable by every other process"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.directory_lock = threading.Lock()
+        self.pid: typing.Optional[int] = None
+        self.file = None
+        self.map: typing.Optional[mmap.mmap] = None
+        self.offsets: typing.Dict[str, int] = {}
+        self.used = USED.size
+
+    def inc(self, key: str, amount: float):
+        with self.lock:
+            offset = self.offset(key)
+            self.map[offset:offset + VALUE.size] = VALUE.pack(VALUE.unpack_from(self.map, offset)[0] + amount)
+
+    def set(self, key: str, value: float):
+        with self.lock:
+            offset = self.offset(key)
+            self.map[offset:offset + VALUE.size] = VALUE.pack(value)
+
+    def offset(self, key: str) -> int:
+        if self.pid != os.getpid():
+            #  a forked worker must not write into its parent's file
+            self.open()
+        offset = self.offsets.get(key)
+        if offset is None:
+            offset = self.append(key)
+        return offset
+
+    def open(self):
+        self.pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(str(self.pid))
+        if os.path.exists(path):
+            #  left by an exited process with the same pid, its samples still count
+            with self.locked():
+                self.fold([path])
+        self.file = open(path, 'w+b')
+        self.file.truncate(INITIAL_FILE_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), INITIAL_FILE_SIZE)
+        self.offsets = {}
+        self.used = USED.size
+        USED.pack_into(self.map, 0, self.used)
+
+    def append(self, key: str) -> int:
+        encoded = key.encode()
+        padded = KEY_LENGTH.size + len(encoded)
+        padded += -padded % 8
+        size = padded + VALUE.size
+        if self.used + size > len(self.map):
+            new_size = max(len(self.map) * 2, self.used + size)
+            self.map.close()
+            self.file.truncate(new_size)
+            self.map = mmap.mmap(self.file.fileno(), new_size)
+        entry = self.used
+        KEY_LENGTH.pack_into(self.map, entry, len(encoded))
+        self.map[entry + KEY_LENGTH.size:entry + KEY_LENGTH.size + len(encoded)] = encoded
+        VALUE.pack_into(self.map, entry + padded, 0.0)
+        #  readers only look at entries below used, so it is moved on after the entry is complete
+        self.used += size
+        USED.pack_into(self.map, 0, self.used)
+        self.offsets[key] = entry + padded
+        return entry + padded
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, f'{FILE_PREFIX}{name}{FILE_SUFFIX}')
+
+    def files(self) -> typing.List[typing.Tuple[typing.Optional[int], typing.Dict[str, float]]]:
+        """Samples of the live processes by pid, and of the exited ones together with pid None"""
+        if not os.path.isdir(self.directory):
+            return []
+        with self.locked():
+            pids = []
+            for filename in os.listdir(self.directory):
+                name = filename[len(FILE_PREFIX):-len(FILE_SUFFIX)]
+                if filename.startswith(FILE_PREFIX) and filename.endswith(FILE_SUFFIX) and name.isdigit():
+                    pids.append(int(name))
+            self.fold([self.path(str(pid)) for pid in pids if not process_alive(pid)])
+            result = []
+            for pid in [pid for pid in pids if process_alive(pid)] + [None]:
+                data = read_file(self.path(str(pid) if pid is not None else AGGREGATE_NAME))
+                if data is not None:
+                    result.append((pid, read_entries(data)))
+            return result
+
+    def fold(self, paths: typing.List[str]):
+        """Adds the samples of exited processes to the aggregate file and deletes their files, needs locked()"""
+        if not paths:
+            return
+        aggregate = read_entries(read_file(self.path(AGGREGATE_NAME)) or b'')
+        for path in paths:
+            data = read_file(path)
+            if data is not None:
+                merge_exited(aggregate, read_entries(data))
+        temporary = os.path.join(self.directory, f'{FILE_PREFIX}{AGGREGATE_NAME}.tmp')
+        with open(temporary, 'wb') as f:
+            f.write(encode_entries(aggregate))
+        os.replace(temporary, self.path(AGGREGATE_NAME))
+        for path in paths:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    @contextlib.contextmanager
+    def locked(self):
+        #  a POSIX lock against other processes, which doesn't exclude threads of this one
+        with self.directory_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, LOCK_FILENAME), 'a+b') as lock_file:
+                fcntl.lockf(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def read_file(path: str) -> typing.Optional[bytes]:
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def encode_entries(values: typing.Dict[str, float]) -> bytes:
+    """The file format MmapStore.append writes"""
+    entries = []
+    for key, value in values.items():
+        encoded = key.encode()
+        padded = KEY_LENGTH.size + len(encoded)
+        entries.append(KEY_LENGTH.pack(len(encoded)) + encoded + b'\0' * (-padded % 8) + VALUE.pack(value))
+    body = b''.join(entries)
+    return USED.pack(USED.size + len(body)) + body
+
+
+def read_entries(data: bytes) -> typing.Dict[str, float]:
+    values = {}
+    if len(data) < USED.size:
+        return values
+    used = min(USED.unpack_from(data)[0], len(data))
+    position = USED.size
+    while position + KEY_LENGTH.size <= used:
+        length = KEY_LENGTH.unpack_from(data, position)[0]
+        padded = KEY_LENGTH.size + length
+        padded += -padded % 8
+        if position + padded + VALUE.size > used:
+            break
+        key = data[position + KEY_LENGTH.size:position + KEY_LENGTH.size + length].decode()
+        values[key] = VALUE.unpack_from(data, position + padded)[0]
+        position += padded + VALUE.size
+    return values
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                directory = getattr(settings, 'LUNA_METRICS_DIR', None)
+                _store = MmapStore(directory) if directory else MemoryStore()
+    return _store
+
+
+@receiver(setting_changed)
+def reset_store(setting, **kwargs):
+    global _store
+    if setting == 'LUNA_METRICS_DIR':
+        _store = None
+
+
+def sample_key(name: str, labels: typing.Dict[str, str]) -> str:
+    if not labels:
+        return name
+    text = ','.join(f'{label}="{escape(str(value))}"' for label, value in labels.items())
+    return f'{name}{{{text}}}'
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+REGISTRY: typing.List['Metric'] = []
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def labels(self, labels: typing.Dict[str, str]) -> typing.Dict[str, str]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes the labels {self.labelnames}, got {tuple(labels)}')
+        return {label: labels[label] for label in self.labelnames}
+
+    def expose(self, values: typing.Dict[str, float]) -> typing.List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key in sorted(values):
+            if key == self.name or key.startswith(self.name + '{'):
+                lines.append(f'{key} {format_value(values[key])}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        get_store().inc(sample_key(self.name, self.labels(labels)), amount)
+
+
+class Gauge(Metric):
+    """A gauge summed over live processes, or with latest=True the value set last by any process"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = (), latest: bool = False):
+        super().__init__(name, documentation, labelnames)
+        self.latest = latest
+
+    def set(self, value: float, **labels):
+        key = sample_key(self.name, self.labels(labels))
+        store = get_store()
+        store.set(key, value)
+        if self.latest:
+            store.set(key + TIMESTAMP_SUFFIX, time.time())
+
+    def inc(self, amount: float = 1, **labels):
+        get_store().inc(sample_key(self.name, self.labels(labels)), amount)
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        labels = self.labels(labels)
+        store = get_store()
+        #  buckets are stored per range and made cumulative in expose
+        bucket = next(bucket for bucket in self.buckets if value <= bucket)
+        store.inc(sample_key(f'{self.name}_bucket', {**labels, 'le': format_value(bucket)}), 1)
+        store.inc(sample_key(f'{self.name}_sum', labels), value)
+        store.inc(sample_key(f'{self.name}_count', labels), 1)
+
+    def expose(self, values: typing.Dict[str, float]) -> typing.List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        series = {}
+        for key, value in values.items():
+            for suffix in ('_sum', '_count'):
+                if key.startswith(f'{self.name}{suffix}{{') or key == f'{self.name}{suffix}':
+                    series.setdefault(key[len(self.name) + len(suffix):], {})[suffix] = value
+        for label_text in sorted(series):
+            labels = label_text[1:-1] + ',' if label_text else ''
+            cumulative = 0.0
+            for bucket in self.buckets:
+                bound = format_value(bucket)
+                cumulative += values.get(f'{self.name}_bucket{{{labels}le="{bound}"}}', 0.0)
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {format_value(cumulative)}')
+            lines.append(f'{self.name}_sum{label_text} {format_value(series[label_text].get("_sum", 0.0))}')
+            lines.append(f'{self.name}_count{label_text} {format_value(series[label_text].get("_count", 0.0))}')
+        return lines
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def gauge_names() -> typing.Tuple[typing.Set[str], typing.Set[str]]:
+    """Names of the gauges taken from the process which set them last, and of the ones summed over live processes"""
+    return ({metric.name for metric in REGISTRY if isinstance(metric, Gauge) and metric.latest},
+            {metric.name for metric in REGISTRY if isinstance(metric, Gauge) and not metric.latest})
+
+
+def merge_exited(aggregate: typing.Dict[str, float], samples: typing.Dict[str, float]):
+    """Adds the samples of an exited process to the aggregate, its gauges summed over live processes are dropped"""
+    latest_gauges, live_gauges = gauge_names()
+    for key, value in samples.items():
+        name = key.split('{', 1)[0]
+        if key.endswith(TIMESTAMP_SUFFIX) or name in live_gauges:
+            continue
+        if name in latest_gauges:
+            timestamp = samples.get(key + TIMESTAMP_SUFFIX, 0.0)
+            if key not in aggregate or aggregate.get(key + TIMESTAMP_SUFFIX, 0.0) <= timestamp:
+                aggregate[key] = value
+                aggregate[key + TIMESTAMP_SUFFIX] = timestamp
+        else:
+            aggregate[key] = aggregate.get(key, 0.0) + value
+
+
+def collect() -> typing.Dict[str, float]:
+    """Samples of all processes: counters and histograms are added up, gauges summed over live processes
+    or taken from the process which set them last"""
+    latest_gauges, live_gauges = gauge_names()
+    values: typing.Dict[str, float] = {}
+    latest: typing.Dict[str, typing.Tuple[float, float]] = {}
+    for pid, samples in get_store().files():
+        alive = pid is None or process_alive(pid)
+        for key, value in samples.items():
+            name = key.split('{', 1)[0]
+            if key.endswith(TIMESTAMP_SUFFIX):
+                continue
+            if name in latest_gauges:
+                timestamp = samples.get(key + TIMESTAMP_SUFFIX, 0.0)
+                if key not in latest or latest[key][0] <= timestamp:
+                    latest[key] = (timestamp, value)
+            elif name in live_gauges and not alive:
+                continue
+            else:
+                values[key] = values.get(key, 0.0) + value
+    values.update({key: value for key, (_, value) in latest.items()})
+    return values
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def render() -> str:
+    """All metrics in the Prometheus text format"""
+    values = collect()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose(values))
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram('luna_request_duration_seconds', 'Time to answer a request, by view', ['view'])
+REQUEST_QUERIES = Histogram('luna_request_queries', 'Database queries of a request, by view', ['view'],
+                            buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+SWEEP_SECONDS = Histogram('luna_checker_sweep_duration_seconds', 'Time of a checker sweep')
+MISSING_PONIES = Counter('luna_checker_missing_ponies_total', 'Ponies the checker marked missing')
+CHECKED_PONIES = Gauge('luna_checker_normal_ponies', 'Normal ponies at the last checkpony run', latest=True)
+BACKGROUND_QUEUE = Gauge('luna_background_queue_depth', 'Tasks waiting for or running in run_in_background')
+NOTIFICATIONS = Counter('luna_notifications_total', 'Notifications sent, by channel and result',
+                        ['channel', 'result'])
+NOTIFICATION_SECONDS = Histogram('luna_notification_duration_seconds', 'Time to send a notification, by channel',
+                                 ['channel'])
+PONY_CACHE = Counter('luna_pony_cache_total', 'Pony cache lookups and invalidations', ['result'])
@@ -0,0 +1,83 @@
+import asyncio
+import contextvars
+import time
+import typing
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import metrics
+
+#  queries of the current request, contextvars follow the request into sync_to_async threads
+_request_queries: contextvars.ContextVar[typing.Optional[typing.List[int]]] = \
+    contextvars.ContextVar('luna_request_queries', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class MetricsMiddleware:
+    """Records latency and database queries of every request routed to a named view"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        for connection in connections.all():
+            install_query_counter(connection)
+        if asyncio.iscoroutinefunction(get_response):
+            #  keeps async views like transitions_pony in the event loop
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        queries, token, start = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, queries, start)
+        return response
+
+    async def __acall__(self, request):
+        queries, token, start = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, queries, start)
+        return response
+
+    @staticmethod
+    def start() -> typing.Tuple[typing.List[int], contextvars.Token, float]:
+        queries = [0]
+        return queries, _request_queries.set(queries), time.monotonic()
+
+    @staticmethod
+    def record(request, queries: typing.List[int], start: float):
+        match = getattr(request, 'resolver_match', None)
+        if match is None or not match.url_name or match.url_name == 'metrics':
+            return
+        MetricsMiddleware.record_view(match.url_name, queries, start)
+
+    @staticmethod
+    def record_view(view: str, queries: typing.List[int], start: float):
+        metrics.REQUEST_SECONDS.observe(time.monotonic() - start, view=view)
+        metrics.REQUEST_QUERIES.observe(queries[0], view=view)
+
+    @staticmethod
+    def finish(token: contextvars.Token):
+        _request_queries.reset(token)
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.6 on 2026-10-18 10:31
+
+from django.db import migrations, models
+from django.db.models import F, ExpressionWrapper
+
+from keeper.expressions import Minutes
+
+STATUS_NORMAL = 1
+
+
+def fill_deadline(apps, schema_editor):
+    Pony = apps.get_model('keeper', 'Pony')
+    Pony.objects.filter(status=STATUS_NORMAL, last_hi_time__isnull=False).update(
+        deadline=ExpressionWrapper(F('last_hi_time') + Minutes(F('dark_minute')), output_field=models.DateTimeField())
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0002_alter_pony_last_hi_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pony',
+            name='deadline',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.RunPython(fill_deadline, migrations.RunPython.noop),
+    ]
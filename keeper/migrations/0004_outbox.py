@@ -0,0 +1,34 @@
+# Generated by Django 3.2.6 on 2026-10-18 10:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0003_pony_deadline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Outbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pony_id', models.IntegerField(null=True)),
+                ('channel', models.CharField(max_length=10)),
+                ('url', models.CharField(max_length=255)),
+                ('title', models.CharField(max_length=255)),
+                ('content', models.TextField()),
+                ('status', models.IntegerField(default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_time', models.DateTimeField()),
+                ('last_error', models.CharField(blank=True, max_length=255)),
+                ('create_time', models.DateTimeField()),
+                ('sent_time', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outbox',
+            index=models.Index(fields=['status', 'channel', 'next_attempt_time'], name='keeper_outb_status_85d43f_idx'),
+        ),
+    ]
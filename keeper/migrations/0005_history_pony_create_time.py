@@ -0,0 +1,22 @@
+# Generated by Django 3.2.6 on 2026-10-18 10:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0004_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['pony_id', 'create_time'], name='keeper_hist_pony_id_069666_idx'),
+        ),
+        migrations.AlterField(
+            model_name='history',
+            name='pony_id',
+            field=models.IntegerField(),
+        ),
+    ]
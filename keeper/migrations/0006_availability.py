@@ -0,0 +1,43 @@
+# Generated by Django 3.2.6 on 2026-10-18 10:44
+
+from django.db import migrations, models
+from django.utils.timezone import now
+
+STATUS_INIT = 0
+
+
+def start_rollups(apps, schema_editor):
+    #  availability of existing ponies is counted from now on
+    Pony = apps.get_model('keeper', 'Pony')
+    Pony.objects.exclude(status=STATUS_INIT).update(rollup_time=now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0005_history_pony_create_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Availability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pony_id', models.IntegerField()),
+                ('day', models.DateField()),
+                ('normal_seconds', models.IntegerField(default=0)),
+                ('missing_seconds', models.IntegerField(default=0)),
+                ('transitions', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pony',
+            name='rollup_time',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='availability',
+            constraint=models.UniqueConstraint(fields=('pony_id', 'day'), name='unique_pony_day'),
+        ),
+        migrations.RunPython(start_rollups, migrations.RunPython.noop),
+    ]
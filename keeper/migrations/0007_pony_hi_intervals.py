@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 10:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0006_availability'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pony',
+            name='hi_intervals',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.6 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0007_pony_hi_intervals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pony',
+            name='cadence_mean',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='pony',
+            name='cadence_variance',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='pony',
+            name='expected_deadline',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-18 10:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0008_pony_cadence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('owner', models.CharField(max_length=255)),
+                ('expire_time', models.DateTimeField()),
+                ('acquire_time', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.6 on 2026-10-18 11:07
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicate_names(apps, schema_editor):
+    #  add_pony checked before inserting, so concurrent requests may have created the same name twice
+    Pony = apps.get_model('keeper', 'Pony')
+    duplicates = list(Pony.objects.values('name').annotate(count=Count('id')).filter(count__gt=1)
+                      .values_list('name', flat=True)[:20])
+    if duplicates:
+        raise RuntimeError(f"rename or remove the ponies sharing a name before migrating: {', '.join(duplicates)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0009_lease'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='pony',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.6 on 2026-10-18 11:21
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_ponies(apps, schema_editor):
+    Pony = apps.get_model('keeper', 'Pony')
+    StatusCount = apps.get_model('keeper', 'StatusCount')
+    StatusCount.objects.bulk_create([StatusCount(status=status, count=count) for status, count in
+                                     Pony.objects.values_list('status').annotate(count=Count('id')).order_by()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0010_pony_name_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatusCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(unique=True)),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_ponies, migrations.RunPython.noop),
+    ]
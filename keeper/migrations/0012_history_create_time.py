@@ -0,0 +1,17 @@
+# Generated by Django 3.2.6 on 2026-10-18 11:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keeper', '0011_statuscount'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['create_time'], name='keeper_hist_create__a64723_idx'),
+        ),
+    ]
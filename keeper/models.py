@@ -1,5 +1,10 @@
+import datetime
+import typing
+
 from django.db import models
 
+from .intervals import IntervalRing, expected_gap
+
 # Create your models here.
 
 
@@ -9,7 +14,7 @@ class Pony(models.Model):
     STATUS_NORMAL = 1
     STATUS_MISSING = 2
 
-    name = models.CharField(max_length=255, db_index= True)
+    name = models.CharField(max_length=255, unique=True)
     passcode = models.CharField(max_length=255)
     dark_minute = models.IntegerField()
     last_hi_time = models.DateTimeField(null=True)
@@ -17,11 +22,105 @@ class Pony(models.Model):
     notify_channel = models.CharField(max_length=10)
     notify_url = models.CharField(max_length=255)
     create_time = models.DateTimeField()
+    #  last_hi_time + dark_minute of a normal pony, null otherwise. Indexed so the checker only reads overdue ponies
+    deadline = models.DateTimeField(null=True, db_index=True)
+    #  the time in the current status up to here is already added to the Availability rollups
+    rollup_time = models.DateTimeField(null=True)
+    #  packed IntervalRing of the latest times between two heartbeats of the normal pony
+    hi_intervals = models.BinaryField(null=True)
+    #  moving average and variance of the seconds between heartbeats
+    cadence_mean = models.FloatField(null=True)
+    cadence_variance = models.FloatField(null=True)
+    #  when the next hi is overdue judging by the cadence, never after deadline. Null while the cadence is unknown
+    expected_deadline = models.DateTimeField(null=True, db_index=True)
+
+    def refresh_deadline(self):
+        self.expected_deadline = None
+        if self.status == Pony.STATUS_NORMAL and self.last_hi_time is not None:
+            self.deadline = self.last_hi_time + datetime.timedelta(minutes=self.dark_minute)
+            gap = self.expected_gap()
+            if gap is not None:
+                self.expected_deadline = min(self.last_hi_time + datetime.timedelta(seconds=gap), self.deadline)
+        else:
+            self.deadline = None
+
+    def expected_gap(self) -> typing.Optional[float]:
+        return expected_gap(self.cadence_mean, self.cadence_variance, IntervalRing(self.hi_intervals).count)
+
+    def interval_summary(self) -> dict:
+        return IntervalRing(self.hi_intervals).summary()
 
 
 class History(models.Model):
-    pony_id = models.IntegerField(db_index= True)
+    pony_id = models.IntegerField()
     create_time = models.DateTimeField()
     previous_status = models.IntegerField()
     current_status = models.IntegerField()
 
+    class Meta:
+        indexes = [
+            #  serves both lookups by pony and the newest-first pages of /pony/history
+            models.Index(fields=['pony_id', 'create_time']),
+            #  the retention cutoff of prunehistory, which spans all ponies
+            models.Index(fields=['create_time']),
+        ]
+
+
+class Availability(models.Model):
+    """Seconds a pony spent normal and missing on a day, and the number of status changes on that day"""
+
+    pony_id = models.IntegerField()
+    day = models.DateField()
+    normal_seconds = models.IntegerField(default=0)
+    missing_seconds = models.IntegerField(default=0)
+    transitions = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['pony_id', 'day'], name='unique_pony_day'),
+        ]
+
+
+class Outbox(models.Model):
+    """A notification waiting to be sent by the dispatcher, written in the same transaction as its cause"""
+
+    STATUS_PENDING = 0
+    STATUS_SENT = 1
+    STATUS_DEAD = 2
+
+    pony_id = models.IntegerField(null=True)
+    channel = models.CharField(max_length=10)
+    url = models.CharField(max_length=255)
+    title = models.CharField(max_length=255)
+    content = models.TextField()
+    status = models.IntegerField(default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    #  also used as a lease, a claimed message is pushed back so a crashed dispatcher's claims become due again
+    next_attempt_time = models.DateTimeField()
+    last_error = models.CharField(max_length=255, blank=True)
+    create_time = models.DateTimeField()
+    sent_time = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'channel', 'next_attempt_time']),
+        ]
+
+
+class Lease(models.Model):
+    """Lets one process at a time do a named piece of work, e.g. one checker per shard.
+
+    The owner renews the lease before expire_time, once it expired anybody may take it over.
+    """
+
+    name = models.CharField(max_length=64, unique=True)
+    owner = models.CharField(max_length=255)
+    expire_time = models.DateTimeField()
+    acquire_time = models.DateTimeField()
+
+
+class StatusCount(models.Model):
+    """Number of ponies in a status, changed in the same transaction as the ponies so reading it needs no COUNT(*)"""
+
+    status = models.IntegerField(unique=True)
+    count = models.BigIntegerField(default=0)
@@ -0,0 +1,135 @@
+import datetime
+import typing
+
+from django.db import transaction
+from django.db.models import Case, When, Value, F, IntegerField
+from django.utils.timezone import now, localdate, localtime, make_aware
+
+from ..models import Pony, Availability
+from ..utils import batch_size
+
+ROLLUP_BATCH_SIZE = 500
+#  parameters per rollup row of the UPDATE in save_credits: pony, day and value in each of the three increments,
+#  plus the pony and the day in the IN lists
+CREDIT_PARAMS_PER_ROW = 11
+SLA_DAYS = (7, 30, 90)
+
+#  (pony_id, day) -> [normal seconds, missing seconds, transitions]
+Credits = typing.Dict[typing.Tuple[int, datetime.date], typing.List[int]]
+
+
+def record_transitions(transitions: typing.List[typing.Tuple[int, int, typing.Optional[datetime.datetime]]],
+                       current_time: datetime.datetime):
+    """Adds (pony_id, previous status, rollup_time) transitions to the rollups.
+
+    The time since rollup_time is added to the previous status and the transition is counted on the current day.
+    Must run in the transaction changing the status, the caller sets rollup_time of the ponies to current_time.
+    """
+    credits: Credits = {}
+    for pony_id, previous_status, rollup_time in transitions:
+        add_status_time(credits, pony_id, previous_status, rollup_time, current_time)
+        credits.setdefault((pony_id, localdate(current_time)), [0, 0, 0])[2] += 1
+    save_credits(credits)
+
+
+def close_day(until: datetime.datetime = None) -> int:
+    """Adds the time in the current status up to `until`, the start of today by default, to the rollups
+    of every normal or missing pony, returns the number of ponies rolled up.
+
+    Runs in transactions of ROLLUP_BATCH_SIZE locked ponies, so it never races a status change.
+    """
+    if until is None:
+        until = start_of_day(localdate())
+    last_id = 0
+    rolled_up = 0
+    while True:
+        with transaction.atomic():
+            ponies = list(Pony.objects.select_for_update()
+                          .filter(id__gt=last_id, status__in=[Pony.STATUS_NORMAL, Pony.STATUS_MISSING],
+                                  rollup_time__lt=until)
+                          .order_by('id').only('id', 'status', 'rollup_time')[:ROLLUP_BATCH_SIZE])
+            if not ponies:
+                return rolled_up
+            credits: Credits = {}
+            for pony in ponies:
+                add_status_time(credits, pony.id, pony.status, pony.rollup_time, until)
+            save_credits(credits)
+            Pony.objects.filter(id__in=[pony.id for pony in ponies]).update(rollup_time=until)
+        last_id = ponies[-1].id
+        rolled_up += len(ponies)
+
+
+def uptime(pony: Pony, current_time: datetime.datetime = None) -> typing.List[dict]:
+    """Availability over the last 7, 30 and 90 days, read from at most 90 rollup rows.
+
+    The time in the current status since the last rollup is added on the fly.
+    """
+    if current_time is None:
+        current_time = now()
+    today = localdate(current_time)
+    credits: Credits = {}
+    for row in Availability.objects.filter(pony_id=pony.id, day__gt=today - datetime.timedelta(days=max(SLA_DAYS))):
+        credits[(pony.id, row.day)] = [row.normal_seconds, row.missing_seconds, row.transitions]
+    add_status_time(credits, pony.id, pony.status, pony.rollup_time, current_time)
+
+    figures = []
+    for days in SLA_DAYS:
+        first_day = today - datetime.timedelta(days=days - 1)
+        rows = [credit for (_, day), credit in credits.items() if day >= first_day]
+        normal = sum(row[0] for row in rows)
+        missing = sum(row[1] for row in rows)
+        transitions = sum(row[2] for row in rows)
+        figures.append({
+            'days': days,
+            'normal_seconds': normal,
+            'missing_seconds': missing,
+            'transitions': transitions,
+            'availability': normal / (normal + missing) if normal + missing else None,
+        })
+    return figures
+
+
+def add_status_time(credits: Credits, pony_id: int, status: int, since: typing.Optional[datetime.datetime],
+                    until: datetime.datetime):
+    if status not in (Pony.STATUS_NORMAL, Pony.STATUS_MISSING) or since is None:
+        return
+    index = 0 if status == Pony.STATUS_NORMAL else 1
+    for day, seconds in split_by_day(since, until):
+        credits.setdefault((pony_id, day), [0, 0, 0])[index] += seconds
+
+
+def split_by_day(since: datetime.datetime, until: datetime.datetime) -> typing.List[typing.Tuple[datetime.date, int]]:
+    """Whole seconds of the interval per local day"""
+    result = []
+    since = localtime(since)
+    while since < until:
+        day_end = start_of_day(since.date() + datetime.timedelta(days=1))
+        end = min(day_end, until)
+        result.append((since.date(), int((end - since).total_seconds())))
+        since = localtime(end)
+    return result
+
+
+def start_of_day(day: datetime.date) -> datetime.datetime:
+    return make_aware(datetime.datetime.combine(day, datetime.time()))
+
+
+def save_credits(credits: Credits):
+    """Adds credits to the rollup rows with one insert and one UPDATE per batch, creating missing rows first"""
+    items = [(key, values) for key, values in credits.items() if any(values)]
+    size = batch_size(CREDIT_PARAMS_PER_ROW, ROLLUP_BATCH_SIZE)
+    for i in range(0, len(items), size):
+        batch = items[i:i + size]
+        Availability.objects.bulk_create([Availability(pony_id=pony_id, day=day) for (pony_id, day), _ in batch],
+                                         ignore_conflicts=True)
+        increments = [
+            Case(*[When(pony_id=pony_id, day=day, then=Value(values[index])) for (pony_id, day), values in batch],
+                 default=Value(0), output_field=IntegerField())
+            for index in range(3)
+        ]
+        Availability.objects.filter(pony_id__in={pony_id for (pony_id, _), _ in batch},
+                                    day__in={day for (_, day), _ in batch}).update(
+            normal_seconds=F('normal_seconds') + increments[0],
+            missing_seconds=F('missing_seconds') + increments[1],
+            transitions=F('transitions') + increments[2],
+        )
@@ -0,0 +1,233 @@
+import datetime
+import heapq
+import logging
+import time
+import typing
+
+from django.db import transaction, close_old_connections
+from django.db.models import QuerySet, Q
+from django.db.models.functions import Mod
+from django.utils.timezone import now
+
+from .. import metrics
+from ..models import Pony, History
+from . import notification, heartbeat, pony_cache, availability, counters
+from .lease import LeaseHolder
+
+CHECK_GRACE_MINUTE = 5
+DAEMON_GRACE_SECONDS = 30
+DAEMON_REFRESH_SECONDS = 30
+#  keep IN (...) lists below the SQLite variable limit
+UPDATE_BATCH_SIZE = 500
+
+#  shard i of N, 1 <= i <= N
+Shard = typing.Tuple[int, int]
+
+
+def parse_shard(value: str) -> Shard:
+    """Parses 'i/N', raises ValueError if it isn't a valid shard"""
+    index, _, count = value.partition('/')
+    shard = int(index), int(count)
+    if not 1 <= shard[0] <= shard[1]:
+        raise ValueError(f'invalid shard: {value}')
+    return shard
+
+
+def in_shard(queryset: QuerySet, shard: typing.Optional[Shard]) -> QuerySet:
+    """Ponies of the shard, partitioned by id modulo the number of shards"""
+    if shard is None or shard[1] == 1:
+        return queryset
+    index, count = shard
+    return queryset.alias(shard=Mod('id', count)).filter(shard=index - 1)
+
+
+def lease_name(shard: typing.Optional[Shard]) -> str:
+    return 'checkpony' if shard is None else f'checkpony:{shard[0]}/{shard[1]}'
+
+
+def find_overdue_ponies(current_time: datetime.datetime = None, grace: datetime.timedelta = None,
+                        adaptive: bool = False, shard: Shard = None) -> QuerySet:
+    """Normal ponies whose deadline plus the grace period has passed, an index range scan on deadline.
+
+    With adaptive=True also the ones whose expected_deadline from their heartbeat cadence has passed,
+    the cadence already allows for jitter so no grace period is added to it.
+    """
+    if current_time is None:
+        current_time = now()
+    if grace is None:
+        grace = datetime.timedelta(minutes=CHECK_GRACE_MINUTE)
+    staleness = heartbeat.staleness_allowance()
+    overdue = Q(deadline__lt=current_time - grace - staleness)
+    if adaptive:
+        overdue |= Q(expected_deadline__lt=current_time - staleness)
+    return in_shard(Pony.objects.filter(overdue, status=Pony.STATUS_NORMAL), shard)
+
+
+def mark_ponies_missing(ponies: typing.List[Pony], current_time: datetime.datetime = None) -> typing.List[Pony]:
+    """Flip ponies to missing with one update and one bulk insert, notifications are sent after commit.
+
+    The ponies need their rollup_time loaded, their time as normal pony is added to the availability rollups.
+    """
+    if not ponies:
+        return []
+    if current_time is None:
+        current_time = now()
+    with transaction.atomic():
+        ids = [pony.id for pony in ponies]
+        for i in range(0, len(ids), UPDATE_BATCH_SIZE):
+            Pony.objects.filter(id__in=ids[i:i + UPDATE_BATCH_SIZE]).update(status=Pony.STATUS_MISSING,
+                                                                             deadline=None, expected_deadline=None,
+                                                                             rollup_time=current_time)
+        History.objects.bulk_create([
+            History(pony_id=pony.id, previous_status=Pony.STATUS_NORMAL, current_status=Pony.STATUS_MISSING,
+                    create_time=current_time)
+            for pony in ponies
+        ], batch_size=UPDATE_BATCH_SIZE)
+        availability.record_transitions([(pony.id, Pony.STATUS_NORMAL, pony.rollup_time) for pony in ponies],
+                                        current_time)
+        counters.adjust({Pony.STATUS_NORMAL: -len(ponies), Pony.STATUS_MISSING: len(ponies)})
+        for pony in ponies:
+            pony.status = Pony.STATUS_MISSING
+            pony.deadline = None
+            pony.expected_deadline = None
+            pony.rollup_time = current_time
+        transaction.on_commit(lambda: forget_ponies(ponies))
+        notification.notify_status_changes([(pony, Pony.STATUS_NORMAL, Pony.STATUS_MISSING) for pony in ponies],
+                                           background=False)
+    return ponies
+
+
+def forget_ponies(ponies: typing.List[Pony]):
+    """Drops copies of ponies that are no longer normal, from the pony cache and the heartbeat store"""
+    pony_cache.invalidate(ponies)
+    heartbeat.forget(ponies)
+
+
+def mark_pony_missing(pony: Pony):
+    mark_ponies_missing([pony])
+
+
+def check_ponies(dry_run: bool = False, current_time: datetime.datetime = None,
+                 grace: datetime.timedelta = None, adaptive: bool = False, shard: Shard = None,
+                 lease: LeaseHolder = None) -> typing.List[Pony]:
+    """Find overdue ponies and mark them missing, returns the overdue ponies.
+
+    With a lease nothing is changed unless it can be renewed in the same transaction, so a checker that lost
+    its shard to another one can't mark ponies missing twice.
+    """
+    if current_time is None:
+        current_time = now()
+    start = time.monotonic()
+    heartbeat.reconcile()
+    overdue = find_overdue_ponies(current_time, grace, adaptive, shard).only('id', 'name', 'passcode', 'dark_minute',
+                                                                     'notify_channel', 'notify_url', 'rollup_time')
+    if dry_run:
+        ponies = list(overdue)
+    else:
+        with transaction.atomic():
+            if lease is not None and not lease.renew():
+                return []
+            #  lock the rows so a concurrent hi can't be overwritten by the missing status
+            ponies = list(overdue.select_for_update())
+            mark_ponies_missing(ponies, current_time)
+        metrics.MISSING_PONIES.inc(len(ponies))
+    metrics.SWEEP_SECONDS.observe(time.monotonic() - start)
+    for pony in ponies:
+        logging.info("pony missing: %s , %d", pony.name, pony.dark_minute)
+    return ponies
+
+
+class CheckerDaemon:
+    """Keeps a min-heap of upcoming deadlines and sweeps right when one of them expires.
+
+    The heap is only a wake-up schedule: every sweep still goes through check_ponies, so entries made
+    stale by a later hi just cause an empty range scan. Deadlines due before the next refresh are
+    (re)loaded every refresh interval, which also picks up new ponies and changed dark_minutes.
+    With a lease the daemon only sweeps while it holds it and waits as a standby otherwise.
+    """
+
+    def __init__(self, grace: datetime.timedelta = None, refresh_interval: datetime.timedelta = None,
+                 dry_run: bool = False, adaptive: bool = False, shard: Shard = None, lease: LeaseHolder = None):
+        self.grace = grace if grace is not None else datetime.timedelta(seconds=DAEMON_GRACE_SECONDS)
+        self.refresh_interval = refresh_interval if refresh_interval is not None \
+            else datetime.timedelta(seconds=DAEMON_REFRESH_SECONDS)
+        self.dry_run = dry_run
+        self.adaptive = adaptive
+        self.shard = shard
+        self.lease = lease
+        self.heap: typing.List[typing.Tuple[datetime.datetime, int]] = []
+        self.scheduled: typing.Dict[int, datetime.datetime] = {}
+        self.next_refresh: typing.Optional[datetime.datetime] = None
+        self.stopped = False
+
+    def refresh(self, current_time: datetime.datetime):
+        heartbeat.reconcile()
+        staleness = heartbeat.staleness_allowance()
+        grace = self.grace + staleness
+        horizon = current_time + self.refresh_interval * 2
+        upcoming = Q(deadline__lt=horizon - grace)
+        if self.adaptive:
+            upcoming |= Q(expected_deadline__lt=horizon - staleness)
+        for pony_id, deadline, expected_deadline in in_shard(Pony.objects.filter(upcoming, status=Pony.STATUS_NORMAL),
+                                                             self.shard).values_list('id', 'deadline',
+                                                                                     'expected_deadline'):
+            due_time = deadline + grace
+            if self.adaptive and expected_deadline is not None:
+                due_time = min(due_time, expected_deadline + staleness)
+            if self.scheduled.get(pony_id) != due_time:
+                self.scheduled[pony_id] = due_time
+                heapq.heappush(self.heap, (due_time, pony_id))
+        self.next_refresh = current_time + self.refresh_interval
+
+    def pop_due(self, current_time: datetime.datetime) -> int:
+        due = 0
+        while self.heap and self.heap[0][0] < current_time:
+            due_time, pony_id = heapq.heappop(self.heap)
+            if self.scheduled.get(pony_id) == due_time:
+                del self.scheduled[pony_id]
+                due += 1
+        return due
+
+    def run_once(self, current_time: datetime.datetime = None) -> typing.Tuple[typing.List[Pony], float]:
+        """Refreshes the heap if needed and sweeps when a deadline expired.
+
+        Returns the ponies marked missing and the number of seconds to sleep until the next wake-up.
+        """
+        if current_time is None:
+            current_time = now()
+        if self.lease is not None and not self.lease.renew():
+            #  another checker holds the shard, start over once its lease expired and we took it
+            self.heap = []
+            self.scheduled = {}
+            self.next_refresh = None
+            return [], self.renew_seconds()
+        if self.next_refresh is None or current_time >= self.next_refresh:
+            self.refresh(current_time)
+        missing_ponies = []
+        if self.pop_due(current_time) > 0:
+            missing_ponies = check_ponies(dry_run=self.dry_run, current_time=current_time, grace=self.grace,
+                                          adaptive=self.adaptive, shard=self.shard, lease=self.lease)
+        wake_time = self.next_refresh
+        if self.heap and self.heap[0][0] < wake_time:
+            wake_time = self.heap[0][0]
+        sleep_seconds = max((wake_time - current_time).total_seconds(), 0)
+        if self.lease is not None:
+            sleep_seconds = min(sleep_seconds, self.renew_seconds())
+        return missing_ponies, sleep_seconds
+
+    def renew_seconds(self) -> float:
+        """Wake up often enough to renew the lease well before it expires"""
+        return self.lease.duration.total_seconds() / 3
+
+    def run_forever(self, on_sweep: typing.Callable[[typing.List[Pony]], None] = None):
+        while not self.stopped:
+            close_old_connections()
+            try:
+                missing_ponies, sleep_seconds = self.run_once()
+                if missing_ponies and on_sweep is not None:
+                    on_sweep(missing_ponies)
+            except Exception as e:
+                logging.error("checker daemon sweep failed", exc_info=e)
+                sleep_seconds = self.refresh_interval.total_seconds()
+                self.next_refresh = None
+            time.sleep(sleep_seconds)
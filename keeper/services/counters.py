@@ -0,0 +1,61 @@
+import logging
+import typing
+
+from django.db import transaction, IntegrityError
+from django.db.models import F, Count
+
+from ..models import Pony, StatusCount
+
+STATUSES = (Pony.STATUS_INIT, Pony.STATUS_NORMAL, Pony.STATUS_MISSING)
+
+
+def adjust(deltas: typing.Dict[int, int]):
+    """Adds the changes in the number of ponies per status, to be called in the transaction changing the ponies
+    after the change is written"""
+    for status, delta in deltas.items():
+        if not delta:
+            continue
+        if not StatusCount.objects.filter(status=status).update(count=F('count') + delta):
+            #  e.g. a flushed table, the count of the written ponies already includes the change
+            create(status)
+
+
+def create(status: int):
+    try:
+        with transaction.atomic():
+            StatusCount.objects.create(status=status, count=Pony.objects.filter(status=status).count())
+    except IntegrityError:
+        #  created by a concurrent transaction, whose count doesn't include our change
+        logging.warning("status count %d created concurrently, left to reconcile()", status)
+
+
+def transitions(changes: typing.Iterable[typing.Tuple[int, int]]) -> typing.Dict[int, int]:
+    """Deltas of (previous status, current status) changes"""
+    deltas = {}
+    for previous_status, after_status in changes:
+        if previous_status != after_status:
+            deltas[previous_status] = deltas.get(previous_status, 0) - 1
+            deltas[after_status] = deltas.get(after_status, 0) + 1
+    return deltas
+
+
+def counts() -> typing.Dict[int, int]:
+    """Number of ponies per status, one read of a few rows"""
+    result = {status: 0 for status in STATUSES}
+    result.update(StatusCount.objects.values_list('status', 'count'))
+    return result
+
+
+def reconcile() -> typing.Dict[int, int]:
+    """Repairs the counters from COUNT(*) queries, returns the drift by status that was repaired"""
+    with transaction.atomic():
+        #  writing the counters first locks them, so no transition commits between counting and storing
+        StatusCount.objects.update(count=F('count'))
+        stored = dict(StatusCount.objects.values_list('status', 'count'))
+        actual = {status: 0 for status in set(STATUSES) | set(stored)}
+        actual.update(Pony.objects.values_list('status').annotate(count=Count('id')).order_by())
+        drift = {status: count - stored.get(status, 0) for status, count in actual.items()
+                 if count != stored.get(status)}
+        for status in drift:
+            StatusCount.objects.update_or_create(status=status, defaults={'count': actual[status]})
+    return {status: delta for status, delta in drift.items() if delta}
@@ -0,0 +1,233 @@
+import datetime
+import logging
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import Count, Min, F
+from django.utils.timezone import now
+
+from ..consts import NOTIFY_CHANNEL_EMAIL, NOTIFY_CHANNEL_SLACK
+from ..models import Outbox
+from . import notification
+
+DEFAULT_CONCURRENCY = {NOTIFY_CHANNEL_EMAIL: 2, NOTIFY_CHANNEL_SLACK: 4}
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_RETRY_SECONDS = 30
+MAX_RETRY_SECONDS = 3600
+#  how long a claimed message stays invisible to other dispatchers
+CLAIM_SECONDS = 300
+EMAILS_PER_CONNECTION = 20
+
+
+class SendStats:
+    """Send counts and latency per channel of this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels: typing.Dict[str, typing.Dict[str, float]] = {}
+
+    def record(self, channel: str, succeeded: bool, latency: float):
+        with self.lock:
+            stats = self.channels.setdefault(channel, {'sent': 0, 'failed': 0, 'latency_total': 0.0,
+                                                       'latency_max': 0.0})
+            stats['sent' if succeeded else 'failed'] += 1
+            stats['latency_total'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+
+    def snapshot(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        with self.lock:
+            return {channel: dict(stats) for channel, stats in self.channels.items()}
+
+
+send_stats = SendStats()
+
+
+def retry_delay(attempts: int, base_seconds: float) -> datetime.timedelta:
+    """Exponential backoff, base_seconds after the first failed attempt and doubling after each one"""
+    return datetime.timedelta(seconds=min(base_seconds * 2 ** (attempts - 1), MAX_RETRY_SECONDS))
+
+
+def claim(channel: str, limit: int, current_time: datetime.datetime = None) -> typing.List[Outbox]:
+    """Takes due pending messages of a channel and pushes their next attempt back by CLAIM_SECONDS"""
+    if current_time is None:
+        current_time = now()
+    with transaction.atomic():
+        messages = list(Outbox.objects.select_for_update(skip_locked=True)
+                        .filter(status=Outbox.STATUS_PENDING, channel=channel, next_attempt_time__lte=current_time)
+                        .order_by('next_attempt_time')[:limit])
+        if messages:
+            claimed_until = current_time + datetime.timedelta(seconds=CLAIM_SECONDS)
+            Outbox.objects.filter(id__in=[message.id for message in messages]) \
+                .update(next_attempt_time=claimed_until, attempts=F('attempts') + 1)
+            for message in messages:
+                message.attempts += 1
+    return messages
+
+
+def deliver(message: Outbox, max_attempts: int, retry_seconds: float) -> bool:
+    return deliver_digest([message], max_attempts, retry_seconds)
+
+
+def deliver_digest(messages: typing.List[Outbox], max_attempts: int, retry_seconds: float) -> bool:
+    """Sends messages to one destination, as a single digest if there are more than one"""
+    title, content = digest_of(messages)
+    start = time.monotonic()
+    try:
+        succeeded = notification.send_by_channel(title, content, messages[0].channel, messages[0].url)
+        error = '' if succeeded else 'sending failed'
+    except Exception as e:
+        succeeded = False
+        error = repr(e)
+    send_stats.record(messages[0].channel, succeeded, time.monotonic() - start)
+    for message in messages:
+        record_delivery(message, succeeded, error, max_attempts, retry_seconds)
+    return succeeded
+
+
+def deliver_emails(digests: typing.List[typing.List[Outbox]], max_attempts: int,
+                   retry_seconds: float) -> typing.List[bool]:
+    """Like deliver_digest for many destinations, the emails are sent over one SMTP connection"""
+    start = time.monotonic()
+    results = notification.send_emails([digest_of(messages) + (messages[0].url,) for messages in digests])
+    latency = (time.monotonic() - start) / len(digests)
+    for messages, succeeded in zip(digests, results):
+        send_stats.record(messages[0].channel, succeeded, latency)
+        for message in messages:
+            record_delivery(message, succeeded, '' if succeeded else 'sending failed', max_attempts, retry_seconds)
+    return results
+
+
+def digest_of(messages: typing.List[Outbox]) -> typing.Tuple[str, str]:
+    if len(messages) == 1:
+        return messages[0].title, messages[0].content
+    return notification.generate_digest_message([message.title for message in messages])
+
+
+def group_digests(messages: typing.List[Outbox], threshold: int) -> typing.List[typing.List[Outbox]]:
+    """Groups claimed messages by destination, destinations with fewer than threshold messages get them one by one"""
+    destinations = {}
+    for message in messages:
+        destinations.setdefault(message.url, []).append(message)
+    digests = []
+    for grouped in destinations.values():
+        if 0 < threshold <= len(grouped):
+            digests.append(grouped)
+        else:
+            digests.extend([message] for message in grouped)
+    return digests
+
+
+def record_delivery(message: Outbox, succeeded: bool, error: str, max_attempts: int, retry_seconds: float):
+    current_time = now()
+    if succeeded:
+        Outbox.objects.filter(id=message.id).update(status=Outbox.STATUS_SENT, sent_time=current_time,
+                                                    last_error='')
+    elif message.attempts >= max_attempts:
+        logging.error("notification %d is dead after %d attempts: %s", message.id, message.attempts, error)
+        Outbox.objects.filter(id=message.id).update(status=Outbox.STATUS_DEAD, last_error=error[:255])
+    else:
+        Outbox.objects.filter(id=message.id).update(
+            next_attempt_time=current_time + retry_delay(message.attempts, retry_seconds), last_error=error[:255])
+
+
+class Dispatcher:
+    """Drains the outbox with a thread pool per channel, so a slow channel never holds up the others"""
+
+    def __init__(self, concurrency: typing.Dict[str, int] = None, max_attempts: int = None,
+                 retry_seconds: float = None):
+        if concurrency is None:
+            concurrency = getattr(settings, 'LUNA_NOTIFICATION_CONCURRENCY', DEFAULT_CONCURRENCY)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts if max_attempts is not None \
+            else getattr(settings, 'LUNA_NOTIFICATION_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self.retry_seconds = retry_seconds if retry_seconds is not None \
+            else getattr(settings, 'LUNA_NOTIFICATION_RETRY_SECONDS', DEFAULT_RETRY_SECONDS)
+        self.executors = {channel: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'dispatch-{channel}')
+                          for channel, workers in concurrency.items()}
+        self.stopped = threading.Event()
+
+    def dispatch_once(self, channel: str) -> int:
+        """Sends one batch of due messages of the channel, returns the number of messages handled.
+
+        Messages of the batch going to the same destination are merged as in notification.digest_messages.
+        """
+        workers = self.concurrency[channel]
+        threshold = notification.digest_threshold()
+        if channel == NOTIFY_CHANNEL_EMAIL:
+            #  each worker sends its share of the batch over a single SMTP connection
+            messages = claim(channel, workers * EMAILS_PER_CONNECTION)
+            digests = group_digests(messages, threshold)
+            chunks = [digests[i::workers] for i in range(workers) if digests[i::workers]]
+            list(self.executors[channel].map(self.deliver_emails, chunks))
+        else:
+            messages = claim(channel, workers * 4)
+            list(self.executors[channel].map(self.deliver_digest, group_digests(messages, threshold)))
+        return len(messages)
+
+    def deliver_digest(self, messages: typing.List[Outbox]) -> bool:
+        try:
+            return deliver_digest(messages, self.max_attempts, self.retry_seconds)
+        finally:
+            close_old_connections()
+
+    def deliver_emails(self, digests: typing.List[typing.List[Outbox]]) -> typing.List[bool]:
+        try:
+            return deliver_emails(digests, self.max_attempts, self.retry_seconds)
+        finally:
+            close_old_connections()
+
+    def dispatch_all(self) -> int:
+        """Drains everything due right now, for one-shot runs"""
+        total = 0
+        for channel in self.concurrency:
+            while True:
+                handled = self.dispatch_once(channel)
+                total += handled
+                if handled == 0:
+                    break
+        return total
+
+    def run_forever(self, poll_interval: float = 1):
+        threads = [threading.Thread(target=self.run_channel, args=(channel, poll_interval),
+                                    name=f'dispatcher-{channel}', daemon=True)
+                   for channel in self.concurrency]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_channel(self, channel: str, poll_interval: float):
+        while not self.stopped.is_set():
+            try:
+                handled = self.dispatch_once(channel)
+            except Exception as e:
+                logging.error("dispatching %s notifications failed", channel, exc_info=e)
+                handled = 0
+            finally:
+                close_old_connections()
+            if handled == 0:
+                self.stopped.wait(poll_interval)
+
+    def stop(self):
+        self.stopped.set()
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
+
+
+def outbox_stats() -> dict:
+    """Queue depth per channel and status, age of the oldest due message and send latency of this process"""
+    current_time = now()
+    depth = {}
+    for row in Outbox.objects.filter(status__in=[Outbox.STATUS_PENDING, Outbox.STATUS_DEAD])\
+            .values('channel', 'status').annotate(count=Count('id')):
+        depth.setdefault(row['channel'], {})['dead' if row['status'] == Outbox.STATUS_DEAD else 'pending'] = row['count']
+    oldest = Outbox.objects.filter(status=Outbox.STATUS_PENDING).aggregate(oldest=Min('create_time'))['oldest']
+    return {
+        'depth': depth,
+        'oldest_pending_seconds': (current_time - oldest).total_seconds() if oldest is not None else 0,
+        'sends': send_stats.snapshot(),
+    }
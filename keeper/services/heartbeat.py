@@ -0,0 +1,516 @@
+import abc
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import transaction, close_old_connections
+from django.db.models import Case, When, Value, F, DateTimeField, ExpressionWrapper, Expression
+from django.db.models.functions import Least
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from ..expressions import Minutes
+from ..intervals import IntervalRing, update_ewma, expected_gap
+from ..liveness import LivenessFile
+from ..models import Pony, History
+from ..utils import batch_size
+from . import notification, pony_cache, availability, counters
+
+#  upper bound of LUNA_HEARTBEAT_MAX_STALENESS_SECONDS, the checker waits this much longer when buffering is on
+MAX_STALENESS_LIMIT_SECONDS = 300
+FLUSH_BATCH_SIZE = 500
+#  parameters per pony of the batched UPDATE in write_heartbeats: a Case branch of last_hi_time, repeated in the
+#  deadline, three of the cadence fields and up to three of expected_deadline, plus its id in the IN list
+WRITE_PARAMS_PER_PONY = 14
+#  and of the one in record_his, which sets the same last_hi_time and deadline for all of them
+RECORD_PARAMS_PER_PONY = 10
+#  fields a heartbeat of a normal pony updates from their previous values
+CADENCE_FIELDS = ('hi_intervals', 'cadence_mean', 'cadence_variance')
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def record_hi(pony: Pony, deferrable: bool = True, hi_time: datetime.datetime = None) -> typing.Tuple[int, int]:
+    """Records a heartbeat of the pony at hi_time, now by default, returns the previous and current status.
+
+    The pony may be a cached snapshot. Heartbeats of normal ponies go to the heartbeat store if there is one,
+    see get_store(), status transitions are always written right away together with their History row.
+    Raises Pony.DoesNotExist if the pony was removed meanwhile.
+    """
+    previous_status = pony.status
+    after_status = Pony.STATUS_NORMAL
+    if hi_time is None:
+        hi_time = now()
+    if deferrable and can_buffer(pony):
+        store = get_store()
+        if store.add(pony, hi_time):
+            if store.due():
+                store.flush()
+            return previous_status, after_status
+        #  the store knows better than our copy, e.g. the checker of another process marked the pony missing
+        pony_cache.invalidate([pony])
+        pony.refresh_from_db()
+        return record_hi(pony, deferrable=False, hi_time=hi_time)
+
+    with transaction.atomic():
+        #  only matches if the status is still the one we have seen, deadline uses the stored dark_minute
+        matching = Pony.objects.filter(id=pony.id, status=previous_status)
+        cadence = cadence_of(pony)
+        stored = None
+        if previous_status == Pony.STATUS_NORMAL:
+            #  the cadence is read-modify-write, it continues from the locked row, not from our copy whose
+            #  last_hi_time is behind whenever another process handled the previous hi
+            stored = matching.select_for_update().values('last_hi_time', *CADENCE_FIELDS).first()
+            if stored is not None:
+                cadence = next_cadence(stored, stored['last_hi_time'], [hi_time])
+        updated = 0
+        if stored is not None or previous_status != Pony.STATUS_NORMAL:
+            updated = matching.update(
+                status=after_status, last_hi_time=hi_time, deadline=deadline_expression(hi_time),
+                expected_deadline=expected_deadline_expression(hi_time, cadence), **cadence
+            )
+        if updated and previous_status != after_status:
+            record_transitions([(pony, previous_status)], hi_time)
+    if not updated:
+        #  our copy is outdated, e.g. the checker marked the pony missing after it was cached
+        pony_cache.invalidate([pony])
+        pony.refresh_from_db()
+        return record_hi(pony, hi_time=hi_time)
+
+    pony.status = after_status
+    pony.last_hi_time = hi_time
+    for field, value in cadence.items():
+        setattr(pony, field, value)
+    pony.refresh_deadline()
+    #  keeps the cached copy matching the database for the next hi
+    transaction.on_commit(lambda: pony_cache.put(pony))
+    if get_store() is not None:
+        transaction.on_commit(lambda: mark_written([pony], hi_time))
+    return previous_status, after_status
+
+
+def record_his(ponies: typing.List[Pony]) -> typing.Dict[int, typing.Tuple[int, int]]:
+    """Records heartbeats of many ponies with one UPDATE, returns previous and current status by pony id.
+
+    The ponies must be fresh and locked, i.e. loaded with select_for_update in the caller's transaction.
+    Otherwise the semantics are the ones of record_hi.
+    """
+    after_status = Pony.STATUS_NORMAL
+    hi_time = now()
+    statuses = {pony.id: (pony.status, after_status) for pony in ponies}
+    buffered = set()
+    store = get_store()
+    if store is not None:
+        buffered = {pony.id for pony in ponies if can_buffer(pony) and store.add(pony, hi_time)}
+        if buffered and store.due():
+            store.flush()
+    written = [pony for pony in ponies if pony.id not in buffered]
+    if not written:
+        return statuses
+
+    cadences = {pony.id: next_cadence(cadence_of(pony), pony.last_hi_time, [hi_time])
+                if pony.status == Pony.STATUS_NORMAL else cadence_of(pony) for pony in written}
+    size = batch_size(RECORD_PARAMS_PER_PONY, FLUSH_BATCH_SIZE)
+    with transaction.atomic():
+        for i in range(0, len(written), size):
+            batch = {pony.id: cadences[pony.id] for pony in written[i:i + size]}
+            Pony.objects.filter(id__in=list(batch)).update(
+                status=after_status, last_hi_time=hi_time, deadline=deadline_expression(hi_time),
+                **cadence_cases({pony_id: (hi_time, cadence) for pony_id, cadence in batch.items()})
+            )
+        transitions = [(pony, pony.status) for pony in written if pony.status != after_status]
+        if transitions:
+            record_transitions(transitions, hi_time)
+            transaction.on_commit(lambda: pony_cache.invalidate([pony for pony, _ in transitions]))
+        if store is not None:
+            transaction.on_commit(lambda: mark_written(written, hi_time))
+    for pony in written:
+        pony.status = after_status
+        pony.last_hi_time = hi_time
+        for field, value in cadences[pony.id].items():
+            setattr(pony, field, value)
+        pony.refresh_deadline()
+    return statuses
+
+
+def record_transitions(transitions: typing.List[typing.Tuple[Pony, int]], hi_time: datetime.datetime):
+    """Writes History rows and availability rollups of ponies which said hi after being init or missing,
+    and notifies after commit"""
+    after_status = Pony.STATUS_NORMAL
+    #  the ponies may be cached snapshots, the end-of-day rollup moves rollup_time without changing the status
+    ids = [pony.id for pony, _ in transitions]
+    rollup_times = {}
+    for i in range(0, len(ids), FLUSH_BATCH_SIZE):
+        chunk = Pony.objects.filter(id__in=ids[i:i + FLUSH_BATCH_SIZE])
+        rollup_times.update(chunk.values_list('id', 'rollup_time'))
+        chunk.update(rollup_time=hi_time)
+    availability.record_transitions([(pony.id, previous_status, rollup_times.get(pony.id))
+                                     for pony, previous_status in transitions], hi_time)
+    for pony, _ in transitions:
+        pony.rollup_time = hi_time
+    History.objects.bulk_create([
+        History(pony_id=pony.id, previous_status=previous_status, current_status=after_status, create_time=hi_time)
+        for pony, previous_status in transitions
+    ], batch_size=FLUSH_BATCH_SIZE)
+    counters.adjust(counters.transitions((previous_status, after_status) for _, previous_status in transitions))
+    notification.notify_status_changes([(pony, previous_status, after_status) for pony, previous_status in transitions])
+    for pony, previous_status in transitions:
+        logging.info("Pony status change:%s,%d,%d", pony.name, previous_status, after_status)
+
+
+def cadence_of(pony: Pony) -> typing.Dict[str, typing.Any]:
+    return {field: getattr(pony, field) for field in CADENCE_FIELDS}
+
+
+def next_cadence(cadence: typing.Dict[str, typing.Any], last_hi_time: typing.Optional[datetime.datetime],
+                 hi_times: typing.List[datetime.datetime]) -> typing.Dict[str, typing.Any]:
+    """Adds the times between last_hi_time and the following heartbeats to the packed IntervalRing
+    and the moving average and variance"""
+    ring = IntervalRing(cadence['hi_intervals'])
+    mean, variance = cadence['cadence_mean'], cadence['cadence_variance']
+    for hi_time in hi_times:
+        if last_hi_time is not None:
+            seconds = (hi_time - last_hi_time).total_seconds()
+            ring.add(seconds)
+            mean, variance = update_ewma(mean, variance, seconds)
+        last_hi_time = hi_time
+    return {'hi_intervals': ring.to_bytes(), 'cadence_mean': mean, 'cadence_variance': variance}
+
+
+def deadline_expression(hi_time: typing.Union[datetime.datetime, Expression]) -> Expression:
+    if not isinstance(hi_time, Expression):
+        hi_time = Value(hi_time)
+    return ExpressionWrapper(hi_time + Minutes(F('dark_minute')), output_field=DateTimeField())
+
+
+def expected_deadline_expression(hi_time: datetime.datetime, cadence: typing.Dict[str, typing.Any]) -> Expression:
+    """hi_time plus the expected gap of the cadence but no later than the deadline, null if the gap is unknown"""
+    gap = expected_gap(cadence['cadence_mean'], cadence['cadence_variance'],
+                       IntervalRing(cadence['hi_intervals']).count)
+    if gap is None:
+        return Value(None, output_field=DateTimeField())
+    return Least(Value(hi_time + datetime.timedelta(seconds=gap)), deadline_expression(hi_time),
+                 output_field=DateTimeField())
+
+
+def cadence_cases(cadences: typing.Dict[int, typing.Tuple[datetime.datetime, typing.Dict[str, typing.Any]]]
+                  ) -> typing.Dict[str, Case]:
+    """Per pony values of the cadence fields and expected_deadline for a batched UPDATE,
+    from the last hi_time and cadence of each pony"""
+    cases = {}
+    for field in CADENCE_FIELDS:
+        output_field = Pony._meta.get_field(field)
+        cases[field] = Case(*[When(id=pony_id, then=Value(cadence[field], output_field=output_field))
+                              for pony_id, (_, cadence) in cadences.items()],
+                            default=F(field), output_field=output_field)
+    cases['expected_deadline'] = Case(*[When(id=pony_id, then=expected_deadline_expression(hi_time, cadence))
+                                        for pony_id, (hi_time, cadence) in cadences.items()],
+                                      default=F('expected_deadline'), output_field=DateTimeField())
+    return cases
+
+
+def buffer_enabled() -> bool:
+    return getattr(settings, 'LUNA_HEARTBEAT_BUFFER', False)
+
+
+def can_buffer(pony: Pony) -> bool:
+    return pony.status == Pony.STATUS_NORMAL and get_store() is not None
+
+
+def staleness_allowance() -> datetime.timedelta:
+    """How far last_hi_time in the database may lag behind the real last heartbeat"""
+    store = get_store()
+    if store is None:
+        return datetime.timedelta()
+    return datetime.timedelta(seconds=store.max_staleness)
+
+
+def write_heartbeats(pending: typing.Dict[int, typing.List[datetime.datetime]]) -> typing.Tuple[int, typing.Set[int]]:
+    """Writes heartbeats of normal ponies as batched UPDATEs of last_hi_time, deadline and cadence.
+
+    Returns the number of ponies updated and the ids of the ponies that are no longer normal or were removed,
+    their heartbeats are dropped. Heartbeats the database already has are skipped.
+    """
+    updated = 0
+    not_normal = set()
+    items = list(pending.items())
+    size = batch_size(WRITE_PARAMS_PER_PONY, FLUSH_BATCH_SIZE)
+    for i in range(0, len(items), size):
+        batch = dict(items[i:i + size])
+        #  the cadence continues from what any process wrote last, not from our possibly cached copies
+        stored = {row.pop('id'): row for row in
+                  Pony.objects.filter(id__in=list(batch), status=Pony.STATUS_NORMAL)
+                  .values('id', 'last_hi_time', *CADENCE_FIELDS)}
+        not_normal.update(pony_id for pony_id in batch if pony_id not in stored)
+        normal = {}
+        for pony_id, hi_times in batch.items():
+            if pony_id in stored:
+                last_hi_time = stored[pony_id]['last_hi_time']
+                hi_times = [hi_time for hi_time in hi_times if last_hi_time is None or hi_time > last_hi_time]
+                if hi_times:
+                    normal[pony_id] = hi_times
+        if normal:
+            cadences = {pony_id: (hi_times[-1], next_cadence(stored[pony_id], stored[pony_id]['last_hi_time'],
+                                                             hi_times))
+                        for pony_id, hi_times in normal.items()}
+            last_hi_times = Case(*[When(id=pony_id, then=Value(hi_time))
+                                   for pony_id, (hi_time, _) in cadences.items()], output_field=DateTimeField())
+            updated += Pony.objects.filter(id__in=list(normal), status=Pony.STATUS_NORMAL).update(
+                last_hi_time=last_hi_times, deadline=deadline_expression(last_hi_times), **cadence_cases(cadences)
+            )
+    return updated, not_normal
+
+
+class HeartbeatStore(abc.ABC):
+    """Takes heartbeats of normal ponies instead of the database, which is updated every flush_interval seconds.
+
+    Status transitions never go through a store. The checker calls reconcile() before it looks for overdue ponies
+    and waits max_staleness seconds longer for what it can't reconcile.
+    """
+
+    def __init__(self, flush_interval: float, max_staleness: float):
+        self.flush_interval = flush_interval
+        self.max_staleness = max_staleness
+        self.flusher_pid: typing.Optional[int] = None
+        self.flusher_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    @abc.abstractmethod
+    def add(self, pony: Pony, hi_time: datetime.datetime) -> bool:
+        """Takes a heartbeat, returns False if the store knows the pony is no longer normal"""
+
+    def due(self) -> bool:
+        """Whether the caller should flush right away"""
+        return False
+
+    @abc.abstractmethod
+    def flush(self) -> int:
+        """Writes the heartbeats taken by this process, returns the number of ponies updated"""
+
+    def reconcile(self) -> int:
+        """Writes every heartbeat the store can reach to the database"""
+        return self.flush()
+
+    def written(self, ponies: typing.List[Pony], hi_time: datetime.datetime):
+        """The ponies were written to the database directly, e.g. after a status transition"""
+
+    def forget(self, ponies: typing.List[Pony]):
+        """The ponies are no longer normal"""
+
+    def ensure_flusher(self):
+        #  started lazily so every forked worker gets its own thread
+        if self.flusher_pid == os.getpid():
+            return
+        with self.flusher_lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+            threading.Thread(target=self.run_flusher, name='heartbeat-flusher', daemon=True).start()
+
+    def run_flusher(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error("failed to flush buffered heartbeats", exc_info=e)
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+class HeartbeatBuffer(HeartbeatStore):
+    """Coalesces heartbeats of normal ponies in the memory of the process.
+
+    A flusher thread writes pending heartbeats every flush_interval seconds, and the request is asked to flush
+    by itself if the oldest pending heartbeat got older than max_staleness, e.g. because the flusher is behind.
+    """
+
+    def __init__(self, flush_interval: float, max_staleness: float):
+        if not 0 < flush_interval < max_staleness <= MAX_STALENESS_LIMIT_SECONDS:
+            raise ImproperlyConfigured(
+                f'heartbeat buffer needs 0 < LUNA_HEARTBEAT_FLUSH_SECONDS < LUNA_HEARTBEAT_MAX_STALENESS_SECONDS'
+                f' <= {MAX_STALENESS_LIMIT_SECONDS}')
+        super().__init__(flush_interval, max_staleness)
+        self.lock = threading.Lock()
+        #  every heartbeat since the last flush is kept for the interval statistics
+        self.pending: typing.Dict[int, typing.Tuple[Pony, typing.List[datetime.datetime]]] = {}
+        self.oldest_pending: typing.Optional[float] = None
+
+    def add(self, pony: Pony, hi_time: datetime.datetime) -> bool:
+        self.ensure_flusher()
+        with self.lock:
+            if pony.id in self.pending:
+                self.pending[pony.id][1].append(hi_time)
+            else:
+                self.pending[pony.id] = (pony, [hi_time])
+            if self.oldest_pending is None:
+                self.oldest_pending = time.monotonic()
+        return True
+
+    def due(self) -> bool:
+        with self.lock:
+            return self.oldest_pending is not None and time.monotonic() - self.oldest_pending >= self.max_staleness
+
+    def flush(self) -> int:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.oldest_pending = None
+        if not pending:
+            return 0
+        updated, not_normal = write_heartbeats({pony_id: hi_times for pony_id, (_, hi_times) in pending.items()})
+        if not_normal:
+            #  buffered from a stale cached copy, e.g. the checker of another process marked the pony missing,
+            #  the latest hi is a recovery and written the synchronous way with its transition
+            pony_cache.invalidate([pending[pony_id][0] for pony_id in not_normal])
+            for pony_id in not_normal:
+                pony, hi_times = pending[pony_id]
+                try:
+                    record_hi(pony, deferrable=False, hi_time=hi_times[-1])
+                except Pony.DoesNotExist:
+                    continue
+                updated += 1
+            logging.info("replayed buffered heartbeats of %d ponies no longer normal", len(not_normal))
+        return updated
+
+
+class MmapStore(HeartbeatStore):
+    """Keeps heartbeats of normal ponies in a LivenessFile shared by all processes of the host.
+
+    Workers record a heartbeat under a lock of just the pony's record, without waiting for the database or
+    for each other. Each process writes the heartbeats it recorded every flush_interval seconds, and
+    reconcile() writes those of every process, so a checker on the same host sees all of them.
+    A pony leaving normal is flagged in the file, which sends its next heartbeat the synchronous way
+    in every process, whatever their cached copies say.
+    """
+
+    def __init__(self, path: str, flush_interval: float):
+        if flush_interval <= 0:
+            raise ImproperlyConfigured('heartbeat file needs LUNA_HEARTBEAT_FLUSH_SECONDS > 0')
+        try:
+            self.file = LivenessFile(path)
+        except OSError as e:
+            raise ImproperlyConfigured(f'cannot use LUNA_HEARTBEAT_FILE {path}: {e}')
+        #  the checker reconciles the file itself, nothing is left to wait for
+        super().__init__(flush_interval, 0)
+        self.lock = threading.Lock()
+        self.pending: typing.Set[int] = set()
+
+    def add(self, pony: Pony, hi_time: datetime.datetime) -> bool:
+        if not self.file.add(pony.id, to_microseconds(hi_time)):
+            return False
+        self.ensure_flusher()
+        with self.lock:
+            self.pending.add(pony.id)
+        return True
+
+    def flush(self) -> int:
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        return self.write(pending)
+
+    def reconcile(self) -> int:
+        return self.write(self.file.behind())
+
+    def write(self, pony_ids: typing.Iterable[int]) -> int:
+        taken = {}
+        for pony_id in pony_ids:
+            entry = self.file.take(pony_id)
+            if entry is not None:
+                taken[pony_id] = entry
+        if not taken:
+            return 0
+        #  a record the database is behind of without pending heartbeats had its last write fail
+        updated, not_normal = write_heartbeats({pony_id: [from_microseconds(t) for t in times or [last]]
+                                                for pony_id, (last, times) in taken.items()})
+        for pony_id, (last, _) in taken.items():
+            if pony_id in not_normal:
+                self.file.forget(pony_id)
+            else:
+                self.file.reconciled(pony_id, last)
+        return updated
+
+    def written(self, ponies: typing.List[Pony], hi_time: datetime.datetime):
+        for pony in ponies:
+            self.file.reset(pony.id, to_microseconds(hi_time))
+
+    def forget(self, ponies: typing.List[Pony]):
+        for pony in ponies:
+            self.file.forget(pony.id)
+
+    def stop(self):
+        super().stop()
+        self.file.close()
+
+
+def to_microseconds(value: datetime.datetime) -> int:
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_microseconds(value: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+_store: typing.Optional[HeartbeatStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> typing.Optional[HeartbeatStore]:
+    """The MmapStore with LUNA_HEARTBEAT_FILE set, the HeartbeatBuffer with LUNA_HEARTBEAT_BUFFER on,
+    otherwise None and heartbeats are written to the database right away"""
+    global _store
+    if _store is None:
+        path = getattr(settings, 'LUNA_HEARTBEAT_FILE', None)
+        if not path and not buffer_enabled():
+            return None
+        with _store_lock:
+            if _store is None:
+                flush_interval = getattr(settings, 'LUNA_HEARTBEAT_FLUSH_SECONDS', 5)
+                if path:
+                    _store = MmapStore(path, flush_interval)
+                else:
+                    _store = HeartbeatBuffer(flush_interval,
+                                             getattr(settings, 'LUNA_HEARTBEAT_MAX_STALENESS_SECONDS', 30))
+    return _store
+
+
+def flush_buffer():
+    if _store is not None:
+        _store.flush()
+
+
+def reconcile() -> int:
+    """Lets the database catch up with the heartbeat store before it is searched for overdue ponies"""
+    store = get_store()
+    return store.reconcile() if store is not None else 0
+
+
+def mark_written(ponies: typing.List[Pony], hi_time: datetime.datetime):
+    store = get_store()
+    if store is not None:
+        store.written(ponies, hi_time)
+
+
+def forget(ponies: typing.List[Pony]):
+    store = get_store()
+    if store is not None:
+        store.forget(ponies)
+
+
+@receiver(setting_changed)
+def reset_buffer(setting, **kwargs):
+    global _store
+    if setting.startswith('LUNA_HEARTBEAT_') and _store is not None:
+        _store.stop()
+        _store = None
+
+
+atexit.register(flush_buffer)
@@ -0,0 +1,75 @@
+import base64
+import datetime
+import time
+import typing
+
+from django.db.models import Q
+
+from ..models import Pony, History
+
+PRUNE_BATCH_SIZE = 500
+PAGE_MAX_SIZE = 100
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def prune_before(before: datetime.datetime, batch_size: int = PRUNE_BATCH_SIZE, pause: float = 0) -> int:
+    """Deletes History rows created before the given time, returns the number of rows deleted.
+
+    Rows are deleted by primary key, batch_size at a time and each batch in its own short transaction,
+    so heartbeats writing History rows meanwhile only ever wait for one batch.
+    """
+    #  ids grow with create_time, so the old rows are the ones below the first recent id
+    boundary = History.objects.filter(create_time__gte=before).order_by('id').values_list('id', flat=True).first()
+    old_rows = History.objects.filter(create_time__lt=before)
+    if boundary is not None:
+        old_rows = old_rows.filter(id__lt=boundary)
+    return delete_in_batches(old_rows, batch_size, pause)
+
+
+def prune_orphans(batch_size: int = PRUNE_BATCH_SIZE, pause: float = 0) -> int:
+    """Deletes History rows of removed ponies in batches like prune_before, returns the number of rows deleted"""
+    return delete_in_batches(History.objects.exclude(pony_id__in=Pony.objects.values('id')), batch_size, pause)
+
+
+def delete_in_batches(queryset, batch_size: int, pause: float) -> int:
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += History.objects.filter(id__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+
+def page(pony_id: int, limit: int, cursor: str = None) -> typing.Tuple[typing.List[History], typing.Optional[str]]:
+    """Returns History rows of the pony newest first, and the cursor of the next page or None on the last page.
+
+    The cursor holds create_time and id of the last row, so every page is an index seek on (pony_id, create_time).
+    Raises ValueError for a malformed cursor.
+    """
+    rows = History.objects.filter(pony_id=pony_id)
+    if cursor:
+        create_time, history_id = decode_cursor(cursor)
+        rows = rows.filter(Q(create_time__lt=create_time) | Q(create_time=create_time, id__lt=history_id))
+    rows = list(rows.order_by('-create_time', '-id')[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1])
+
+
+def encode_cursor(history: History) -> str:
+    value = f'{(history.create_time - EPOCH) // datetime.timedelta(microseconds=1)}:{history.id}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> typing.Tuple[datetime.datetime, int]:
+    try:
+        microseconds, history_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return EPOCH + datetime.timedelta(microseconds=int(microseconds)), int(history_id)
+    except (ValueError, UnicodeError, OverflowError) as e:
+        raise ValueError(f'invalid cursor: {cursor}') from e
+
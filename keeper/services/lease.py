@@ -0,0 +1,70 @@
+import datetime
+import logging
+import os
+import socket
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Q, Case, When, F, Value
+from django.utils.timezone import now
+
+from ..models import Lease
+
+LEASE_SECONDS = 300
+
+
+def lease_duration() -> datetime.timedelta:
+    return datetime.timedelta(seconds=getattr(settings, 'LUNA_CHECKER_LEASE_SECONDS', LEASE_SECONDS))
+
+
+def default_owner() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def acquire(name: str, owner: str, duration: datetime.timedelta, current_time: datetime.datetime = None) -> bool:
+    """Takes or renews the lease for `duration`, fails while another owner holds it and it has not expired.
+
+    A single conditional UPDATE decides between competing owners, so it is safe across processes and hosts
+    as long as their clocks agree to well within the duration.
+    """
+    if current_time is None:
+        current_time = now()
+    expire_time = current_time + duration
+    taken = Lease.objects.filter(Q(owner=owner) | Q(expire_time__lte=current_time), name=name).update(
+        owner=owner, expire_time=expire_time,
+        acquire_time=Case(When(owner=owner, then=F('acquire_time')), default=Value(current_time)))
+    if taken:
+        return True
+    try:
+        with transaction.atomic():
+            Lease.objects.create(name=name, owner=owner, expire_time=expire_time, acquire_time=current_time)
+        return True
+    except IntegrityError:
+        #  somebody else holds it, or created it right now
+        return False
+
+
+def release(name: str, owner: str):
+    Lease.objects.filter(name=name, owner=owner).delete()
+
+
+class LeaseHolder:
+    """A named lease of this process, renew() must be called again before the duration runs out"""
+
+    def __init__(self, name: str, duration: datetime.timedelta = None, owner: str = None):
+        self.name = name
+        self.duration = duration if duration is not None else lease_duration()
+        self.owner = owner if owner is not None else default_owner()
+        self.held = False
+
+    def renew(self, current_time: datetime.datetime = None) -> bool:
+        held = acquire(self.name, self.owner, self.duration, current_time)
+        if self.held and not held:
+            logging.warning("lost lease %s, another process took it over", self.name)
+        self.held = held
+        return held
+
+    def release(self):
+        if self.held:
+            release(self.name, self.owner)
+            self.held = False
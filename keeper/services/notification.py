@@ -1,12 +1,23 @@
+import atexit
+import datetime
 import logging
+import threading
+import time
+import typing
+from functools import partial
 
 import django.core.mail as mail
-from typing import Tuple
+from typing import Tuple, List
+from django.conf import settings
+from django.db import transaction
 from django.utils.timezone import now
 
-from ..utils import send_json_request
+from .. import metrics
+from ..utils import send_json_request, run_in_background
 from ..consts import NOTIFY_CHANNEL_SLACK, NOTIFY_CHANNEL_EMAIL
-from ..models import Pony
+from ..models import Pony, Outbox
+
+EMAIL_BATCH_MAX_FAILURES = 5
 
 STATUS_NAME = {
     Pony.STATUS_INIT: 'Just Created',
@@ -15,6 +26,132 @@ STATUS_NAME = {
 }
 
 
+def outbox_enabled() -> bool:
+    return getattr(settings, 'LUNA_NOTIFICATION_OUTBOX', False)
+
+
+def digest_threshold() -> int:
+    return getattr(settings, 'LUNA_DIGEST_THRESHOLD', 5)
+
+
+def digest_window() -> float:
+    return getattr(settings, 'LUNA_DIGEST_WINDOW_SECONDS', 0)
+
+
+def notify_status_changes(changes: List[Tuple[Pony, int, int]], background=True):
+    """Notifies owners about status changes once the current transaction commits.
+
+    Changes going to the same destination are merged into one digest if there are at least LUNA_DIGEST_THRESHOLD
+    of them. With background=True, e.g. for recoveries from hi_pony, they are also held back for
+    LUNA_DIGEST_WINDOW_SECONDS so that changes of other requests can join the digest. Without the outbox they wait
+    in memory and are lost if the process exits before the window ends.
+    With LUNA_NOTIFICATION_OUTBOX on the notifications are written to the outbox within the transaction instead,
+    and sent by the dispatchnotifications command.
+    """
+    messages = []
+    for pony, previous_status, after_status in changes:
+        if previous_status != after_status:
+            title, content = generate_status_change_message(pony, previous_status, after_status)
+            messages.append((title, content, pony.notify_channel, pony.notify_url, pony.id))
+    if not messages:
+        return
+    if outbox_enabled():
+        #  held back messages wait in the outbox, the dispatcher merges what is due together
+        delay = datetime.timedelta(seconds=digest_window()) if background else datetime.timedelta()
+        Outbox.objects.bulk_create([new_outbox_message(*message, delay=delay) for message in digest_messages(messages)],
+                                   batch_size=500)
+    elif background and digest_window() > 0:
+        transaction.on_commit(lambda: [recovery_digest.add(*message[:4], window=digest_window())
+                                       for message in messages])
+    elif background:
+        for message in messages:
+            transaction.on_commit(partial(run_in_background, send_by_channel, *message[:4]))
+    else:
+        transaction.on_commit(lambda: send_messages([message[:4] for message in digest_messages(messages)]))
+
+
+def notify_by_channel(title: str, content: str, channel: str, url: str, pony_id: int = None):
+    """Like notify_status_changes for any message, e.g. lifecycle messages of a pony"""
+    if outbox_enabled():
+        new_outbox_message(title, content, channel, url, pony_id).save()
+    else:
+        transaction.on_commit(partial(run_in_background, send_by_channel, title, content, channel, url))
+
+
+def notify_messages(messages: List[Tuple[str, str, str, str]]):
+    """Like notify_by_channel for many (title, content, channel, url) messages, emails share one SMTP connection"""
+    if not messages:
+        return
+    if outbox_enabled():
+        Outbox.objects.bulk_create([new_outbox_message(*message) for message in messages], batch_size=500)
+    else:
+        transaction.on_commit(partial(run_in_background, send_messages, messages))
+
+
+def new_outbox_message(title: str, content: str, channel: str, url: str, pony_id: int = None,
+                       delay: datetime.timedelta = datetime.timedelta()) -> Outbox:
+    current_time = now()
+    return Outbox(pony_id=pony_id, channel=channel, url=url, title=title[:255], content=content,
+                  next_attempt_time=current_time + delay, create_time=current_time)
+
+
+def digest_messages(messages: List[tuple], threshold: int = None) -> List[tuple]:
+    """Replaces messages like (title, content, channel, url, ...) to the same destination by one digest
+    if there are at least `threshold` of them, the extra fields of a digest are None"""
+    if threshold is None:
+        threshold = digest_threshold()
+    if threshold <= 0:
+        return messages
+    destinations = {}
+    for message in messages:
+        destinations.setdefault((message[2], message[3]), []).append(message)
+    result = []
+    for (channel, url), grouped in destinations.items():
+        if len(grouped) < threshold:
+            result.extend(grouped)
+            continue
+        title, content = generate_digest_message([message[0] for message in grouped])
+        result.append((title, content, channel, url) + (None,) * (len(grouped[0]) - 4))
+    return result
+
+
+def generate_digest_message(titles: List[str]) -> Tuple[str, str]:
+    title = f"{len(titles)} updates about your ponies"
+    content = "\n".join(titles) + f"\ntime: {now()}"
+    return title, content
+
+
+class DigestWindow:
+    """Holds messages back for a short window and sends what piled up per destination, digested if needed"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: List[Tuple[str, str, str, str]] = []
+        self.timer: typing.Optional[threading.Timer] = None
+
+    def add(self, title: str, content: str, channel: str, url: str, window: float):
+        with self.lock:
+            self.pending.append((title, content, channel, url))
+            if self.timer is None:
+                self.timer = threading.Timer(window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self) -> List[bool]:
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not pending:
+            return []
+        return send_messages(digest_messages(pending))
+
+
+recovery_digest = DigestWindow()
+atexit.register(recovery_digest.flush)
+
+
 def send_status_change_notification(pony: Pony, previous_status: int, after_status: int):
     if previous_status == after_status:
         return
@@ -22,6 +159,15 @@ def send_status_change_notification(pony: Pony, previous_status: int, after_stat
     send_by_channel(title, content, pony.notify_channel, pony.notify_url)
 
 
+def send_status_change_notifications(changes: List[Tuple[Pony, int, int]]) -> List[bool]:
+    """Sends many status change notifications at once, digested per destination, emails share one SMTP connection"""
+    messages = []
+    for pony, previous_status, after_status in changes:
+        title, content = generate_status_change_message(pony, previous_status, after_status)
+        messages.append((title, content, pony.notify_channel, pony.notify_url))
+    return send_messages(digest_messages(messages))
+
+
 def generate_status_change_message(pony: Pony, previous_status: int, after_status: int) -> Tuple[str, str]:
     title = f"Your pony {pony.name} just changed it's status"
     if previous_status == Pony.STATUS_INIT and after_status == Pony.STATUS_NORMAL:
@@ -35,13 +181,74 @@ def generate_status_change_message(pony: Pony, previous_status: int, after_statu
 
 
 def send_by_channel(title:str, content: str, channel: str, url: str):
+    start = time.monotonic()
     if channel == NOTIFY_CHANNEL_EMAIL:
-        return send_email(title, content, url)
+        succeeded = send_email(title, content, url)
     elif channel == NOTIFY_CHANNEL_SLACK:
-        return send_slack_notification(title, content, url)
+        succeeded = send_slack_notification(title, content, url)
     else:
         logging.error("unknown channel:%s", locals())
         return False
+    record_sent(channel, succeeded, time.monotonic() - start)
+    return succeeded
+
+
+def record_sent(channel: str, succeeded: bool, seconds: float, count: int = 1):
+    metrics.NOTIFICATIONS.inc(count, channel=channel, result='success' if succeeded else 'failure')
+    metrics.NOTIFICATION_SECONDS.observe(seconds, channel=channel)
+
+
+def send_messages(messages: List[Tuple[str, str, str, str]]) -> List[bool]:
+    """Sends (title, content, channel, url) messages, returns the result of each one in the same order"""
+    results = [False] * len(messages)
+    email_indexes = [i for i, message in enumerate(messages) if message[2] == NOTIFY_CHANNEL_EMAIL]
+    email_results = send_emails([(messages[i][0], messages[i][1], messages[i][3]) for i in email_indexes])
+    for i, result in zip(email_indexes, email_results):
+        results[i] = result
+    for i, (title, content, channel, url) in enumerate(messages):
+        if channel != NOTIFY_CHANNEL_EMAIL:
+            results[i] = send_by_channel(title, content, channel, url)
+    return results
+
+
+def send_emails(emails: List[Tuple[str, str, str]], max_failures: int = EMAIL_BATCH_MAX_FAILURES) -> List[bool]:
+    """Sends (title, content, address) emails over one SMTP connection, returns the result of each one.
+
+    After max_failures failed emails the rest of the batch is given up and reported as failed,
+    so a broken relay costs a few timeouts instead of one per email.
+    """
+    results = [False] * len(emails)
+    if not emails:
+        return results
+    connection = mail.get_connection()
+    failures = 0
+    attempted = 0
+    try:
+        connection.open()
+        for i, (title, content, address) in enumerate(emails):
+            if failures >= max_failures:
+                logging.error("giving up %d emails after %d failures", len(emails) - i, failures)
+                break
+            attempted += 1
+            start = time.monotonic()
+            try:
+                message = mail.EmailMessage(title, content, None, [address], connection=connection)
+                results[i] = message.send() == 1
+                record_sent(NOTIFY_CHANNEL_EMAIL, results[i], time.monotonic() - start)
+            except BaseException as e:
+                logging.error("send email encountered exception", exc_info=e)
+                record_sent(NOTIFY_CHANNEL_EMAIL, False, time.monotonic() - start)
+                failures += 1
+                #  the session may be broken, e.g. the relay hung up on us
+                connection.close()
+                connection.open()
+    except BaseException as e:
+        logging.error("failed to open a mail connection", exc_info=e)
+    finally:
+        connection.close()
+    if attempted < len(emails):
+        metrics.NOTIFICATIONS.inc(len(emails) - attempted, channel=NOTIFY_CHANNEL_EMAIL, result='failure')
+    return results
 
 
 def send_email(title: str, content: str, address: str,) -> bool:
@@ -0,0 +1,63 @@
+import threading
+import typing
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .. import metrics
+from ..models import Pony
+
+#  the cache is keyed on name and passcode hash, so a wrong passcode can never hit another pony's entry
+KEY_PREFIX = 'luna:pony:'
+
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    alias = getattr(settings, 'LUNA_PONY_CACHE', None)
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def make_key(name: str, passcode_hash: str) -> str:
+    return f'{KEY_PREFIX}{name}:{passcode_hash}'
+
+
+def get(name: str, passcode_hash: str) -> typing.Optional[Pony]:
+    cache = get_cache()
+    if cache is None:
+        return None
+    pony = cache.get(make_key(name, passcode_hash))
+    count('hits' if pony is not None else 'misses')
+    return pony
+
+
+def put(pony: Pony):
+    cache = get_cache()
+    if cache is not None:
+        cache.set(make_key(pony.name, pony.passcode), pony)
+
+
+def invalidate(ponies: typing.Iterable[Pony]):
+    """Drops cached entries, the ponies need their name and passcode loaded"""
+    cache = get_cache()
+    if cache is None:
+        return
+    keys = [make_key(pony.name, pony.passcode) for pony in ponies]
+    if keys:
+        cache.delete_many(keys)
+        count('invalidations', len(keys))
+
+
+def count(name: str, value: int = 1):
+    with _stats_lock:
+        _stats[name] += value
+    metrics.PONY_CACHE.inc(value, result=name)
+
+
+def stats() -> typing.Dict[str, int]:
+    """Hit, miss and invalidation counters of this process"""
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,205 @@
+import csv
+import io
+import json
+import typing
+
+from django.core.exceptions import ValidationError
+from django.db import transaction, IntegrityError
+from django.forms import IntegerField, EmailField
+from django.utils.timezone import now
+
+from ..consts import NOTIFY_CHANNEL_EMAIL
+from ..forms import NameField, PasscodeField, NotifyChannelField, NotifyWebUrlField
+from ..models import Pony
+from ..utils import hash_password
+from . import notification, pony_cache, counters
+
+ACTION_CREATE = 'create'
+ACTION_UPDATE = 'update'
+ACTION_DELETE = 'delete'
+ACTIONS = (ACTION_CREATE, ACTION_UPDATE, ACTION_DELETE)
+CSV_COLUMNS = ['action', 'name', 'passcode', 'dark_minute', 'notify_channel', 'notify_url']
+#  keep IN (...) lists below the SQLite variable limit
+BATCH_SIZE = 500
+
+NAME_FIELD = NameField()
+PASSCODE_FIELD = PasscodeField()
+DARK_MINUTE_FIELD = IntegerField(min_value=5, max_value=43200)
+NOTIFY_CHANNEL_FIELD = NotifyChannelField()
+EMAIL_FIELD = EmailField()
+NOTIFY_WEB_URL_FIELD = NotifyWebUrlField()
+
+
+class ProvisioningError(Exception):
+    """Nothing was written, `errors` holds {'index', 'name', 'msg'} for each rejected item"""
+
+    def __init__(self, errors: typing.List[dict]):
+        super().__init__(f'{len(errors)} invalid items, first: {errors[0]["msg"]}')
+        self.errors = errors
+
+
+def clean_settings(params: typing.Mapping, pony: Pony = None) -> typing.Tuple[int, str, str]:
+    """Validated dark_minute, notify_channel and notify_url, those missing from params are taken from `pony`.
+    Raises ValidationError"""
+    dark_minute = pony.dark_minute if pony is not None and 'dark_minute' not in params \
+        else DARK_MINUTE_FIELD.clean(params.get('dark_minute'))
+    notify_channel = pony.notify_channel if pony is not None and 'notify_channel' not in params \
+        else NOTIFY_CHANNEL_FIELD.clean(params.get('notify_channel'))
+    notify_url = pony.notify_url if pony is not None and 'notify_url' not in params else params.get('notify_url')
+    if notify_channel == NOTIFY_CHANNEL_EMAIL:
+        notify_url = EMAIL_FIELD.clean(notify_url)
+    else:
+        notify_url = NOTIFY_WEB_URL_FIELD.clean(notify_url)
+    return dark_minute, notify_channel, notify_url
+
+
+def parse_items(data: str, format: str) -> typing.List[dict]:
+    """Items of a JSON array of objects, or of CSV with a header row of CSV_COLUMNS where empty cells are left out.
+    Raises ValueError"""
+    if format == 'json':
+        items = json.loads(data)
+        if not isinstance(items, list):
+            raise ValueError('JSON must be an array of objects')
+        return items
+    if format == 'csv':
+        reader = csv.DictReader(io.StringIO(data))
+        unknown = set(reader.fieldnames or []) - set(CSV_COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown CSV columns: {', '.join(sorted(unknown))}")
+        return [{key: value for key, value in row.items() if value} for row in reader]
+    raise ValueError(f'unsupported format: {format}')
+
+
+def validate(items: typing.List[dict]) -> typing.List[dict]:
+    """Checks every item with the fields of the single-pony requests before anything is written"""
+    errors = []
+    cleaned = []
+    names = set()
+    for i, item in enumerate(items):
+        name = item.get('name') if isinstance(item, dict) else None
+        try:
+            if not isinstance(item, dict):
+                raise ValidationError('each item must be an object')
+            action = item.get('action', ACTION_CREATE)
+            if action not in ACTIONS:
+                raise ValidationError(f"action must be one of {', '.join(ACTIONS)}")
+            name = NAME_FIELD.clean(name)
+            if name in names:
+                raise ValidationError('pony appears more than once')
+            names.add(name)
+            result = {'index': i, 'action': action, 'name': name,
+                      'passcode': hash_password(PASSCODE_FIELD.clean(item.get('passcode')))}
+            if action == ACTION_CREATE:
+                result['settings'] = clean_settings(item)
+            elif action == ACTION_UPDATE:
+                #  checked against the pony once it is loaded
+                result['params'] = {key: item[key] for key in ('dark_minute', 'notify_channel', 'notify_url')
+                                    if key in item}
+                if 'dark_minute' in item:
+                    DARK_MINUTE_FIELD.clean(item['dark_minute'])
+                if 'notify_channel' in item:
+                    NOTIFY_CHANNEL_FIELD.clean(item['notify_channel'])
+        except ValidationError as e:
+            errors.append({'index': i, 'name': name, 'msg': e.messages[0]})
+            continue
+        cleaned.append(result)
+    if errors:
+        raise ProvisioningError(errors)
+    return cleaned
+
+
+def load_ponies(names: typing.List[str]) -> typing.Dict[str, Pony]:
+    ponies = {}
+    for start in range(0, len(names), BATCH_SIZE):
+        ponies.update((pony.name, pony) for pony in
+                      Pony.objects.select_for_update().filter(name__in=names[start:start + BATCH_SIZE]))
+    return ponies
+
+
+def provision(items: typing.List[dict], dry_run: bool = False) -> dict:
+    """Creates, updates and deletes ponies in one transaction, all of them or none.
+
+    Raises ProvisioningError if any item is invalid, if a pony to create exists or a pony to change
+    doesn't exist or has another passcode. Owners get one summary per destination instead of one message per pony.
+    """
+    cleaned = validate(items)
+    try:
+        with transaction.atomic():
+            return apply(cleaned, dry_run)
+    except IntegrityError:
+        #  created by another request since apply() looked
+        raise ProvisioningError([{'index': None, 'name': None, 'msg': 'pony with same name already exists'}])
+
+
+def apply(cleaned: typing.List[dict], dry_run: bool) -> dict:
+    existing = load_ponies([item['name'] for item in cleaned])
+    errors = []
+    for item in cleaned:
+        pony = existing.get(item['name'])
+        if item['action'] == ACTION_CREATE:
+            if pony is not None:
+                errors.append({'index': item['index'], 'name': item['name'],
+                               'msg': 'pony with same name already exists'})
+        elif pony is None or pony.passcode != item['passcode']:
+            errors.append({'index': item['index'], 'name': item['name'],
+                           'msg': 'failed to find pony,check your name and passcode'})
+        elif item['action'] == ACTION_UPDATE:
+            try:
+                item['settings'] = clean_settings(item['params'], pony)
+            except ValidationError as e:
+                errors.append({'index': item['index'], 'name': item['name'], 'msg': e.messages[0]})
+    if errors:
+        raise ProvisioningError(errors)
+
+    created, updated, deleted = [], [], []
+    #  (channel, url) -> names created and names updated to it
+    destinations: typing.Dict[typing.Tuple[str, str], typing.Tuple[list, list]] = {}
+    current_time = now()
+    for item in cleaned:
+        pony = existing.get(item['name'])
+        if item['action'] == ACTION_CREATE:
+            dark_minute, notify_channel, notify_url = item['settings']
+            created.append(Pony(name=item['name'], passcode=item['passcode'], dark_minute=dark_minute,
+                                notify_channel=notify_channel, notify_url=notify_url, create_time=current_time,
+                                status=Pony.STATUS_INIT))
+            destinations.setdefault((notify_channel, notify_url), ([], []))[0].append(item['name'])
+        elif item['action'] == ACTION_UPDATE:
+            dark_minute, notify_channel, notify_url = item['settings']
+            if (pony.notify_channel, pony.notify_url) != (notify_channel, notify_url):
+                destinations.setdefault((notify_channel, notify_url), ([], []))[1].append(pony.name)
+            pony.dark_minute, pony.notify_channel, pony.notify_url = dark_minute, notify_channel, notify_url
+            pony.refresh_deadline()
+            updated.append(pony)
+        else:
+            deleted.append(pony)
+    result = {'created': [pony.name for pony in created], 'updated': [pony.name for pony in updated],
+              'deleted': [pony.name for pony in deleted]}
+    if dry_run:
+        return result
+
+    Pony.objects.bulk_create(created, batch_size=BATCH_SIZE)
+    Pony.objects.bulk_update(updated, ['dark_minute', 'notify_channel', 'notify_url', 'deadline', 'expected_deadline'],
+                             batch_size=BATCH_SIZE)
+    deleted_ids = [pony.id for pony in deleted]
+    for start in range(0, len(deleted_ids), BATCH_SIZE):
+        Pony.objects.filter(id__in=deleted_ids[start:start + BATCH_SIZE]).delete()
+    deltas = {Pony.STATUS_INIT: len(created)}
+    for pony in deleted:
+        deltas[pony.status] = deltas.get(pony.status, 0) - 1
+    counters.adjust(deltas)
+    changed = updated + deleted
+    if changed:
+        transaction.on_commit(lambda: pony_cache.invalidate(changed))
+    notification.notify_messages([generate_summary_message(*names) + destination
+                                  for destination, names in destinations.items()])
+    return result
+
+
+def generate_summary_message(created: typing.List[str], updated: typing.List[str]) -> typing.Tuple[str, str]:
+    lines = []
+    if created:
+        lines.append(f"created: {', '.join(created)}")
+    if updated:
+        lines.append(f"now notifying here: {', '.join(updated)}")
+    title = f"{len(created) + len(updated)} of your ponies have been provisioned"
+    return title, "\n".join(lines) + f"\ntime: {now()}"
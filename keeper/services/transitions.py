@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import typing
+
+from asgiref.sync import sync_to_async
+from django.db.models import Max
+
+from ..models import Pony, History
+
+LONG_POLL_SECONDS = 25
+#  below the 60 seconds proxies like nginx wait for a response by default
+LONG_POLL_MAX_SECONDS = 55
+POLL_SECONDS = 1
+PAGE_MAX_SIZE = 100
+
+
+def latest_id() -> int:
+    return History.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def since(after_id: int, limit: int, pony_id: int = None) -> typing.List[dict]:
+    """Status changes after the History.id after_id, oldest first, with the name of their pony"""
+    rows = History.objects.filter(id__gt=after_id)
+    if pony_id is not None:
+        rows = rows.filter(pony_id=pony_id)
+    rows = list(rows.order_by('id')[:limit])
+    names = dict(Pony.objects.filter(id__in={row.pony_id for row in rows}).values_list('id', 'name'))
+    return [{'id': row.id, 'pony_id': row.pony_id, 'name': names.get(row.pony_id), 'create_time': row.create_time,
+             'previous_status': row.previous_status, 'current_status': row.current_status} for row in rows]
+
+
+class TransitionWatcher:
+    """Wakes up the long polls of this process once History has rows newer than they have seen.
+
+    While anybody waits, one task per event loop polls the latest History.id every POLL_SECONDS, so the database
+    load doesn't grow with the number of waiting requests and each of them only costs a future. Under WSGI every
+    request runs its own event loop in its own thread, the waiters of a loop are only ever touched by its thread.
+    """
+
+    def __init__(self, poll_interval: float = POLL_SECONDS):
+        self.poll_interval = poll_interval
+        self.latest: typing.Optional[int] = None
+        self.waiters: typing.Dict[asyncio.AbstractEventLoop, typing.List[typing.Tuple[int, asyncio.Future]]] = {}
+        self.tasks: typing.Dict[asyncio.AbstractEventLoop, asyncio.Task] = {}
+
+    async def wait(self, seen_id: int, timeout: float) -> bool:
+        """Waits until there are rows after seen_id, returns False if there are none after timeout seconds"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiters.setdefault(loop, []).append((seen_id, future))
+        if loop not in self.tasks:
+            self.tasks[loop] = loop.create_task(self.run(loop))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = [(waiter_id, waiter) for waiter_id, waiter in self.waiters.get(loop, []) if waiter is not future]
+            if waiters:
+                self.waiters[loop] = waiters
+            else:
+                self.waiters.pop(loop, None)
+
+    async def run(self, loop: asyncio.AbstractEventLoop):
+        try:
+            while self.waiters.get(loop):
+                try:
+                    latest = await sync_to_async(latest_id)()
+                except Exception as e:
+                    logging.error("failed to poll status changes", exc_info=e)
+                else:
+                    #  the poll of another loop may finish later with an older id
+                    self.latest = max(self.latest or 0, latest)
+                    for seen_id, future in self.waiters.get(loop, []):
+                        if latest > seen_id and not future.done():
+                            future.set_result(None)
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            self.tasks.pop(loop, None)
+
+
+watcher = TransitionWatcher()
@@ -1,20 +1,42 @@
+import asyncio
+import contextlib
 import datetime
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
 import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
 from io import StringIO
 from unittest.mock import patch, MagicMock
 import json
+from urllib.parse import urlencode
 
-from django.test import TestCase,Client
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.test import TestCase,TransactionTestCase,Client,AsyncClient,RequestFactory,override_settings
 from django.urls import reverse
 from django.utils.timezone import now
 from django.core import mail
-from django.core.management import call_command
+from django.core.management import call_command, CommandError
+from django.db import connection, connections, close_old_connections, transaction, OperationalError
+from django.core.signals import request_started, request_finished
+from django.test.utils import CaptureQueriesContext
 
-from .services import notification
-from .models import Pony,History
+from .services import notification, checker, heartbeat, pony_cache, dispatcher, availability, lease, counters, \
+    transitions, history
+from .models import Pony,History,Outbox,Availability,Lease
 from .consts import NOTIFY_CHANNEL_EMAIL,NOTIFY_CHANNEL_SLACK
 from .views import check_and_get_pony
-from .utils import hash_password,send_json_request
+from .benchmarks import seed_ponies, clear_pony_cache, BENCHMARK_PASSCODE
+from .utils import hash_password,send_json_request,HttpConnectionPool,HttpError
+from .intervals import IntervalRing,PACKED_SIZE
+from .liveness import LivenessFile,GROW_RECORDS
+from . import metrics, ingress
+from .backends.sqlite3 import base as sqlite_backend
+from luna import checker as luna_checker
 
 
 # Create your tests here.
@@ -39,10 +61,49 @@ def add_testing_pony(name=NEW_TESTING_PONY_NAME, last_hi_time=None, status=Pony.
     )
     if last_hi_time is not None:
         pony.last_hi_time = last_hi_time
+    pony.refresh_deadline()
     pony.save()
     print("Testing Pony added")
 
 
+@contextlib.contextmanager
+def connections_kept_open():
+    """Like the test client, keeps the request signals from closing the connection of the test transaction"""
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        yield
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+
+
+@contextlib.contextmanager
+def tuned_sqlite(path: str, timeout: float = 5):
+    """A keeper.backends.sqlite3 connection to the file as alias 'tuned' of this thread, others need their own"""
+    tuned = sqlite_backend.DatabaseWrapper(dict(connection.settings_dict, ENGINE='keeper.backends.sqlite3', NAME=path,
+                                                OPTIONS={'timeout': timeout}), 'tuned')
+    connections['tuned'] = tuned
+    try:
+        yield tuned
+    finally:
+        tuned.close()
+        del connections['tuned']
+
+
+@contextlib.contextmanager
+def query_params_counted() -> typing.Iterator[typing.List[int]]:
+    """Collects the number of parameters of every query"""
+    counts = []
+
+    def count(execute, sql, params, many, context):
+        counts.append(len(params or ()))
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        yield counts
+
+
 def get_testing_pony(name = NEW_TESTING_PONY_NAME) -> typing.Optional[Pony]:
     try:
         return Pony.objects.get(name=name)
@@ -50,14 +111,80 @@ def get_testing_pony(name = NEW_TESTING_PONY_NAME) -> typing.Optional[Pony]:
         return None
 
 
+class JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    response = b''
+    status = 200
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        JsonHandler.requests.append((self.path, self.headers, body))
+        self.send_response(JsonHandler.status)
+        self.send_header('Content-Length', str(len(JsonHandler.response)))
+        self.end_headers()
+        self.wfile.write(JsonHandler.response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SmtpHandler(StreamRequestHandler):
+    """Just enough SMTP to count sessions and messages, rejects recipients listed in `rejected`"""
+    sessions = 0
+    messages = []
+    rejected = set()
+
+    def handle(self):
+        SmtpHandler.sessions += 1
+        self.wfile.write(b'220 luna test smtp\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith('RCPT TO') and any(address.upper() in command for address in SmtpHandler.rejected):
+                self.wfile.write(b'550 no such user\r\n')
+            elif command == 'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                data = b''
+                while not data.endswith(b'\r\n.\r\n'):
+                    data += self.rfile.readline()
+                SmtpHandler.messages.append(data)
+                self.wfile.write(b'250 ok\r\n')
+            elif command == 'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
 class KeeperTest (TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.http_server = ThreadingHTTPServer(('127.0.0.1', 0), JsonHandler)
+        threading.Thread(target=cls.http_server.serve_forever, daemon=True).start()
+        cls.smtp_server = ThreadingTCPServer(('127.0.0.1', 0), SmtpHandler)
+        cls.smtp_server.daemon_threads = True
+        threading.Thread(target=cls.smtp_server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.http_server.shutdown()
+        cls.http_server.server_close()
+        cls.smtp_server.shutdown()
+        cls.smtp_server.server_close()
+        super().tearDownClass()
+
     @classmethod
     def setUpTestData(cls):
         add_testing_pony()
 
     def setUp(self) -> None:
-        pass
+        clear_pony_cache()
+        JsonHandler.status = 200
 
     def test_getting_test_pony(self):
         pony = get_testing_pony(NEW_TESTING_PONY_NAME)
@@ -82,6 +209,24 @@ class KeeperTest (TestCase):
             ret = notification.send_by_channel('Failed Title', "This is a failed notifiction", NOTIFY_CHANNEL_EMAIL, "luna")
             self.assertFalse(ret)
 
+    def test_send_emails_over_one_connection(self):
+        SmtpHandler.sessions, SmtpHandler.messages = 0, []
+        SmtpHandler.rejected = {'nobody@equestria.org'}
+        emails = [('title', 'content', f'luna{i}@equestria.org') for i in range(10)]
+        emails[3] = ('title', 'content', 'nobody@equestria.org')
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.smtp_server.server_address[1]):
+            results = notification.send_emails(emails)
+            self.assertEqual([True] * 3 + [False] + [True] * 6, results)
+            self.assertEqual(9, len(SmtpHandler.messages))
+            #  one session, and a new one after the refused recipient
+            self.assertEqual(2, SmtpHandler.sessions)
+
+            SmtpHandler.sessions, SmtpHandler.messages = 0, []
+            results = notification.send_emails([('title', 'content', 'nobody@equestria.org')] * 10, max_failures=2)
+            self.assertEqual([False] * 10, results)
+            self.assertEqual(3, SmtpHandler.sessions)
+
     def test_send_unknown(self):
         ret = notification.send_by_channel('Hello, Title', 'This is a test notification', 'unknown', 'unknown url')
         self.assertFalse(ret)
@@ -109,27 +254,48 @@ class KeeperTest (TestCase):
         pony = check_and_get_pony('wrong name', TESTING_PONY_PASSCODE)
         self.assertIsNone(pony)
 
-    @patch(__package__ + '.utils.request.urlopen')
-    def test_send_http_json_request(self, urlopen_mock: MagicMock):
-        url = 'https://jsonurl'
+    def test_send_http_json_request(self):
+        url = f'http://127.0.0.1:{self.http_server.server_port}/jsonurl'
         param_dict = {'k': 'v'}
         response_str = '{"ret":0}'
         response_dict = json.loads(response_str)
-        response_mock = MagicMock()
-        response_mock.read.return_value = response_str.encode('utf-8')
-        urlopen_mock.return_value = response_mock
+        JsonHandler.response = response_str.encode('utf-8')
 
         ret = send_json_request(url, param_dict, True)
-        call_args = urlopen_mock.call_args
-        request = call_args[0][0]
-        self.assertEqual(url, request.full_url)
-        self.assertEqual(json.dumps(param_dict).encode('utf-8'), request.data)
-        self.assertEquals(request.headers.get('Content-type'), 'application/json')
+        path, headers, body = JsonHandler.requests[-1]
+        self.assertEqual('/jsonurl', path)
+        self.assertEqual(json.dumps(param_dict).encode('utf-8'), body)
+        self.assertEquals(headers.get('Content-type'), 'application/json')
         self.assertDictEqual(response_dict, ret)
 
         ret = send_json_request(url, param_dict, False)
         self.assertEqual(response_str, ret)
 
+    def test_http_pool(self):
+        pool = HttpConnectionPool(max_response_bytes=100)
+        url = f'http://127.0.0.1:{self.http_server.server_port}/slack'
+        JsonHandler.response = b'ok'
+        for i in range(20):
+            self.assertEqual((200, b'ok'), pool.request('POST', url, b'{}'))
+        self.assertEqual(1, pool.connections_opened)
+        JsonHandler.response = b'x' * 101
+        with self.assertRaises(HttpError):
+            pool.request('POST', url, b'{}')
+        JsonHandler.response = b'ok'
+        JsonHandler.status = 500
+        with self.assertRaises(HttpError):
+            pool.request('POST', url, b'{}')
+        pool.close()
+
+
+def record_worker_metrics(left_behind: typing.Dict[str, float] = None):
+    if left_behind is not None:
+        #  by an exited process whose pid this one got
+        with open(os.path.join(settings.LUNA_METRICS_DIR, f'luna_{os.getpid()}.metrics'), 'wb') as f:
+            f.write(metrics.encode_entries(left_behind))
+    metrics.NOTIFICATIONS.inc(channel=NOTIFY_CHANNEL_SLACK, result='failure')
+    metrics.BACKGROUND_QUEUE.set(5)
+
 
 class ClientTest (TestCase):
 
@@ -138,8 +304,12 @@ class ClientTest (TestCase):
         add_testing_pony()
 
     def setUp(self) -> None:
+        clear_pony_cache()
         self.client = Client()
 
+    def tearDown(self) -> None:
+        notification.recovery_digest.flush()
+
     def test_index_page(self):
         response = self.client.get("/")
         self.assertEqual(response.status_code, 200)
@@ -220,6 +390,7 @@ class ClientTest (TestCase):
         self.assertEqual(Pony.STATUS_NORMAL, pony.status)
         self.assertIsNotNone(pony.last_hi_time)
         self.assertTrue(20 > (now() - pony.last_hi_time).total_seconds() >= 0)
+        self.assertEqual(pony.last_hi_time + datetime.timedelta(minutes=pony.dark_minute), pony.deadline)
         #  check history
         histories = History.objects.filter(pony_id=pony.id).order_by('-id')[:1]
         self.assertEqual(1, histories.count())
@@ -228,6 +399,182 @@ class ClientTest (TestCase):
         self.assertEqual(Pony.STATUS_NORMAL, history.current_status)
         self.assertTrue(20 > (now() - history.create_time).total_seconds() >= 0)
 
+    def test_pony_history(self):
+        pony = get_testing_pony()
+        create_time = now()
+        History.objects.bulk_create([
+            History(pony_id=pony.id, previous_status=Pony.STATUS_NORMAL, current_status=Pony.STATUS_MISSING,
+                    create_time=create_time - datetime.timedelta(minutes=i // 2)) for i in range(5)
+        ])
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE, 'limit': 2}
+        ids = []
+        while True:
+            response_json = self.client.get(reverse('history_pony'), params).json()
+            self.assertEqual(0, response_json['code'])
+            ids.extend(row['id'] for row in response_json['data']['history'])
+            if response_json['data']['next_cursor'] is None:
+                break
+            params['cursor'] = response_json['data']['next_cursor']
+        expected = History.objects.filter(pony_id=pony.id).order_by('-create_time', '-id')
+        self.assertEqual([history.id for history in expected], ids)
+
+        params['cursor'] = 'nope'
+        self.assertEqual(1, self.client.get(reverse('history_pony'), params).json()['code'])
+        params['passcode'] = 'wrong pass'
+        self.assertEqual(1, self.client.get(reverse('history_pony'), params).json()['code'])
+
+    def test_prune_history_command(self):
+        pony = get_testing_pony()
+        current_time = now()
+        History.objects.bulk_create([
+            History(pony_id=pony_id, previous_status=Pony.STATUS_NORMAL, current_status=Pony.STATUS_MISSING,
+                    create_time=current_time - datetime.timedelta(days=days))
+            for pony_id, days in [(pony.id, 200), (pony.id, 190), (pony.id, 1), (pony.id + 1000, 1)]
+        ])
+        out = StringIO()
+        call_command('prunehistory', '--batch-size', '1', stdout=out)
+        self.assertIn('older than 180 days 2 ,of removed ponies 1', out.getvalue())
+        self.assertEqual([pony.id], list(History.objects.values_list('pony_id', flat=True)))
+
+        #  the retention cutoff seeks an index instead of scanning the history of every pony
+        self.assertIn('USING INDEX keeper_hist_create_',
+                      History.objects.filter(create_time__lt=current_time).explain())
+        #  orphans are found by one subquery, not by loading every pony_id
+        History.objects.bulk_create([History(pony_id=pony.id + 1000 + i, previous_status=Pony.STATUS_NORMAL,
+                                             current_status=Pony.STATUS_MISSING, create_time=current_time)
+                                     for i in range(3)])
+        with self.assertNumQueries(2):
+            self.assertEqual(3, history.prune_orphans())
+        self.assertEqual([pony.id], list(History.objects.values_list('pony_id', flat=True)))
+
+    def test_uptime(self):
+        current_time = now()
+        add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=current_time - datetime.timedelta(days=1),
+                         status=Pony.STATUS_NORMAL)
+        Pony.objects.filter(name=MISSING_PONY_NAME).update(rollup_time=current_time - datetime.timedelta(hours=2))
+        checker.check_ponies(current_time=current_time)
+        rollups = Availability.objects.filter(pony_id=get_testing_pony(MISSING_PONY_NAME).id)
+        self.assertEqual([7200, 0, 1], [sum(getattr(row, field) for row in rollups)
+                                        for field in ('normal_seconds', 'missing_seconds', 'transitions')])
+
+        #  the end-of-day job adds the time in the current status
+        self.assertEqual(1, availability.close_day(current_time + datetime.timedelta(hours=1)))
+        self.assertEqual(0, availability.close_day(current_time + datetime.timedelta(hours=1)))
+        pony = get_testing_pony(MISSING_PONY_NAME)
+        figures = availability.uptime(pony, current_time + datetime.timedelta(hours=1))
+        self.assertEqual([7, 30, 90], [figure['days'] for figure in figures])
+        self.assertEqual({'days': 7, 'normal_seconds': 7200, 'missing_seconds': 3600, 'transitions': 1,
+                          'availability': 2 / 3}, figures[0])
+
+        self.client.get(reverse('hi_pony'), {'name': MISSING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE})
+        response_json = self.client.get(reverse('uptime_pony'), {'name': MISSING_PONY_NAME,
+                                                                 'passcode': TESTING_PONY_PASSCODE}).json()
+        self.assertEqual(0, response_json['code'])
+        self.assertEqual(2, response_json['data'][2]['transitions'])
+        self.assertEqual([(datetime.date(2026, 1, 1), 3600), (datetime.date(2026, 1, 2), 1800)], availability.split_by_day(
+            datetime.datetime(2026, 1, 1, 23, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2026, 1, 2, 0, 30, tzinfo=datetime.timezone.utc)))
+
+    def test_hi_intervals(self):
+        ring = IntervalRing()
+        for seconds in range(1, 41):
+            ring.add(seconds)
+        ring = IntervalRing(ring.to_bytes())
+        self.assertEqual(PACKED_SIZE, len(ring.to_bytes()))
+        self.assertEqual({'count': 32, 'mean': 24.5, 'variance': 85.25, 'p95': 39}, ring.summary())
+
+        add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=now() - datetime.timedelta(seconds=60),
+                         status=Pony.STATUS_NORMAL)
+        params = {'name': MISSING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.get(reverse('hi_pony'), params)
+        summary = self.client.get(reverse('get_pony'), params).json()['data']['hi_intervals']
+        self.assertEqual(2, summary['count'])
+        self.assertAlmostEqual(30, summary['mean'], delta=1)
+
+        #  a copy cached before another worker's hi continues the cadence from the database without a retry
+        stale = get_testing_pony(MISSING_PONY_NAME)
+        Pony.objects.filter(id=stale.id).update(last_hi_time=now() - datetime.timedelta(seconds=10))
+        with patch.object(Pony, 'refresh_from_db') as refresh_from_db:
+            self.assertEqual((Pony.STATUS_NORMAL, Pony.STATUS_NORMAL), heartbeat.record_hi(stale, deferrable=False))
+        refresh_from_db.assert_not_called()
+        pony = get_testing_pony(MISSING_PONY_NAME)
+        #  about 60, 0 and 10 seconds, the interval since the stale copy's last hi would be about 0
+        self.assertEqual(3, pony.interval_summary()['count'])
+        self.assertAlmostEqual(70 / 3, pony.interval_summary()['mean'], delta=1)
+
+        with override_settings(LUNA_HEARTBEAT_BUFFER=True, LUNA_HEARTBEAT_FLUSH_SECONDS=240,
+                               LUNA_HEARTBEAT_MAX_STALENESS_SECONDS=300):
+            for _ in range(2):
+                self.client.get(reverse('hi_pony'), params)
+            self.assertEqual(1, heartbeat.get_store().flush())
+        self.assertEqual(5, get_testing_pony(MISSING_PONY_NAME).interval_summary()['count'])
+
+    def test_adaptive_check(self):
+        start_time = now() - datetime.timedelta(seconds=660)
+        add_testing_pony(name=MISSING_PONY_NAME, status=Pony.STATUS_NORMAL)
+        pony = get_testing_pony(MISSING_PONY_NAME)
+        hi_times = [start_time + datetime.timedelta(seconds=60 * i) for i in range(1, 11)]
+        for field, value in heartbeat.next_cadence(heartbeat.cadence_of(pony), start_time, hi_times).items():
+            setattr(pony, field, value)
+        pony.last_hi_time = hi_times[-1]
+        pony.refresh_deadline()
+        pony.save()
+        #  three missed beats of a pony saying hi every minute, well before its dark_minute
+        self.assertEqual(pony.last_hi_time + datetime.timedelta(seconds=180), pony.expected_deadline)
+        current_time = pony.last_hi_time + datetime.timedelta(seconds=200)
+        self.assertEqual([], checker.check_ponies(dry_run=True, current_time=current_time))
+        self.assertEqual([MISSING_PONY_NAME], [pony.name for pony in
+                                               checker.check_ponies(dry_run=True, current_time=current_time,
+                                                                    adaptive=True)])
+
+        self.client.get(reverse('hi_pony'), {'name': MISSING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE})
+        pony = get_testing_pony(MISSING_PONY_NAME)
+        self.assertAlmostEqual(60, pony.cadence_mean, delta=1)
+        self.assertAlmostEqual(180, (pony.expected_deadline - pony.last_hi_time).total_seconds(), delta=5)
+        self.assertLessEqual(pony.expected_deadline, pony.deadline)
+        with self.captureOnCommitCallbacks(execute=True):
+            checker.check_ponies(current_time=pony.last_hi_time + datetime.timedelta(seconds=200), adaptive=True)
+        self.assertIsNone(get_testing_pony(MISSING_PONY_NAME).expected_deadline)
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(LUNA_METRICS_DIR=directory):
+            params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+            self.client.get(reverse('hi_pony'), params)
+            self.client.get(reverse('get_pony'), params)
+            checker.check_ponies()
+            #  a worker which has exited, its counters still count but its gauges don't
+            worker = multiprocessing.get_context('fork').Process(target=record_worker_metrics)
+            worker.start()
+            worker.join()
+            self.assertEqual(2, len(os.listdir(directory)))
+
+            response = self.client.get(reverse('metrics'))
+            self.assertEqual(200, response.status_code)
+            lines = response.content.decode().splitlines()
+            self.assertIn('# TYPE luna_request_duration_seconds histogram', lines)
+            self.assertIn('luna_request_duration_seconds_count{view="hi_pony"} 1', lines)
+            self.assertIn('luna_request_duration_seconds_bucket{view="get_pony",le="+Inf"} 1', lines)
+            self.assertIn('luna_checker_sweep_duration_seconds_count 1', lines)
+            self.assertIn('luna_notifications_total{channel="SLACK",result="failure"} 1', lines)
+            self.assertNotIn('luna_background_queue_depth 5', lines)
+            queries = [line for line in lines if line.startswith('luna_request_queries_sum{view="hi_pony"}')]
+            self.assertNotEqual(['luna_request_queries_sum{view="hi_pony"} 0'], queries)
+
+            #  the file of the exited worker was folded into the aggregate, a new worker reusing a pid keeps
+            #  the samples of the file it finds
+            self.assertNotIn(f'luna_{worker.pid}.metrics', os.listdir(directory))
+            self.assertIn('luna_aggregate.metrics', os.listdir(directory))
+            key = 'luna_notifications_total{channel="SLACK",result="failure"}'
+            worker = multiprocessing.get_context('fork').Process(target=record_worker_metrics, args=({key: 2},))
+            worker.start()
+            worker.join()
+            lines = self.client.get(reverse('metrics')).content.decode().splitlines()
+            self.assertIn(f'{key} 4', lines)
+            self.assertEqual({f'luna_{os.getpid()}.metrics', 'luna_aggregate.metrics', 'luna.lock'},
+                             set(os.listdir(directory)))
+
     def test_get_pony(self):
         response = self.client.get(reverse('get_pony'), {
                                     'name': NEW_TESTING_PONY_NAME,
@@ -265,6 +612,22 @@ class ClientTest (TestCase):
         response_json = response.json()
         self.assertEqual(1, response_json['code'])
 
+    def test_deadline_follows_dark_minute(self):
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        self.client.get(reverse('hi_pony'), params)
+        self.client.get(reverse('change_pony'), dict(params, dark_minute=30))
+        pony = get_testing_pony()
+        self.assertEqual(pony.last_hi_time + datetime.timedelta(minutes=30), pony.deadline)
+
+        #  a copy read before the checker marked the pony missing doesn't bring the normal status back
+        stale = get_testing_pony()
+        checker.mark_pony_missing(get_testing_pony())
+        with patch('keeper.views.check_pony_or_response', return_value=stale):
+            self.assertEqual(0, self.client.get(reverse('change_pony'), dict(params, dark_minute=20)).json()['code'])
+        pony = get_testing_pony()
+        self.assertEqual((Pony.STATUS_MISSING, 20, None), (pony.status, pony.dark_minute, pony.deadline))
+        self.assertEqual(1, counters.counts()[Pony.STATUS_MISSING])
+
     def test_remove_pony(self):
         response = self.client.get(reverse('remove_pony'), {
                                     'name': NEW_TESTING_PONY_NAME,
@@ -276,10 +639,106 @@ class ClientTest (TestCase):
         pony = get_testing_pony()
         self.assertIsNone(pony)
 
+    @override_settings(LUNA_NOTIFICATION_OUTBOX=True)
+    def test_bulk_pony(self):
+        new_pony = {'passcode': TESTING_PONY_PASSCODE, 'dark_minute': 10, 'notify_channel': NOTIFY_CHANNEL_EMAIL,
+                    'notify_url': 'twilight@equestria.org'}
+        items = [dict(new_pony, name=f'{MISSING_PONY_NAME}_{i}') for i in range(3)] + [
+            {'action': 'update', 'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE, 'dark_minute': 20}]
+        response = self.client.post(reverse('bulk_pony'), json.dumps(items), content_type='application/json')
+        response_json = response.json()
+        self.assertEqual(0, response_json['code'], response_json['msg'])
+        self.assertEqual([f'{MISSING_PONY_NAME}_{i}' for i in range(3)], response_json['data']['created'])
+        self.assertEqual(3, Pony.objects.filter(name__startswith=MISSING_PONY_NAME, dark_minute=10).count())
+        self.assertEqual(20, get_testing_pony().dark_minute)
+        #  one summary for the new destination, none for the unchanged one
+        self.assertEqual(['twilight@equestria.org'], [message.url for message in Outbox.objects.all()])
+
+        #  one bad item and nothing is written
+        items = [{'action': 'delete', 'name': f'{MISSING_PONY_NAME}_0', 'passcode': TESTING_PONY_PASSCODE},
+                 dict(new_pony, name=NEW_TESTING_PONY_NAME),
+                 {'action': 'update', 'name': f'{MISSING_PONY_NAME}_1', 'passcode': 'wrong', 'dark_minute': 30},
+                 dict(new_pony, name='x')]
+        response_json = self.client.post(reverse('bulk_pony'), json.dumps(items),
+                                         content_type='application/json').json()
+        self.assertEqual(1, response_json['code'])
+        self.assertEqual([3], [error['index'] for error in response_json['data']])
+        self.assertIsNotNone(get_testing_pony(f'{MISSING_PONY_NAME}_0'))
+        items[3]['name'] = 'sunset01'
+        response_json = self.client.post(reverse('bulk_pony'), json.dumps(items),
+                                         content_type='application/json').json()
+        self.assertEqual([1, 2], [error['index'] for error in response_json['data']])
+        self.assertIsNone(get_testing_pony('sunset01'))
+
+        csv_body = (f'action,name,passcode,dark_minute,notify_channel,notify_url\n'
+                    f'delete,{MISSING_PONY_NAME}_0,{TESTING_PONY_PASSCODE},,,\n'
+                    f'update,{MISSING_PONY_NAME}_1,{TESTING_PONY_PASSCODE},30,,\n')
+        response_json = self.client.post(reverse('bulk_pony'), csv_body, content_type='text/csv').json()
+        self.assertEqual(0, response_json['code'], response_json['msg'])
+        self.assertIsNone(get_testing_pony(f'{MISSING_PONY_NAME}_0'))
+        self.assertEqual(30, get_testing_pony(f'{MISSING_PONY_NAME}_1').dark_minute)
+
+    def test_provision_ponies_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ponies.csv')
+            with open(path, 'w') as f:
+                f.write('name,passcode,dark_minute,notify_channel,notify_url\n')
+                for i in range(3):
+                    f.write(f'{MISSING_PONY_NAME}_{i},{TESTING_PONY_PASSCODE},5,{NOTIFY_CHANNEL_EMAIL},'
+                            f'twilight@equestria.org\n')
+            out = StringIO()
+            call_command('provisionponies', path, '--dry-run', stdout=out)
+            self.assertIn('would have created 3', out.getvalue())
+            self.assertIsNone(get_testing_pony(f'{MISSING_PONY_NAME}_0'))
+
+            mail.outbox = []
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('provisionponies', path, stdout=out)
+            self.assertEqual(3, Pony.objects.filter(name__startswith=MISSING_PONY_NAME).count())
+            #  the notification is sent by a background thread
+            for _ in range(50):
+                if mail.outbox:
+                    break
+                threading.Event().wait(0.1)
+            self.assertEqual(['3 of your ponies have been provisioned'], [message.subject for message in mail.outbox])
+
+            with self.assertRaises(CommandError):
+                call_command('provisionponies', path, stdout=out, stderr=StringIO())
+
+    def test_status_counts(self):
+        #  the testing pony was saved without counting it
+        self.assertEqual({Pony.STATUS_INIT: 1}, counters.reconcile())
+        self.assertEqual({}, counters.reconcile())
+        expected = {'init': 1, 'normal': 0, 'missing': 0, 'total': 1}
+        self.assertEqual(expected, self.client.get(reverse('overview_pony')).json()['data'])
+
+        response_json = self.client.post(reverse('add_pony'), {
+            'name': MISSING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE, 'dark_minute': 5,
+            'notify_channel': NOTIFY_CHANNEL_EMAIL, 'notify_url': 'luna@equestria.org'}).json()
+        self.assertEqual(0, response_json['code'], response_json['msg'])
+        for name in (NEW_TESTING_PONY_NAME, MISSING_PONY_NAME):
+            self.client.get(reverse('hi_pony'), {'name': name, 'passcode': TESTING_PONY_PASSCODE})
+        Pony.objects.filter(name=MISSING_PONY_NAME).update(deadline=now() - datetime.timedelta(days=1))
+        checker.check_ponies()
+        self.client.get(reverse('remove_pony'), {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE})
+        expected = {'init': 0, 'normal': 0, 'missing': 1, 'total': 1}
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, self.client.get(reverse('overview_pony')).json()['data'])
+        self.assertIn(b'Luna is watching 1 ponies', self.client.get(reverse('index')).content)
+        self.assertEqual({}, counters.reconcile())
+
+        #  drift is repaired
+        Pony.objects.filter(name=MISSING_PONY_NAME).update(status=Pony.STATUS_NORMAL)
+        out = StringIO()
+        call_command('reconcilecounts', stdout=out)
+        self.assertIn('drift Normal +1 ,Missing -1', out.getvalue())
+        self.assertEqual({Pony.STATUS_INIT: 0, Pony.STATUS_NORMAL: 1, Pony.STATUS_MISSING: 0}, counters.counts())
+
     def test_check_pony_command(self):
         add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=now() - datetime.timedelta(days=1), status=Pony.STATUS_NORMAL)
         out = StringIO()
-        call_command('checkpony', stdout=out)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('checkpony', stdout=out)
         self.assertIn('start checking', out.getvalue())
         self.assertIn('finished checking', out.getvalue())
 
@@ -288,6 +747,7 @@ class ClientTest (TestCase):
 
         missing_pony = get_testing_pony(MISSING_PONY_NAME)
         self.assertEqual(Pony.STATUS_MISSING, missing_pony.status)
+        self.assertIsNone(missing_pony.deadline)
         history = History.objects.order_by('-id').filter(pony_id=missing_pony.id)[0]
         self.assertIsNotNone(history)
         self.assertEquals(Pony.STATUS_NORMAL, history.previous_status)
@@ -300,5 +760,559 @@ class ClientTest (TestCase):
                 break
         self.assertTrue(has_missing_email)
 
+    def test_fast_checker_entry_point(self):
+        add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=now() - datetime.timedelta(days=1), status=Pony.STATUS_NORMAL)
+        with patch('sys.stdout', new_callable=StringIO) as out:
+            luna_checker.main(['--dry-run'])
+        self.assertIn('missing 1', out.getvalue())
+        self.assertEqual(Pony.STATUS_NORMAL, get_testing_pony(MISSING_PONY_NAME).status)
+
+    def test_check_pony_command_bulk(self):
+        for i in range(20):
+            add_testing_pony(name=f'{MISSING_PONY_NAME}_{i}', last_hi_time=now() - datetime.timedelta(days=1),
+                             status=Pony.STATUS_NORMAL)
+        add_testing_pony(name='dali_alive', last_hi_time=now(), status=Pony.STATUS_NORMAL)
+        counters.reconcile()
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks() as callbacks:
+            missing_ponies = checker.check_ponies()
+        self.assertEqual(20, len(missing_ponies))
+        #  one select, one update, inserts of history and rollups and two counter updates
+        #  no matter how many ponies are missing
+        self.assertEqual(7, len([q for q in queries if 'SAVEPOINT' not in q['sql']]))
+        self.assertEqual(2, len(callbacks))
+        self.assertEqual(20, Pony.objects.filter(status=Pony.STATUS_MISSING).count())
+        self.assertEqual(Pony.STATUS_NORMAL, get_testing_pony('dali_alive').status)
+        self.assertEqual(20, History.objects.filter(current_status=Pony.STATUS_MISSING).count())
+
+    def test_checker_daemon(self):
+        current_time = now()
+        add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=current_time - datetime.timedelta(minutes=4, seconds=50),
+                         status=Pony.STATUS_NORMAL)
+        daemon = checker.CheckerDaemon(grace=datetime.timedelta(seconds=5),
+                                       refresh_interval=datetime.timedelta(seconds=60))
+        missing_ponies, sleep_seconds = daemon.run_once(current_time)
+        self.assertEqual([], missing_ponies)
+        #  wake up right after deadline + grace instead of waiting for the refresh
+        self.assertAlmostEqual(15, sleep_seconds, delta=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            missing_ponies, sleep_seconds = daemon.run_once(current_time + datetime.timedelta(seconds=16))
+        self.assertEqual([MISSING_PONY_NAME], [pony.name for pony in missing_ponies])
+        self.assertEqual(Pony.STATUS_MISSING, get_testing_pony(MISSING_PONY_NAME).status)
+        self.assertAlmostEqual(44, sleep_seconds, delta=1)
+
+    def test_sharded_check(self):
+        for i in range(6):
+            add_testing_pony(name=f'{MISSING_PONY_NAME}_{i}', last_hi_time=now() - datetime.timedelta(days=1),
+                             status=Pony.STATUS_NORMAL)
+        with self.captureOnCommitCallbacks(execute=True):
+            first = checker.check_ponies(shard=(1, 2))
+            second = checker.check_ponies(shard=(2, 2))
+        self.assertEqual({0}, {pony.id % 2 for pony in first})
+        self.assertEqual({1}, {pony.id % 2 for pony in second})
+        self.assertEqual(6, len(first) + len(second))
+        self.assertEqual((2, 4), checker.parse_shard('2/4'))
+        with self.assertRaises(ValueError):
+            checker.parse_shard('5/4')
+        with self.assertRaises(CommandError):
+            call_command('checkpony', '--shard', '0/2', stdout=StringIO())
+
+    def test_checker_lease(self):
+        add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=now() - datetime.timedelta(days=1),
+                         status=Pony.STATUS_NORMAL)
+        duration = datetime.timedelta(seconds=60)
+        holder = lease.LeaseHolder('checkpony', duration, owner='node-a')
+        self.assertTrue(holder.renew())
+        self.assertTrue(holder.renew())
+        self.assertFalse(lease.acquire('checkpony', 'node-b', duration))
+        out = StringIO()
+        call_command('checkpony', stdout=out)
+        self.assertIn('held by another checker', out.getvalue())
+        self.assertEqual(Pony.STATUS_NORMAL, get_testing_pony(MISSING_PONY_NAME).status)
+
+        #  node-a stopped renewing, node-b takes over and node-a may no longer change anything
+        self.assertTrue(lease.acquire('checkpony', 'node-b', duration, now() + datetime.timedelta(seconds=61)))
+        self.assertEqual([], checker.check_ponies(lease=holder))
+        self.assertEqual(Pony.STATUS_NORMAL, get_testing_pony(MISSING_PONY_NAME).status)
+        holder.release()
+        self.assertTrue(Lease.objects.filter(name='checkpony', owner='node-b').exists())
+
+        lease.release('checkpony', 'node-b')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('checkpony', stdout=out)
+        self.assertEqual(Pony.STATUS_MISSING, get_testing_pony(MISSING_PONY_NAME).status)
+        self.assertFalse(Lease.objects.exists())
+
+    @override_settings(LUNA_HEARTBEAT_BUFFER=True, LUNA_HEARTBEAT_FLUSH_SECONDS=240,
+                       LUNA_HEARTBEAT_MAX_STALENESS_SECONDS=300, LUNA_PONY_CACHE='ponies')
+    def test_buffered_hi(self):
+        class NoFlushStore(heartbeat.HeartbeatStore):
+            def add(self, pony, hi_time):
+                return True
+
+        #  a store missing a method fails before it takes any heartbeat
+        with self.assertRaises(TypeError):
+            NoFlushStore(1, 1)
+
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        #  the first hi is a status transition and written right away
+        self.client.get(reverse('hi_pony'), params)
+        first_hi_time = get_testing_pony().last_hi_time
+        self.assertIsNotNone(first_hi_time)
+
+        response_json = self.client.get(reverse('hi_pony'), params).json()
+        self.assertEqual({'previous': Pony.STATUS_NORMAL, 'current': Pony.STATUS_NORMAL}, response_json['data'])
+        self.assertEqual(first_hi_time, get_testing_pony().last_hi_time)
+        self.assertEqual(1, heartbeat.get_store().flush())
+        pony = get_testing_pony()
+        self.assertGreater(pony.last_hi_time, first_hi_time)
+        self.assertEqual(pony.last_hi_time + datetime.timedelta(minutes=pony.dark_minute), pony.deadline)
+        self.assertEqual(1, History.objects.filter(pony_id=pony.id).count())
+        self.assertEqual(datetime.timedelta(seconds=300), heartbeat.staleness_allowance())
+
+        #  the checker of another process marked the pony missing, this process still has it cached as normal
+        pony_cache.put(pony)
+        Pony.objects.filter(id=pony.id).update(status=Pony.STATUS_MISSING, deadline=None)
+        counters.reconcile()
+        self.client.get(reverse('hi_pony'), params)
+        hi_time = heartbeat.get_store().pending[pony.id][1][-1]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(1, heartbeat.get_store().flush())
+        pony = get_testing_pony()
+        self.assertEqual((Pony.STATUS_NORMAL, hi_time), (pony.status, pony.last_hi_time))
+        self.assertEqual((Pony.STATUS_MISSING, Pony.STATUS_NORMAL),
+                         History.objects.filter(pony_id=pony.id).values_list('previous_status', 'current_status')
+                         .latest('id'))
+        self.assertEqual(0, counters.counts()[Pony.STATUS_MISSING])
+
+    @patch.object(connection.features, 'max_query_params', 999)
+    def test_heartbeat_batches_fit_query_params(self):
+        #  SQLite before 3.32 allows 999 parameters per query, the ponies have a known cadence after 9 heartbeats
+        ids = list(Pony.objects.filter(name__in=seed_ponies(300, prefix='batch')).values_list('id', flat=True))
+        current_time = now()
+        pending = {pony_id: [current_time + datetime.timedelta(seconds=i) for i in range(9)] for pony_id in ids}
+        with query_params_counted() as counts:
+            self.assertEqual((300, set()), heartbeat.write_heartbeats(pending))
+        self.assertLessEqual(max(counts), 999)
+        pony = Pony.objects.get(id=ids[-1])
+        self.assertIsNotNone(pony.expected_deadline)
+        self.assertEqual(current_time + datetime.timedelta(seconds=8), pony.last_hi_time)
+
+        #  a full batch request of ponies with a known cadence
+        Pony.objects.filter(id__in=ids).update(status=Pony.STATUS_MISSING)
+        counters.reconcile()
+        items = [{'name': f'batch{i}', 'passcode': BENCHMARK_PASSCODE} for i in range(300)]
+        items += [{'name': f'nobody{i}', 'passcode': BENCHMARK_PASSCODE} for i in range(700)]
+        with query_params_counted() as counts:
+            results = self.client.post(reverse('hi_pony_batch'), items, content_type='application/json').json()['data']
+        self.assertLessEqual(max(counts), 999)
+        self.assertEqual([{'previous': Pony.STATUS_MISSING, 'current': Pony.STATUS_NORMAL}] * 300,
+                         [result['data'] for result in results[:300]])
+        self.assertEqual(300, Pony.objects.filter(id__in=ids, status=Pony.STATUS_NORMAL).count())
+
+    @override_settings(LUNA_PONY_CACHE='ponies')
+    def test_heartbeat_file(self):
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(LUNA_HEARTBEAT_FILE=os.path.join(directory, 'heartbeats'),
+                                  LUNA_HEARTBEAT_FLUSH_SECONDS=240):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.get(reverse('hi_pony'), params)
+            first_hi_time = get_testing_pony().last_hi_time
+            with self.assertNumQueries(0):
+                response_json = self.client.get(reverse('hi_pony'), params).json()
+            self.assertEqual({'previous': Pony.STATUS_NORMAL, 'current': Pony.STATUS_NORMAL}, response_json['data'])
+            self.assertEqual(first_hi_time, get_testing_pony().last_hi_time)
+            self.assertEqual(datetime.timedelta(), heartbeat.staleness_allowance())
+
+            #  another worker of the host said hi later, the checker reconciles everybody's heartbeats
+            pony = get_testing_pony()
+            other_worker = LivenessFile(os.path.join(directory, 'heartbeats'))
+            later = now() + datetime.timedelta(seconds=30)
+            self.assertTrue(other_worker.add(pony.id, heartbeat.to_microseconds(later)))
+            self.assertTrue(other_worker.add(GROW_RECORDS * 3, heartbeat.to_microseconds(later)))
+            self.assertIn(GROW_RECORDS * 3, heartbeat.get_store().file.behind())
+            self.assertEqual([], checker.check_ponies())
+            pony = get_testing_pony()
+            self.assertEqual(later, pony.last_hi_time)
+            self.assertEqual(2, IntervalRing(pony.hi_intervals).count)
+            self.assertEqual([], heartbeat.get_store().file.behind())
+            other_worker.close()
+
+            #  once missing, a stale cached copy can't put heartbeats into the file anymore
+            Pony.objects.filter(id=pony.id).update(deadline=now() - datetime.timedelta(days=1))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual([pony.id], [missing.id for missing in checker.check_ponies()])
+            self.assertFalse(heartbeat.get_store().add(pony, now()))
+            pony_cache.put(pony)
+            with self.captureOnCommitCallbacks(execute=True):
+                response_json = self.client.get(reverse('hi_pony'), params).json()
+            self.assertEqual({'previous': Pony.STATUS_MISSING, 'current': Pony.STATUS_NORMAL}, response_json['data'])
+            self.assertTrue(heartbeat.get_store().add(get_testing_pony(), now()))
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'luna.sqlite3')
+
+            def write(hold: float):
+                with tuned_sqlite(path), transaction.atomic(using='tuned'):
+                    connections['tuned'].cursor().execute('UPDATE hay SET bales = bales + 1')
+                    writing.set()
+                    time.sleep(hold)
+
+            with tuned_sqlite(path) as tuned, tuned.cursor() as cursor:
+                cursor.execute('CREATE TABLE hay (id INTEGER PRIMARY KEY, bales INTEGER)')
+                cursor.execute('INSERT INTO hay (id, bales) VALUES (1, 0)')
+                with tuned.schema_editor() as editor:
+                    editor.create_model(Lease)
+                self.assertEqual(('wal',), cursor.execute('PRAGMA journal_mode').fetchone())
+                self.assertEqual((1,), cursor.execute('PRAGMA synchronous').fetchone())
+                self.assertTrue(os.path.exists(path + '-writer'))
+
+                #  readers go on while a transaction writes, the next writer waits until it committed
+                writing = threading.Event()
+                writer = threading.Thread(target=write, args=(0.3,))
+                writer.start()
+                self.assertTrue(writing.wait(5))
+                self.assertEqual((0,), cursor.execute('SELECT bales FROM hay').fetchone())
+                start = time.monotonic()
+                cursor.execute('UPDATE hay SET bales = bales * 10')
+                self.assertGreater(time.monotonic() - start, 0.1)
+                writer.join()
+                self.assertEqual((10,), cursor.execute('SELECT bales FROM hay').fetchone())
+
+            #  a writer gives up after the timeout like SQLite does
+            writing = threading.Event()
+            writer = threading.Thread(target=write, args=(0.5,))
+            writer.start()
+            self.assertTrue(writing.wait(5))
+            with tuned_sqlite(path, timeout=0.05) as tuned:
+                #  a block that only reads neither waits for the writer lock nor sees the uncommitted write
+                start = time.monotonic()
+                with transaction.atomic(using='tuned'):
+                    self.assertEqual((10,), tuned.cursor().execute('SELECT bales FROM hay').fetchone())
+                self.assertLess(time.monotonic() - start, 0.3)
+                with self.assertRaisesMessage(OperationalError, 'database is locked'):
+                    with transaction.atomic(using='tuned'):
+                        tuned.cursor().execute('UPDATE hay SET bales = bales + 100')
+                #  so does one that begins with select_for_update, the rows it reads are to be written
+                with self.assertRaisesMessage(OperationalError, 'database is locked'):
+                    with transaction.atomic(using='tuned'):
+                        list(Lease.objects.using('tuned').select_for_update())
+            writer.join()
+            with tuned_sqlite(path) as tuned, transaction.atomic(using='tuned'):
+                self.assertEqual((11,), tuned.cursor().execute('SELECT bales FROM hay').fetchone())
+
+            #  SQLite's busy handler waits as long as the writer lock without a timeout in OPTIONS
+            untimed = sqlite_backend.DatabaseWrapper(dict(connection.settings_dict, NAME=path, OPTIONS={}), 'untimed')
+            self.assertEqual(sqlite_backend.DEFAULT_TIMEOUT_SECONDS, untimed.get_connection_params()['timeout'])
+
+    @override_settings(LUNA_PONY_CACHE='ponies')
+    def test_cached_hi(self):
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('hi_pony'), params)
+        stats = pony_cache.stats()
+        with override_settings(LUNA_HEARTBEAT_BUFFER=True, LUNA_HEARTBEAT_FLUSH_SECONDS=240,
+                               LUNA_HEARTBEAT_MAX_STALENESS_SECONDS=300), self.assertNumQueries(0):
+            self.client.get(reverse('hi_pony'), params)
+        self.assertEqual(stats['hits'] + 1, pony_cache.stats()['hits'])
+
+        #  the checker marks the pony missing, the next hi must see the transition
+        Pony.objects.filter(name=NEW_TESTING_PONY_NAME).update(last_hi_time=now() - datetime.timedelta(days=1),
+                                                               deadline=now() - datetime.timedelta(days=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            checker.check_ponies()
+        response_json = self.client.get(reverse('hi_pony'), params).json()
+        self.assertEqual({'previous': Pony.STATUS_MISSING, 'current': Pony.STATUS_NORMAL}, response_json['data'])
+
+    @override_settings(LUNA_PONY_CACHE='ponies')
+    def test_stale_cached_pony(self):
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        self.client.get(reverse('hi_pony'), params)
+        #  changed behind the cache's back, e.g. by the checker in another process with a local memory cache
+        Pony.objects.filter(name=NEW_TESTING_PONY_NAME).update(status=Pony.STATUS_MISSING, deadline=None)
+        response_json = self.client.get(reverse('hi_pony'), params).json()
+        self.assertEqual({'previous': Pony.STATUS_MISSING, 'current': Pony.STATUS_NORMAL}, response_json['data'])
+        self.assertEqual(Pony.STATUS_NORMAL, get_testing_pony().status)
+        self.assertEqual(2, History.objects.filter(pony_id=get_testing_pony().id).count())
+
+    async def test_asgi_hi_and_get(self):
+        client = AsyncClient()
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        response_json = (await client.get(reverse('hi_pony') + '?' + urlencode(params))).json()
+        self.assertEqual({'previous': Pony.STATUS_INIT, 'current': Pony.STATUS_NORMAL}, response_json['data'])
+        response_json = (await client.get(reverse('get_pony') + '?' + urlencode(params))).json()
+        self.assertEqual(0, response_json['code'])
+        self.assertEqual(Pony.STATUS_NORMAL, response_json['data']['status'])
+        params['passcode'] = 'wrong pass'
+        response_json = (await client.get(reverse('hi_pony') + '?' + urlencode(params))).json()
+        self.assertEqual(1, response_json['code'])
+
+    def test_heartbeat_ingress(self):
+        passed_on = []
+
+        def django_application(environ, start_response):
+            passed_on.append((environ['REQUEST_METHOD'], environ['PATH_INFO']))
+            start_response('200 OK', [])
+            return [b'django']
+
+        application = ingress.HeartbeatIngress(django_application)
+        factory = RequestFactory()
+        path = reverse('hi_pony')
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+
+        def call(request) -> bytes:
+            statuses = []
+            with connections_kept_open():
+                body = b''.join(application(request.environ, lambda status, headers: statuses.append(status)))
+            self.assertEqual('200 OK', statuses[0])
+            return body
+
+        self.assertEqual({'code': 0, 'data': {'previous': Pony.STATUS_INIT, 'current': Pony.STATUS_NORMAL}, 'msg': ''},
+                         json.loads(call(factory.get(path, params))))
+        self.assertEqual(Pony.STATUS_NORMAL, get_testing_pony().status)
+        response_json = json.loads(call(factory.get(path, params)))
+        self.assertEqual({'previous': Pony.STATUS_NORMAL, 'current': Pony.STATUS_NORMAL}, response_json['data'])
+        #  errors are the same as those of hi_pony
+        for wrong_params in ({}, dict(params, passcode='wrong pass')):
+            self.assertEqual(self.client.get(path, wrong_params).json(),
+                             json.loads(call(factory.get(path, wrong_params))))
+        self.assertEqual([], passed_on)
+
+        #  anything else is Django's, POSTs need a CSRF token like they do through the view
+        self.assertEqual(b'django', call(factory.post(path, params)))
+        self.assertEqual(b'django', call(factory.post(path, urlencode(params),
+                                                      content_type='application/x-www-form-urlencoded')))
+        self.assertEqual(b'django', call(factory.get(reverse('get_pony'), params)))
+        self.assertEqual([('POST', path), ('POST', path), ('GET', reverse('get_pony'))], passed_on)
+
+        #  so are hosts Django rejects and requests it redirects to HTTPS
+        passed_on.clear()
+        self.assertEqual(b'django', call(factory.get(path, params, HTTP_HOST='evil.example')))
+        with override_settings(SECURE_SSL_REDIRECT=True, SECURE_HSTS_SECONDS=3600):
+            application = ingress.HeartbeatIngress(django_application)
+            self.assertEqual(b'django', call(factory.get(path, params)))
+            self.assertEqual([('GET', path)] * 2, passed_on)
+            headers = []
+            with connections_kept_open():
+                application(factory.get(path, params, secure=True).environ,
+                            lambda status, response_headers: headers.extend(response_headers))
+            self.assertEqual(2, len(passed_on))
+            self.assertIn(('Strict-Transport-Security', 'max-age=3600'), headers)
+            self.assertIn(('X-Content-Type-Options', 'nosniff'), headers)
+
+    async def test_asgi_heartbeat_ingress(self):
+        passed_on = []
+
+        async def django_application(scope, receive, send):
+            passed_on.append(scope)
+
+        application = ingress.AsgiHeartbeatIngress(django_application)
+        params = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': reverse('hi_pony'), 'root_path': '',
+                 'query_string': urlencode(params).encode(), 'headers': [(b'host', b'testserver')]}
+        with connections_kept_open():
+            await application(scope, receive, send)
+        self.assertEqual([], passed_on)
+        self.assertEqual(200, messages[0]['status'])
+        self.assertEqual({'previous': Pony.STATUS_INIT, 'current': Pony.STATUS_NORMAL},
+                         json.loads(messages[1]['body'])['data'])
+
+        #  hosts Django rejects, requests it redirects to HTTPS and POSTs are Django's
+        await application(dict(scope, headers=[(b'host', b'evil.example')]), receive, send)
+        with override_settings(SECURE_SSL_REDIRECT=True):
+            await ingress.AsgiHeartbeatIngress(django_application)(scope, receive, send)
+        await application(dict(scope, method='POST'), receive, send)
+        self.assertEqual(3, len(passed_on))
+
+    def test_batch_hi(self):
+        add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=now() - datetime.timedelta(minutes=1),
+                         status=Pony.STATUS_NORMAL)
+        items = [
+            {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE},
+            {'name': MISSING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE},
+            {'name': MISSING_PONY_NAME, 'passcode': 'wrong pass'},
+            {'name': 'x'},
+        ]
+        with self.captureOnCommitCallbacks(execute=True), \
+                patch(__package__ + '.services.notification.run_in_background', side_effect=lambda f, *a: f(*a)):
+            response = self.client.post(reverse('hi_pony_batch'), json.dumps(items), content_type='application/json')
+        response_json = response.json()
+        self.assertEqual(0, response_json['code'])
+        results = response_json['data']
+        self.assertEqual({'previous': Pony.STATUS_INIT, 'current': Pony.STATUS_NORMAL}, results[0]['data'])
+        self.assertEqual({'previous': Pony.STATUS_NORMAL, 'current': Pony.STATUS_NORMAL}, results[1]['data'])
+        self.assertEqual([1, 1], [results[2]['code'], results[3]['code']])
+
+        for name in (NEW_TESTING_PONY_NAME, MISSING_PONY_NAME):
+            pony = get_testing_pony(name)
+            self.assertEqual(Pony.STATUS_NORMAL, pony.status)
+            self.assertTrue(20 > (now() - pony.last_hi_time).total_seconds() >= 0)
+            self.assertEqual(pony.last_hi_time + datetime.timedelta(minutes=pony.dark_minute), pony.deadline)
+        #  only the transition is recorded
+        self.assertEqual(1, History.objects.count())
+        notification.recovery_digest.flush()
+        first_hi_title = notification.generate_status_change_message(get_testing_pony(), Pony.STATUS_INIT,
+                                                                     Pony.STATUS_NORMAL)[0]
+        self.assertIn(first_hi_title, [message.subject for message in mail.outbox])
+
+        response_json = self.client.post(reverse('hi_pony_batch'), 'nope', content_type='application/json').json()
+        self.assertEqual(1, response_json['code'])
+
+    @override_settings(LUNA_DIGEST_THRESHOLD=3)
+    def test_notification_digest(self):
+        for i in range(3):
+            add_testing_pony(name=f'{MISSING_PONY_NAME}_{i}', last_hi_time=now() - datetime.timedelta(days=1),
+                             status=Pony.STATUS_NORMAL)
+        add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=now() - datetime.timedelta(days=1),
+                         status=Pony.STATUS_NORMAL)
+        Pony.objects.filter(name=MISSING_PONY_NAME).update(notify_url='twilight@equestria.org')
+        mail.outbox = []
+        with self.captureOnCommitCallbacks(execute=True):
+            checker.check_ponies()
+        self.assertEqual(2, len(mail.outbox))
+        digest = next(message for message in mail.outbox if message.to == ['luna@equestria.org'])
+        self.assertEqual('3 updates about your ponies', digest.subject)
+        self.assertIn(f'Your pony {MISSING_PONY_NAME}_2 was missing', digest.body)
+        self.assertEqual([f'Your pony {MISSING_PONY_NAME} was missing'],
+                         [message.subject for message in mail.outbox if message.to == ['twilight@equestria.org']])
+
+        #  with a window, recoveries of separate requests are held back and merged
+        mail.outbox = []
+        for i in range(3):
+            with override_settings(LUNA_DIGEST_WINDOW_SECONDS=10), self.captureOnCommitCallbacks(execute=True):
+                self.client.get(reverse('hi_pony'), {'name': f'{MISSING_PONY_NAME}_{i}',
+                                                     'passcode': TESTING_PONY_PASSCODE})
+        self.assertEqual([], mail.outbox)
+        notification.recovery_digest.flush()
+        self.assertEqual(['3 updates about your ponies'], [message.subject for message in mail.outbox])
+
+    @override_settings(LUNA_NOTIFICATION_OUTBOX=True, LUNA_DIGEST_THRESHOLD=3, LUNA_DIGEST_WINDOW_SECONDS=10)
+    def test_notification_outbox_digest(self):
+        for i in range(3):
+            add_testing_pony(name=f'{MISSING_PONY_NAME}_{i}', last_hi_time=now() - datetime.timedelta(days=1),
+                             status=Pony.STATUS_MISSING)
+        mail.outbox = []
+        for i in range(3):
+            self.client.get(reverse('hi_pony'), {'name': f'{MISSING_PONY_NAME}_{i}', 'passcode': TESTING_PONY_PASSCODE})
+        #  recoveries wait in the outbox for the digest window
+        self.assertEqual(3, Outbox.objects.count())
+        self.assertEqual([], dispatcher.claim(NOTIFY_CHANNEL_EMAIL, 10))
+        messages = dispatcher.claim(NOTIFY_CHANNEL_EMAIL, 10, now() + datetime.timedelta(seconds=11))
+        digests = dispatcher.group_digests(messages, 3)
+        self.assertEqual([3], [len(digest) for digest in digests])
+        self.assertEqual([True], dispatcher.deliver_emails(digests, max_attempts=2, retry_seconds=30))
+        self.assertEqual(3, Outbox.objects.filter(status=Outbox.STATUS_SENT).count())
+        self.assertEqual(['3 updates about your ponies'], [message.subject for message in mail.outbox])
+
+    @override_settings(LUNA_NOTIFICATION_OUTBOX=True)
+    def test_notification_outbox(self):
+        add_testing_pony(name=MISSING_PONY_NAME, last_hi_time=now() - datetime.timedelta(days=1),
+                         status=Pony.STATUS_NORMAL)
+        mail.outbox = []
+        with self.captureOnCommitCallbacks(execute=True):
+            checker.check_ponies()
+        self.assertEqual([], mail.outbox)
+        message = Outbox.objects.get()
+        missing_pony = get_testing_pony(MISSING_PONY_NAME)
+        self.assertEqual(missing_pony.id, message.pony_id)
+        self.assertEqual(Outbox.STATUS_PENDING, message.status)
+        self.assertEqual({'EMAIL': {'pending': 1}}, dispatcher.outbox_stats()['depth'])
+
+        #  a failed send is retried later, and dead after max attempts
+        with patch(__package__ + '.services.notification.send_by_channel', return_value=False):
+            message = dispatcher.claim(NOTIFY_CHANNEL_EMAIL, 10)[0]
+            self.assertFalse(dispatcher.deliver(message, max_attempts=2, retry_seconds=30))
+            self.assertEqual([], dispatcher.claim(NOTIFY_CHANNEL_EMAIL, 10))
+            message.refresh_from_db()
+            self.assertEqual(Outbox.STATUS_PENDING, message.status)
+            self.assertAlmostEqual(30, (message.next_attempt_time - now()).total_seconds(), delta=5)
+        message = dispatcher.claim(NOTIFY_CHANNEL_EMAIL, 10, now() + datetime.timedelta(seconds=31))[0]
+        self.assertTrue(dispatcher.deliver(message, max_attempts=2, retry_seconds=30))
+        message.refresh_from_db()
+        self.assertEqual(Outbox.STATUS_SENT, message.status)
+        self.assertEqual(2, message.attempts)
+        self.assertEqual([message.title], [sent.subject for sent in mail.outbox])
+        self.assertEqual(datetime.timedelta(seconds=120), dispatcher.retry_delay(3, 30))
+
+
+class TransitionStreamTest (TransactionTestCase):
+    """Long polls wait in tasks of their own which query from other threads, so nothing may stay uncommitted"""
+
+    def setUp(self) -> None:
+        add_testing_pony()
+        clear_pony_cache()
+
+    def tearDown(self) -> None:
+        notification.recovery_digest.flush()
+
+    async def test_transitions_long_poll(self):
+        client = AsyncClient()
+        credentials = {'name': NEW_TESTING_PONY_NAME, 'passcode': TESTING_PONY_PASSCODE}
+        await client.get(reverse('hi_pony') + '?' + urlencode(credentials))
+        url = reverse('transitions_pony') + '?' + urlencode(dict(credentials, after=0, timeout=5))
+        data = (await client.get(url)).json()['data']
+        self.assertEqual([(NEW_TESTING_PONY_NAME, Pony.STATUS_INIT, Pony.STATUS_NORMAL)],
+                         [(row['name'], row['previous_status'], row['current_status']) for row in data['transitions']])
+
+        #  nothing new, the poll gives up after its timeout
+        cursor = data['cursor']
+        url = reverse('transitions_pony') + '?' + urlencode(dict(credentials, after=cursor, timeout=1))
+        self.assertEqual({'transitions': [], 'cursor': cursor}, (await client.get(url)).json()['data'])
+
+        #  a change recorded while the request waits is answered right after the next poll
+        url = reverse('transitions_pony') + '?' + urlencode(dict(credentials, after=cursor, timeout=10))
+        poll = asyncio.ensure_future(client.get(url))
+        await asyncio.sleep(0.2)
+        pony = await sync_to_async(get_testing_pony)()
+        await sync_to_async(checker.mark_pony_missing)(pony)
+        data = (await asyncio.wait_for(poll, 5)).json()['data']
+        self.assertEqual([(Pony.STATUS_NORMAL, Pony.STATUS_MISSING)],
+                         [(row['previous_status'], row['current_status']) for row in data['transitions']])
+        self.assertGreater(data['cursor'], cursor)
+
+        #  the changes of all ponies need the token
+        url = reverse('transitions_pony') + '?after=0&timeout=0'
+        self.assertEqual(1, (await client.get(url)).json()['code'])
+        with override_settings(LUNA_TRANSITIONS_TOKEN='moon'):
+            self.assertEqual(1, (await client.get(url, authorization='Bearer sun')).json()['code'])
+            data = (await client.get(url, authorization='Bearer moon')).json()['data']
+        self.assertEqual(2, len(data['transitions']))
+
+    def test_transitions_polls_of_threads(self):
+        #  like under WSGI, where every request runs its own event loop in its own thread
+        watcher = transitions.TransitionWatcher(poll_interval=0.1)
+        seen_id = transitions.latest_id()
+        woken: typing.Dict[str, typing.Tuple[bool, float]] = {}
 
+        def poll(name: str):
+            try:
+                woken[name] = (asyncio.run(watcher.wait(seen_id, 3)), time.monotonic())
+            finally:
+                connections.close_all()
 
+        threads = [threading.Thread(target=poll, args=(name,)) for name in ('first', 'second')]
+        #  the in-memory test database locks the table for polls while the change is written, they try again
+        with patch.object(transitions, 'logging'):
+            for thread in threads:
+                thread.start()
+                time.sleep(0.2)
+            changed_at = time.monotonic()
+            checker.mark_pony_missing(get_testing_pony())
+            for thread in threads:
+                thread.join()
+        self.assertEqual({'first', 'second'}, set(woken))
+        for name, (changed, at) in woken.items():
+            self.assertTrue(changed, name)
+            self.assertLess(at - changed_at, 1, name)
+        self.assertGreater(watcher.latest, seen_id)
+        self.assertEqual({}, watcher.waiters)
+        self.assertEqual({}, watcher.tasks)
@@ -5,7 +5,14 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('pony/add', views.add_pony, name='add_pony'),
     path('pony/hi', views.hi_pony, name='hi_pony'),
+    path('pony/hi/batch', views.hi_pony_batch, name='hi_pony_batch'),
+    path('pony/bulk', views.bulk_pony, name='bulk_pony'),
     path('pony/get', views.get_pony, name='get_pony'),
+    path('pony/history', views.history_pony, name='history_pony'),
+    path('pony/transitions', views.transitions_pony, name='transitions_pony'),
+    path('pony/uptime', views.uptime_pony, name='uptime_pony'),
+    path('pony/overview', views.overview_pony, name='overview_pony'),
     path('pony/change', views.change_pony, name='change_pony'),
-    path('pony/remove', views.remove_pony, name='remove_pony')
+    path('pony/remove', views.remove_pony, name='remove_pony'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -1,10 +1,128 @@
 import concurrent.futures
 import hashlib
-import logging
-from urllib import request
+import http.client
+import threading
+import typing
+from urllib.parse import urlsplit
 import json
 from concurrent.futures import ThreadPoolExecutor
 
+from django.db import connection
+
+from . import metrics
+
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 10
+HTTP_MAX_RESPONSE_BYTES = 1024 * 1024
+HTTP_MAX_IDLE_PER_HOST = 4
+#  parameters of a batched statement that don't depend on the number of rows, e.g. a status condition
+SHARED_QUERY_PARAMS = 10
+
+
+class HttpError(IOError):
+    pass
+
+
+class HttpConnectionPool:
+    """Keeps idle keep-alive connections per scheme, host and port, and applies timeouts and a response size limit.
+
+    Connections are only reused after their response was read completely, at most max_idle_per_host of them
+    are kept per host, extra ones are closed when they are given back.
+    """
+
+    def __init__(self, connect_timeout: float = HTTP_CONNECT_TIMEOUT, read_timeout: float = HTTP_READ_TIMEOUT,
+                 max_response_bytes: int = HTTP_MAX_RESPONSE_BYTES, max_idle_per_host: int = HTTP_MAX_IDLE_PER_HOST):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_response_bytes = max_response_bytes
+        self.max_idle_per_host = max_idle_per_host
+        self.lock = threading.Lock()
+        self.idle: typing.Dict[tuple, typing.List[http.client.HTTPConnection]] = {}
+        self.connections_opened = 0
+
+    def request(self, method: str, url: str, body: bytes = None,
+                headers: typing.Dict[str, str] = None) -> typing.Tuple[int, bytes]:
+        """Sends the request and returns the status and body, raises HttpError on 4xx and 5xx responses"""
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'unsupported url: {url}')
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn, reused = self.acquire(key)
+        try:
+            try:
+                response = self.send(conn, method, path, body, headers)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                #  the server closed the idle connection meanwhile, it never saw this request
+                conn.close()
+                conn, reused = self.acquire(key, fresh=True)
+                response = self.send(conn, method, path, body, headers)
+            data = response.read(self.max_response_bytes + 1)
+            if len(data) > self.max_response_bytes:
+                raise HttpError(f'response of {url} is larger than {self.max_response_bytes} bytes')
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+        if response.status >= 400:
+            raise HttpError(f'{url} responded {response.status}: {data[:200]!r}')
+        return response.status, data
+
+    def send(self, conn: http.client.HTTPConnection, method: str, path: str, body: bytes,
+             headers: typing.Dict[str, str]) -> http.client.HTTPResponse:
+        if conn.sock is None:
+            conn.connect()
+            with self.lock:
+                self.connections_opened += 1
+        conn.sock.settimeout(self.read_timeout)
+        conn.request(method, path, body=body, headers=headers or {})
+        return conn.getresponse()
+
+    def acquire(self, key: tuple, fresh: bool = False) -> typing.Tuple[http.client.HTTPConnection, bool]:
+        if not fresh:
+            with self.lock:
+                idle = self.idle.get(key)
+                if idle:
+                    return idle.pop(), True
+        scheme, host, port = key
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(host, port, timeout=self.connect_timeout), False
+
+    def release(self, key: tuple, conn: http.client.HTTPConnection):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+http_pool = HttpConnectionPool()
+
+
+def batch_size(params_per_row: int, limit: int) -> int:
+    """Rows per batched statement, at most limit and few enough for the database's limit of parameters per query,
+    e.g. 999 on SQLite before 3.32"""
+    max_params = connection.features.max_query_params
+    if max_params is None:
+        return limit
+    return max(1, min(limit, (max_params - SHARED_QUERY_PARAMS) // params_per_row))
+
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -12,17 +130,18 @@ def hash_password(password: str) -> str:
 
 def send_json_request(url: str, params: dict, ret_json=True) -> dict:
     post_data = json.dumps(params).encode('utf-8')
-    req = request.Request(url, data=post_data, headers={'Content-Type': 'application/json'})
-    response = request.urlopen(req)
-    response_text = response.read().decode('utf-8')
+    _, response = http_pool.request('POST', url, post_data, headers={'Content-Type': 'application/json'})
+    response_text = response.decode('utf-8')
     if ret_json:
         return json.loads(response_text)
     return response_text
 
 
 def run_in_background(func , *args, **kwargs) -> concurrent.futures.Future:
+    metrics.BACKGROUND_QUEUE.inc()
     f = run_in_background.executor.submit(func,*args, **kwargs)
+    f.add_done_callback(lambda _: metrics.BACKGROUND_QUEUE.dec())
     return f
 
 
-run_in_background.executor = ThreadPoolExecutor(max_workers=3)
\ No newline at end of file
+run_in_background.executor = ThreadPoolExecutor(max_workers=3)
@@ -1,24 +1,46 @@
+import asyncio
+import hmac
+import json
 import logging
 import typing
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.shortcuts import render
 from django.http import HttpResponse, JsonResponse, HttpRequest
-from django.forms import IntegerField, EmailField, model_to_dict
+from django.forms import IntegerField, model_to_dict
+from django.db import transaction, IntegrityError
 from django.utils.timezone import now
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from .forms import *
 from .consts import *
-from .models import Pony, History
-from .utils import hash_password, run_in_background
-from .services import notification
+from .models import Pony
+from .utils import hash_password
+from .intervals import RING_SIZE
+from . import metrics
+from .services import notification, heartbeat, pony_cache, history, availability, transitions, \
+    provisioning, counters
 
 
 # Create your views here.
 
+#  form fields hold no state while cleaning, so the hot paths share them
+NAME_FIELD = NameField()
+PASSCODE_FIELD = PasscodeField()
+
+HI_BATCH_MAX_SIZE = 1000
+PROVISION_MAX_SIZE = 10000
+OVERVIEW_NAMES = {Pony.STATUS_INIT: 'init', Pony.STATUS_NORMAL: 'normal', Pony.STATUS_MISSING: 'missing'}
+
+
 def index(request: HttpRequest):
     context = {
-        'domain': request.get_host()
+        'domain': request.get_host(),
+        'interval_ring_size': RING_SIZE,
+        'overview': overview(),
     }
     return render(request, 'keeper/index.html', context)
 
@@ -28,58 +50,212 @@ def add_pony(request: HttpRequest):
         query_params = get_query_param(request)
         name = NameField().clean(query_params.get('name'))
         passcode = PasscodeField().clean(query_params.get('passcode'))
-        dark_minute = IntegerField(min_value=5, max_value=43200).clean(query_params.get('dark_minute'))
-        notify_channel = NotifyChannelField().clean(query_params.get('notify_channel'))
-        if notify_channel == NOTIFY_CHANNEL_EMAIL:
-            notify_url = EmailField().clean(query_params.get('notify_url'))
-        else:
-            notify_url = NotifyWebUrlField().clean(query_params.get('notify_url'))
+        dark_minute, notify_channel, notify_url = provisioning.clean_settings(query_params)
     except ValidationError as e:
         return error_response(e.messages[0])
-    #  check whether name exists
-    num_of_pony = Pony.objects.filter(name__exact=name).count()
-    if num_of_pony > 0:
-        return error_response('pony with same name already exists')
     pony = Pony(name=name, passcode=hash_password(passcode), dark_minute=dark_minute, notify_channel=notify_channel,
                 notify_url=notify_url, create_time=now(), status=Pony.STATUS_INIT)
-    pony.save()
-    run_in_background(notification.send_by_channel, 'pony created', f'Your pony {name} has been created',
-                      notify_channel, notify_url)
+    try:
+        with transaction.atomic():
+            #  the unique name decides between concurrent requests
+            pony.save()
+            counters.adjust({Pony.STATUS_INIT: 1})
+            notification.notify_by_channel('pony created', f'Your pony {name} has been created', notify_channel,
+                                           notify_url, pony.id)
+    except IntegrityError:
+        return error_response('pony with same name already exists')
     return succ_response({'id': pony.id, 'name': pony.name},
                          msg="check your notification channel whether you've received a creation message")
 
 
 def hi_pony(request):
-    pony = check_pony_or_response(request)
+    pony = check_pony_or_response(request, cached=True)
     if type(pony) != Pony:
         return pony
+    return hi_response(pony)
 
-    previous_status = pony.status
-    after_status = Pony.STATUS_NORMAL
 
-    pony.status = after_status
-    pony.last_hi_time = now()
-    pony.save()
+def hi_pony_by_credentials(name: str, passcode: str, pony: Pony = None):
+    if pony is None:
+        pony = check_and_get_pony(name, passcode, cached=True)
+        if pony is None:
+            return error_response('failed to find pony,check your name and passcode')
+    return hi_response(pony)
 
-    if previous_status != after_status:
-        history = History()
-        history.pony_id = pony.id
-        history.previous_status = previous_status
-        history.current_status = after_status
-        history.create_time = now()
-        history.save()
-        #  send notification
-        run_in_background(notification.send_status_change_notification, pony, previous_status, after_status)
-        logging.info("Pony status change:%s,%d,%d", pony.name, previous_status, after_status)
 
+def hi_response(pony: Pony):
+    try:
+        previous_status, after_status = heartbeat.record_hi(pony)
+    except Pony.DoesNotExist:
+        return error_response('failed to find pony,check your name and passcode')
     return succ_response({'previous': previous_status, 'current': after_status})
 
 
+@csrf_exempt
+@require_POST
+def hi_pony_batch(request):
+    """Heartbeats of many ponies in one request, e.g. from a gateway.
+
+    The body is a JSON array of {"name": ..., "passcode": ...} objects, the data of the response is a list of
+    per-item results in the same order, each one like the response of hi_pony.
+    """
+    try:
+        items = json.loads(request.body)
+    except ValueError:
+        return error_response('request body must be a JSON array')
+    if not isinstance(items, list) or not items:
+        return error_response('request body must be a non-empty JSON array')
+    if len(items) > HI_BATCH_MAX_SIZE:
+        return error_response(f'at most {HI_BATCH_MAX_SIZE} ponies per request')
+
+    results: typing.List[typing.Optional[dict]] = [None] * len(items)
+    credentials = {}
+    for i, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValidationError('each item must be an object with name and passcode')
+            name = NAME_FIELD.clean(item.get('name'))
+            passcode = PASSCODE_FIELD.clean(item.get('passcode'))
+        except ValidationError as e:
+            results[i] = {'code': RESPONSE_CODE_FAIL, 'msg': e.messages[0]}
+            continue
+        credentials[i] = (name, hash_password(passcode))
+
+    with transaction.atomic():
+        names = sorted({name for name, _ in credentials.values()})
+        ponies = {}
+        #  IN (...) lists of FLUSH_BATCH_SIZE stay below the SQLite variable limit
+        for start in range(0, len(names), heartbeat.FLUSH_BATCH_SIZE):
+            ponies.update(((pony.name, pony.passcode), pony) for pony in Pony.objects.select_for_update().filter(
+                name__in=names[start:start + heartbeat.FLUSH_BATCH_SIZE]))
+        statuses = heartbeat.record_his(list({pony.id: pony for pony in ponies.values()}.values()))
+    for i, key in credentials.items():
+        pony = ponies.get(key)
+        if pony is None:
+            logging.warning("failed to find pony:%s", key[0])
+            results[i] = {'code': RESPONSE_CODE_FAIL, 'msg': 'failed to find pony,check your name and passcode'}
+        else:
+            previous_status, after_status = statuses[pony.id]
+            results[i] = {'code': RESPONSE_CODE_SUCC, 'data': {'previous': previous_status, 'current': after_status}}
+    return succ_response(results)
+
+
+@csrf_exempt
+@require_POST
+def bulk_pony(request):
+    """Creates, updates and deletes many ponies in one transaction, all of them or none.
+
+    The body is a JSON array of objects with an action of create, update or delete and the params of add_pony,
+    change_pony or remove_pony, or CSV with a header row if the Content-Type is text/csv.
+    If any item is rejected the data of the response lists the errors by item index.
+    """
+    format = 'csv' if request.content_type == 'text/csv' else 'json'
+    try:
+        items = provisioning.parse_items(request.body.decode(), format)
+    except ValueError as e:
+        return error_response(f'failed to parse the {format} body: {e}')
+    if not items:
+        return error_response('request body must contain at least one pony')
+    if len(items) > PROVISION_MAX_SIZE:
+        return error_response(f'at most {PROVISION_MAX_SIZE} ponies per request')
+    try:
+        result = provisioning.provision(items)
+    except provisioning.ProvisioningError as e:
+        return JsonResponse({'code': RESPONSE_CODE_FAIL, 'data': e.errors, 'msg': str(e)})
+    return succ_response(result)
+
+
 def get_pony(request):
     pony = check_pony_or_response(request)
     if type(pony) != Pony:
         return pony
-    return succ_response(model_to_dict(pony))
+    return succ_response(pony_to_dict(pony))
+
+
+def history_pony(request):
+    """Status changes of the pony newest first, pass next_cursor of a page as cursor to get the following page"""
+    pony = check_pony_or_response(request)
+    if type(pony) != Pony:
+        return pony
+    query_params = get_query_param(request)
+    try:
+        limit = IntegerField(min_value=1, max_value=history.PAGE_MAX_SIZE, required=False) \
+            .clean(query_params.get('limit')) or 20
+        rows, next_cursor = history.page(pony.id, limit, query_params.get('cursor'))
+    except ValidationError as e:
+        return error_response(e.messages[0])
+    except ValueError:
+        return error_response('invalid cursor')
+    return succ_response({
+        'history': [{'id': row.id, 'create_time': row.create_time, 'previous_status': row.previous_status,
+                     'current_status': row.current_status} for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+
+async def transitions_pony(request):
+    """Long poll for status changes after the History.id `after`, oldest first.
+
+    Answers as soon as there are any, or without any after `timeout` seconds, pass the cursor of the response
+    as `after` of the next request. With name and passcode only the pony's changes are returned, all of them
+    with a bearer token matching LUNA_TRANSITIONS_TOKEN.
+    """
+    query_params = get_query_param(request)
+    try:
+        after = IntegerField(min_value=0, required=False).clean(query_params.get('after'))
+        limit = IntegerField(min_value=1, max_value=transitions.PAGE_MAX_SIZE, required=False) \
+            .clean(query_params.get('limit')) or transitions.PAGE_MAX_SIZE
+        timeout = IntegerField(min_value=0, max_value=transitions.LONG_POLL_MAX_SECONDS, required=False) \
+            .clean(query_params.get('timeout'))
+    except ValidationError as e:
+        return error_response(e.messages[0])
+    if timeout is None:
+        timeout = transitions.LONG_POLL_SECONDS
+    pony_id = None
+    if 'name' in query_params or 'passcode' in query_params:
+        try:
+            name, passcode = get_credentials(request)
+        except ValidationError as e:
+            return error_response(e.messages[0])
+        pony = await sync_to_async(check_and_get_pony)(name, passcode)
+        if pony is None:
+            return error_response('failed to find pony,check your name and passcode')
+        pony_id = pony.id
+    elif not has_transitions_token(request):
+        return error_response('name and passcode of a pony or a valid token are required')
+
+    loop = asyncio.get_running_loop()
+    give_up_time = loop.time() + timeout
+    seen_id = await sync_to_async(transitions.latest_id)()
+    if after is None:
+        after = seen_id
+    while True:
+        rows = await sync_to_async(transitions.since)(after, limit, pony_id)
+        remaining = give_up_time - loop.time()
+        if rows or remaining <= 0 or not await transitions.watcher.wait(seen_id, remaining):
+            break
+        seen_id = transitions.watcher.latest
+    return succ_response({'transitions': rows, 'cursor': rows[-1]['id'] if rows else after})
+
+
+def has_transitions_token(request) -> bool:
+    token = getattr(settings, 'LUNA_TRANSITIONS_TOKEN', None)
+    authorization = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+
+
+def uptime_pony(request):
+    """Availability of the pony over the last 7, 30 and 90 days"""
+    pony = check_pony_or_response(request)
+    if type(pony) != Pony:
+        return pony
+    return succ_response(availability.uptime(pony))
+
+
+def pony_to_dict(pony: Pony) -> dict:
+    data = model_to_dict(pony)
+    data['hi_intervals'] = pony.interval_summary()
+    return data
 
 
 def change_pony(request):
@@ -87,38 +263,27 @@ def change_pony(request):
     pony = check_pony_or_response(request)
     if type(pony) != Pony:
         return pony
-    dark_minute = pony.dark_minute
-    notify_channel = pony.notify_channel
-    notify_url = pony.notify_url
-
-    query_params = get_query_param(request)
     try:
-        if 'dark_minute' in query_params:
-            dark_minute = IntegerField(min_value=5, max_value=43200).clean(query_params.get('dark_minute'))
-        if 'notify_channel' in query_params:
-            notify_channel = NotifyChannelField().clean(query_params.get('notify_channel'))
-        if 'notify_url' in query_params:
-            notify_url = query_params.get('notify_url')
-        if notify_channel == NOTIFY_CHANNEL_EMAIL:
-            notify_url = EmailField().clean(notify_url)
-        else:
-            notify_url = NotifyWebUrlField().clean(notify_url)
+        dark_minute, notify_channel, notify_url = provisioning.clean_settings(get_query_param(request), pony)
     except ValidationError as e:
         return error_response(e.messages[0])
 
-    pony.dark_minute = dark_minute
-    need_notification: bool = False
-    if pony.notify_url != notify_url or pony.notify_channel != notify_channel:
-        pony.notify_channel = notify_channel
-        pony.notify_url = notify_url
-        need_notification = True
-    pony.save()
+    need_notification = pony.notify_url != notify_url or pony.notify_channel != notify_channel
+    with transaction.atomic():
+        #  status, heartbeat and cadence are the ones of the locked row, never our copy's
+        pony = Pony.objects.select_for_update().filter(id=pony.id).first()
+        if pony is None:
+            return error_response('failed to find pony,check your name and passcode')
+        pony.dark_minute = dark_minute
+        pony.refresh_deadline()
+        Pony.objects.filter(id=pony.id).update(dark_minute=dark_minute, notify_channel=notify_channel,
+                                               notify_url=notify_url, deadline=pony.deadline,
+                                               expected_deadline=pony.expected_deadline)
+    pony_cache.invalidate([pony])
 
     if need_notification:
-        run_in_background(notification.send_by_channel,
-                          "Pony Updated",
-                          f"Your pony {pony.name} has been updated",
-                          notify_channel, notify_url)
+        notification.notify_by_channel("Pony Updated", f"Your pony {pony.name} has been updated",
+                                       notify_channel, notify_url, pony.id)
 
     return succ_response({'name': pony.name, 'dark_minute': dark_minute,
                           'notify_channel': notify_channel,
@@ -130,10 +295,34 @@ def remove_pony(request):
     pony = check_pony_or_response(request)
     if type(pony) != Pony:
         return pony
-    pony.delete()
+    with transaction.atomic():
+        #  the status counted down must be the one deleted
+        pony = Pony.objects.select_for_update().filter(id=pony.id).first()
+        if pony is None:
+            return error_response('failed to find pony,check your name and passcode')
+        pony.delete()
+        counters.adjust({pony.status: -1})
+    pony_cache.invalidate([pony])
     return succ_response(None)
 
 
+def overview_pony(request):
+    """Number of ponies per status, read from the status counters"""
+    return succ_response(overview())
+
+
+def overview() -> dict:
+    by_status = counters.counts()
+    result = {name: by_status[status] for status, name in OVERVIEW_NAMES.items()}
+    result['total'] = sum(by_status.values())
+    return result
+
+
+def metrics_view(request):
+    """Metrics of all workers in the Prometheus text format"""
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def error_response(message: str, code=RESPONSE_CODE_FAIL):
     return JsonResponse({'code': code, 'msg': message})
 
@@ -152,23 +341,37 @@ def get_query_param(request: HttpRequest):
     return query_params
 
 
-def check_pony_or_response(request):
+def get_credentials(request) -> typing.Tuple[str, str]:
+    return clean_credentials(get_query_param(request))
+
+
+def clean_credentials(query_params) -> typing.Tuple[str, str]:
+    return NAME_FIELD.clean(query_params.get('name')), PASSCODE_FIELD.clean(query_params.get('passcode'))
+
+
+def check_pony_or_response(request, cached=False):
     try:
-        query_params = get_query_param(request)
-        name = NameField().clean(query_params.get('name'))
-        passcode = PasscodeField().clean(query_params.get('passcode'))
+        name, passcode = get_credentials(request)
     except ValidationError as e:
         return error_response(e.messages[0])
-    pony = check_and_get_pony(name, passcode)
+    pony = check_and_get_pony(name, passcode, cached)
     if pony is None:
         return error_response('failed to find pony,check your name and passcode')
     return pony
 
 
-def check_and_get_pony(name: str, passcode: str) -> typing.Optional[Pony]:
+def check_and_get_pony(name: str, passcode: str, cached=False) -> typing.Optional[Pony]:
+    """Finds the pony by its credentials, cached=True may return a snapshot from the pony cache"""
     passcode = hash_password(passcode)
+    if cached:
+        pony = pony_cache.get(name, passcode)
+        if pony is not None:
+            return pony
     try:
-        return Pony.objects.get(name=name, passcode=passcode)
+        pony = Pony.objects.get(name=name, passcode=passcode)
+        if cached:
+            pony_cache.put(pony)
+        return pony
     except Pony.DoesNotExist:
         logging.warning("failed to find pony:%s", name)
         return None
@@ -0,0 +1,35 @@
+"""
+Fast-start entry point of the checker for cron jobs on small hosts, takes the options of `manage.py checkpony`:
+`*/5 * * * * DJANGO_PRODUCTION=1 python -m luna.checker`
+
+It runs with the minimal settings profile, imports the checkpony command directly instead of discovering the
+commands of every app, and skips the system checks, which guard the web application rather than a sweep.
+"""
+import os
+import sys
+
+
+def setup():
+    """django.setup() with the minimal profile, unless DJANGO_SETTINGS_MODULE says otherwise"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'luna.settings_minimal')
+    if sys.version_info < (3, 12) and 'distutils' not in sys.modules:
+        #  Django 3.2 imports distutils for a version comparison, setuptools >= 60 swaps it for its own copy
+        #  which pulls in all of pkg_resources and takes longer to import than the rest of the checker
+        try:
+            import _distutils_hack
+            _distutils_hack.remove_shim()
+        except (ImportError, AttributeError):
+            pass
+
+    import django
+    django.setup()
+
+
+def main(argv=None):
+    setup()
+    from keeper.management.commands.checkpony import Command
+    Command().run_from_argv(['checker', 'checkpony', '--skip-checks'] + (sys.argv[1:] if argv is None else argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'keeper.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -70,8 +71,12 @@ WSGI_APPLICATION = 'luna.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'keeper.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # seconds a write waits for the one before it
+            'timeout': 20,
+        },
     }
 }
 
@@ -135,6 +140,77 @@ EMAIL_HOST_PASSWORD = ''
 EMAIL_USE_SSL = False
 DEFAULT_FROM_EMAIL = 'luna@equestria.org'
 
+# Alias of the cache used to authenticate heartbeats without a database read, None disables it.
+# With several worker processes use a shared backend like memcached or redis: a passcode change or a removal
+# only clears the entry in the cache of the process that made it, a local memory cache elsewhere keeps
+# accepting the old credentials until the entry times out.
+LUNA_PONY_CACHE = None
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'ponies': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'luna-ponies',
+        'TIMEOUT': 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+# Coalesce heartbeats of normal ponies in memory and write them in batches.
+# The checker waits LUNA_HEARTBEAT_MAX_STALENESS_SECONDS longer before marking a pony missing when this is on.
+LUNA_HEARTBEAT_BUFFER = False
+LUNA_HEARTBEAT_FLUSH_SECONDS = 5
+LUNA_HEARTBEAT_MAX_STALENESS_SECONDS = 30
+# Or keep them in this memory-mapped file shared by all workers of the host, which write them every
+# LUNA_HEARTBEAT_FLUSH_SECONDS. checkpony must run on the same host, it writes all of them before each sweep.
+LUNA_HEARTBEAT_FILE = None
+# Answer /pony/hi in luna.wsgi and luna.asgi before Django's URL routing and middleware, with the same response.
+# Measure it with `manage.py benchmark hi-ingress` on your setup before turning it on.
+LUNA_HEARTBEAT_INGRESS = False
+
+# Write notifications to an outbox table in the same transaction as the status change, and send them with
+# `manage.py dispatchnotifications --daemon`. Failed sends are retried with exponential backoff.
+LUNA_NOTIFICATION_OUTBOX = False
+LUNA_NOTIFICATION_CONCURRENCY = {'EMAIL': 2, 'SLACK': 4}
+LUNA_NOTIFICATION_MAX_ATTEMPTS = 8
+LUNA_NOTIFICATION_RETRY_SECONDS = 30
+
+# Notifications to the same destination are merged into one digest once there are this many of them, 0 disables it.
+# Recoveries reported by hi_pony are held back LUNA_DIGEST_WINDOW_SECONDS so that they can be merged as well.
+# Turn on LUNA_NOTIFICATION_OUTBOX before setting a window, without it held recoveries wait in the memory of the
+# worker and are lost when it exits, e.g. when gunicorn recycles it after max_requests.
+LUNA_DIGEST_THRESHOLD = 5
+LUNA_DIGEST_WINDOW_SECONDS = 0
+
+# Status history older than this is deleted by `manage.py prunehistory`
+LUNA_HISTORY_RETENTION_DAYS = 180
+
+# Directory where every process keeps its metrics for /metrics, so that it shows the sum over all workers.
+# Use a directory on a local disk or tmpfs and empty it before starting the workers, None keeps metrics per process.
+LUNA_METRICS_DIR = None
+
+# Seconds a checkpony process holds its shard without renewing it, after that another checker may take it over.
+# Keep it longer than a sweep takes and the clocks of checker nodes in sync.
+LUNA_CHECKER_LEASE_SECONDS = 300
+
+# Pragmas run on every new connection of the keeper.backends.sqlite3 engine, WAL lets reads go on while one writes.
+# With the writer queue on, writes of all workers of the host take turns instead of failing with "database is locked".
+# Keep the database on a local disk, WAL doesn't work on network file systems.
+LUNA_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+}
+LUNA_SQLITE_WRITER_QUEUE = True
+
+# Bearer token that gives /pony/transitions the status changes of all ponies, e.g. for dashboards. None disables it.
+LUNA_TRANSITIONS_TOKEN = None
+
 if not os.environ.get('DJANGO_PRODUCTION'):
     # Quick-start development settings - unsuitable for production
     # See https://docs.djangoproject.com/en/3.2/howto/deployment/checklist/
@@ -0,0 +1,37 @@
+"""
+Minimal runtime profile of luna, e.g. for `python -m luna.checker`.
+
+Only keeper is installed: no admin, auth, sessions, messages or static files, and /admin/ isn't served.
+Everything else, including settings_prod and settings_dev, is the same as in luna.settings.
+Web workers that don't need the admin site can use it as well:
+`DJANGO_SETTINGS_MODULE=luna.settings_minimal gunicorn luna.wsgi`
+"""
+from .settings import *
+
+INSTALLED_APPS = [
+    'keeper.apps.KeeperConfig',
+]
+
+MIDDLEWARE = [
+    'keeper.middleware.MetricsMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+]
+
+ROOT_URLCONF = 'keeper.urls'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.debug',
+                'django.template.context_processors.request',
+            ],
+        },
+    },
+]
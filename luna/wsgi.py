@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'luna.settings')
 
 application = get_wsgi_application()
+
+from keeper import ingress  # noqa: E402, needs the apps loaded by get_wsgi_application()
+
+if ingress.ingress_enabled():
+    #  heartbeats skip Django's routing and middleware
+    application = ingress.HeartbeatIngress(application)